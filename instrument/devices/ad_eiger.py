@@ -5,18 +5,22 @@ Eiger area detector
 
 # Borrowed from 4-id-polar which in turn was adapted from NSLS-II CHX
 
+from collections import deque, OrderedDict
+from contextlib import contextmanager
 from pathlib import PurePath
+from threading import Lock
 from time import time as ttime
 from ophyd import (Component, ADComponent, EigerDetectorCam, DetectorBase,
                    Staged, EpicsSignal, Signal, Kind, Device)
 from ophyd.areadetector.base import EpicsSignalWithRBV
 from ophyd.signal import EpicsSignalRO
-from ophyd.status import wait as status_wait, SubscriptionStatus
+from ophyd.status import wait as status_wait, DeviceStatus, SubscriptionStatus
 from ophyd.areadetector.plugins import ROIPlugin_V34, StatsPlugin_V34
 from ophyd.areadetector.trigger_mixins import TriggerBase, ADTriggerStatus
 from ophyd.areadetector.filestore_mixins import FileStoreBase
 from ophyd.utils.epics_pvs import set_and_wait
 from os.path import join, isdir
+from .staging import apply_settings, DiffStagedDevice
 from ..session_logs import logger
 logger.info(__file__)
 
@@ -29,7 +33,7 @@ IMAGE_DIR = '2021-2/test_bluesky'
 # EigerDetectorCam inherits FileBase, which contains a few PVs that were
 # removed from AD after V22: file_number_sync, file_number_write,
 # pool_max_buffers.
-class LocalEigerCam(EigerDetectorCam):
+class LocalEigerCam(EigerDetectorCam, DiffStagedDevice):
     
 	file_number_sync = None
 	file_number_write = None
@@ -44,16 +48,70 @@ class LocalEigerCam(EigerDetectorCam):
 class LocalTrigger(TriggerBase):
     """
     This trigger mixin class takes one acquisition per trigger.
+
+    With ``setup_batch_trigger`` the images of several triggers come from
+    one trigger button press (``num_images`` per press) or from external
+    gates; each trigger then only waits for its image to be counted, at
+    most ``batch_trigger_timeout`` seconds.  ``restore_trigger`` puts back
+    the trigger set up before (at unstage when called while staged).
     """
     _status_type = ADTriggerStatus
+    # seconds a batched (or gated) trigger waits for its image
+    batch_trigger_timeout = 30
 
     def __init__(self, *args, image_name=None, **kwargs):
         super().__init__(*args, **kwargs)
         if image_name is None:
             image_name = '_'.join([self.name, 'image'])
         self._image_name = image_name
-        self._image_count = self.cam.array_counter
+        self._image_count = self.cam.num_images_counter
         self._acquisition_signal = self.cam.special_trigger_button
+        self._images_per_trigger = 1
+        self._gated = False
+        # images triggered and counted since staging, and the statuses
+        # of the triggers waiting for their image: (image, status)
+        self._images_triggered = 0
+        self._images_counted = 0
+        self._pending = deque()
+        self._pending_lock = Lock()
+        self._kept_armed = False
+        # (cam stage_sigs, images per trigger, gated) before the batch
+        self._saved_trigger = None
+        self._restore_at_unstage = False
+
+    @property
+    def kept_armed(self):
+        "True inside keep_armed(), the detector stays armed between runs."
+        return self._kept_armed
+
+    @contextmanager
+    def keep_armed(self):
+        """
+        Keep the detector armed across the runs inside the block
+
+            with eiger.keep_armed():
+                for z in z_positions:
+                    RE(VPstepScan([eiger], ..., z_pos=z))
+
+        The detector is staged and armed once (Internal Series, manual
+        trigger).  The Eiger fixes the file name pattern and the image
+        numbering when it arms, so all the runs write to the same data
+        files: each run gets a resource document for these files and its
+        datums carry the image numbers of the whole series.  The detector
+        is disarmed and unstaged at the end.
+        """
+        self.setup_manual_trigger()
+        self.stage()
+        self._kept_armed = True
+        try:
+            yield self
+        finally:
+            self._kept_armed = False
+            self.unstage()
+
+    def _stage_run(self):
+        "Start a new run without disarming."
+        self._reset_counts()
 
     def setup_manual_trigger(self):
         # Stage signals
@@ -63,17 +121,102 @@ class LocalTrigger(TriggerBase):
         self.cam.stage_sigs["num_images"] = 1
         self.cam.stage_sigs["num_exposures"] = 1
         self.cam.stage_sigs["num_triggers"] = int(1e5)
+        self._images_per_trigger = 1
+        self._gated = False
+
+    def setup_batch_trigger(self, images_per_trigger, gated=False):
+        """
+        Take the images of several triggers at once
+
+        Call before staging; ``restore_trigger`` goes back to the trigger
+        (and cam stage_sigs) set up before.  The images of a press are
+        taken at the frame rate, so nothing may move between the triggers
+        of a batch unless it is gated.
+
+        args
+        ----
+        images_per_trigger  : int of images taken per trigger button press
+                              (e.g. the points of a step scan row); the
+                              first trigger of each batch presses it
+
+        kwargs
+        ------
+        gated = False       : one image per external gate (External
+                              Enable) instead, the button is never pressed.
+                              The gates must come from a source wired to
+                              the Eiger trigger input and driven by the
+                              scan; nothing here sets one up, without it
+                              every trigger times out
+        """
+        if self._staged != Staged.no:
+            raise RuntimeError(f"{self.name} is staged (or kept armed),"
+                               " set up the batch trigger before staging.")
+        if self._saved_trigger is None:
+            self._saved_trigger = (OrderedDict(self.cam.stage_sigs),
+                                   self._images_per_trigger, self._gated)
+        if gated:
+            self.cam.stage_sigs["trigger_mode"] = "External Enable"
+            self.cam.stage_sigs["manual_trigger"] = "Disable"
+            self.cam.stage_sigs["num_images"] = 1
+        else:
+            self.cam.stage_sigs["trigger_mode"] = "Internal Series"
+            self.cam.stage_sigs["manual_trigger"] = "Enable"
+            self.cam.stage_sigs["num_images"] = int(images_per_trigger)
+        self.cam.stage_sigs["num_exposures"] = 1
+        self.cam.stage_sigs["num_triggers"] = int(1e5)
+        self._images_per_trigger = 1 if gated else int(images_per_trigger)
+        self._gated = gated
+
+    def restore_trigger(self):
+        """
+        Undo ``setup_batch_trigger``, back to the previous trigger; while
+        staged (e.g. a plan closed before its unstage), done at unstage.
+        """
+        if self._saved_trigger is None:
+            return
+        if self._staged != Staged.no:
+            self._restore_at_unstage = True
+            return
+        self._restore_at_unstage = False
+        stage_sigs, self._images_per_trigger, self._gated = \
+            self._saved_trigger
+        self._saved_trigger = None
+        self.cam.stage_sigs.clear()
+        self.cam.stage_sigs.update(stage_sigs)
+
+    def _reset_counts(self):
+        with self._pending_lock:
+            self._images_triggered = 0
+            self._images_counted = 0
+            self._pending.clear()
 
     def stage(self):
+        if self._kept_armed:
+            self._stage_run()
+            return [self]
         # Make sure that detector is not armed.
-        set_and_wait(self.cam.acquire, 0)
+        apply_settings({self.cam.acquire: 0})
         super().stage()
         # The trigger button does not track that the detector is done, so
         # the image_count is used. Not clear it's the best choice.
-        self._image_count.subscribe(self._acquire_changed)
+        self._reset_counts()
+        self._image_count.subscribe(self._acquire_changed, run=False)
         set_and_wait(self.cam.acquire, 1)
 
     def unstage(self):
+        if self._kept_armed:
+            # stays armed (and its files staged) until keep_armed() ends
+            with self._pending_lock:
+                self._pending.clear()
+            self.file.end_run()
+            return [self]
+        try:
+            self._unstage_and_disarm()
+        finally:
+            if self._restore_at_unstage:
+                self.restore_trigger()
+
+    def _unstage_and_disarm(self):
         super().unstage()
         self._image_count.clear_sub(self._acquire_changed)
         set_and_wait(self.cam.acquire, 0)
@@ -99,25 +242,62 @@ class LocalTrigger(TriggerBase):
             raise RuntimeError("This detector is not ready to trigger."
                                "Call the stage() method before triggering.")
 
-        self._status = self._status_type(self)
-        self._acquisition_signal.put(1, wait=False)
+        if self._gated or self._images_per_trigger > 1:
+            # counted by _acquire_changed only, no progress subscription
+            status = DeviceStatus(self, timeout=self.batch_trigger_timeout)
+            if self._gated:
+                status.add_callback(self._gate_missed)
+        else:
+            status = self._status_type(self)
+        with self._pending_lock:
+            first = self._images_triggered % self._images_per_trigger == 0
+            self._images_triggered += 1
+            self._pending.append((self._images_triggered, status))
+        if first and not self._gated:
+            self._acquisition_signal.put(1, wait=False)
         self.dispatch(self._image_name, ttime())
-        return self._status
+        self._finish_counted()
+        return status
+
+    def _gate_missed(self, status):
+        if not status.success:
+            logger.warning(
+                "%s: no image within %s s of a gated trigger, is a gate"
+                " source driving the Eiger trigger input?", self.name,
+                self.batch_trigger_timeout)
 
     def _acquire_changed(self, value=None, old_value=None, **kwargs):
-        "This is called when the 'acquire' signal changes."
-        if self._status is None:
+        "This is called when the image counter changes."
+        if old_value is None or value <= old_value:
+            # reset when arming
             return
-        if value > old_value:  # There is a new image!
-            self._status.set_finished()
-            self._status = None
+        with self._pending_lock:
+            self._images_counted += value - old_value  # There are new images!
+        self._finish_counted()
+
+    def _finish_counted(self):
+        "Finish the statuses of all the images counted so far."
+        with self._pending_lock:
+            done = []
+            while self._pending and self._pending[0][0] <= self._images_counted:
+                done.append(self._pending.popleft()[1])
+        for status in done:
+            status.set_finished()
 
 
 # Based on NSLS2-CHX
 class EigerSimulatedFilePlugin(Device, FileStoreBase):
     """
     Using the filename from EPICS.
+
+    Datums number the images themselves (one per trigger, from 0 at
+    stage, continued by the runs of a detector kept armed); at the end of
+    each run the count is checked against num_images_counter in the
+    background, see ``image_count_reports``.
     """
+    # seconds for num_images_counter to reach the datum count at unstage
+    validate_timeout = 10
+
     seq_id = ADComponent(EpicsSignalRO, "SequenceId")
     file_path = ADComponent(EpicsSignalWithRBV, 'FilePath', string=True,
                             put_complete=True)
@@ -134,6 +314,14 @@ class EigerSimulatedFilePlugin(Device, FileStoreBase):
         super().__init__(*args, **kwargs)
         self.enable.subscribe(self._set_kind)
         self._base_name = None
+        # images of the earlier runs in the same files (kept armed)
+        self._image_offset = 0
+        # datums of the current run, None when not staged with files
+        self._image_num = None
+        self._resource_kwargs = None
+        self.image_count_status = None
+        # resource uid -> report of the image count check
+        self.image_count_reports = OrderedDict()
 
     def _set_kind(self, value, **kwargs):
         if value in (True, 1, "on", "enable"):
@@ -169,20 +357,86 @@ class EigerSimulatedFilePlugin(Device, FileStoreBase):
             self.file_path.put(write_path)
             self._fn = PurePath(read_path)
 
+            self._image_offset = 0
             self.parent.save_images_on()
             super().stage()
 
             ipf = int(self.file_write_images_per_file.get())
-            res_kwargs = {'images_per_file': ipf}
-            self._generate_resource(res_kwargs)
+            self._resource_kwargs = {'images_per_file': ipf}
+            self._generate_resource(self._resource_kwargs)
+            self._image_num = 0
+
+    @property
+    def image_count_report(self):
+        "Report of the last image count check, None before any."
+        if not self.image_count_reports:
+            return None
+        return next(reversed(self.image_count_reports.values()))
+
+    def end_run(self):
+        """
+        Check the images of a run of a detector kept armed, then start a
+        new resource, for the same files, for the next run; its image
+        numbers follow those of the earlier runs.
+        """
+        if not self._image_num:
+            # files not saved, or no image in this run
+            return
+        self.image_count_status = self._validate_image_count()
+        self._image_offset += self._image_num
+        self._asset_docs_cache.clear()
+        self._generate_resource(self._resource_kwargs)
+        self._image_num = 0
+
+    def unstage(self):
+        if self._image_num:
+            self.image_count_status = self._validate_image_count()
+        self._image_num = None
+        return super().unstage()
 
     def generate_datum(self, key, timestamp, datum_kwargs):
-        """Using the num_images_counter to pick image from scan."""
-        datum_kwargs.update({'image_num': self.num_images_counter.get()})
+        """One image per trigger, counted here (no PV read)."""
+        datum_kwargs.update({'image_num': self._image_offset + self._image_num})
+        self._image_num += 1
         return super().generate_datum(key, timestamp, datum_kwargs)
 
+    def _validate_image_count(self):
+        """
+        Compare the datums with num_images_counter once it has caught up
+
+        Returns the status at once; the result goes in
+        ``image_count_reports`` under the resource uid and a mismatch is
+        logged as a warning.
+        """
+        resource = str(self._fn)
+        resource_uid = self._resource_uid
+        datums = self._image_num
+        expected = self._image_offset + datums
+        last = {}
+
+        def caught_up(*, value, **kwargs):
+            last["value"] = value
+            return value >= expected
+
+        def report(status):
+            counted = last.get("value")
+            self.image_count_reports[resource_uid] = dict(
+                resource=resource, datums=datums, expected=expected,
+                counted=counted, ok=counted == expected,
+            )
+            if counted != expected:
+                logger.warning(
+                    "%s: %d datums but num_images_counter is %s (expected"
+                    " %d) for %s", self.name, datums, counted, expected,
+                    resource)
+
+        status = SubscriptionStatus(self.num_images_counter, caught_up,
+                                    timeout=self.validate_timeout)
+        status.add_callback(report)
+        return status
+
 
-class LocalEigerDetector(LocalTrigger, DetectorBase):
+class LocalEigerDetector(LocalTrigger, DetectorBase, DiffStagedDevice):
 
     _default_configuration_attrs = ('roi1', 'roi2', 'roi3', 'roi4')
     _default_read_attrs = ('cam', 'file', 'stats1', 'stats2', 'stats3',
@@ -316,14 +570,17 @@ class LocalEigerDetector(LocalTrigger, DetectorBase):
         )
 
     def default_settings(self):
-        self.cam.num_triggers.put(1)
-        self.cam.manual_trigger.put("Disable")
-        self.cam.trigger_mode.put("Internal Enable")
-        self.cam.acquire.put(0)
-        self.cam.wait_for_plugins.put("Yes")
-        self.cam.create_directory.put(-1)
-        self.cam.fw_compression.put("Enable")
-        self.cam.fw_num_images_per_file.put(100)
-        self.file.enable.put(True)  #what is this?
+        # Stop first, then write only the settings that differ, together.
+        apply_settings({self.cam.acquire: 0}, times=self.staging_times)
+        apply_settings({
+            self.cam.num_triggers: 1,
+            self.cam.manual_trigger: "Disable",
+            self.cam.trigger_mode: "Internal Enable",
+            self.cam.wait_for_plugins: "Yes",
+            self.cam.create_directory: -1,
+            self.cam.fw_compression: "Enable",
+            self.cam.fw_num_images_per_file: 100,
+            self.file.enable: True,  #what is this?
+        }, times=self.staging_times)
         self.setup_manual_trigger()
         #self.save_images_off()
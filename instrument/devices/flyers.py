@@ -4,10 +4,16 @@ Velociprobe fly scanning devices
 M. Wyman 2022-02-11
 """
 
-from ophyd import Device, EpicsSignal, EpicsSignalRO
+from ophyd import Device, EpicsSignal, EpicsSignalRO, Signal
 from ophyd import Component as Cpt
-from ophyd.status import DeviceStatus
+from ophyd import FormattedComponent as FCpt
+from ophyd.status import DeviceStatus, SubscriptionStatus
+from ophyd.areadetector.filestore_mixins import new_uid
 
+from .staging import DiffStagedDevice
+
+import numpy as np
+import os
 import time
 import logging
 
@@ -32,6 +38,9 @@ triggerFrequency = EpicsSignal('2iddVELO:VP:Trigger_Freq_Hz', name ="trigger_fre
 # PV suffixese for eiger
 pmac_mode_PV = 'Motion_Program' # generally set to 5 for snake scans
 pmac_trigger_PV = 'Calc_Motion_Cmd.PROC' # set to 1 to start
+# set to 1 to abort the program; not confirmed on every PMAC IOC, so it is
+# optional (not waited for by load_flyer, skipped when not connected)
+pmac_abort_PV = 'Abort_Motion_Cmd.PROC'
 pmac_wf_1000_PV = 'writeWF_1000.VAL'
 pmac_wf_1128_PV = 'writeWF_1128.VAL'
 
@@ -50,51 +59,151 @@ eiger_SaveFiles_PV = 'cam1:SaveFiles'
 eiger_FW_auto_rm_PV = 'cam1:FWAutoRemove'
 eiger_filepath_PV = 'cam1:FilePath'
 eiger_FW_pattern_PV = 'cam1:FWNamePattern'
-
-
-class PmacEigerFlyer(Device):
-
+eiger_num_images_counter_PV = 'cam1:NumImagesCounter_RBV'
+eiger_armed_PV = 'cam1:Armed'
+
+
+class FlyerPmac(Device):
+    """PMAC motion program PVs of the fly scans"""
+    start_program = Cpt(EpicsSignal, pmac_trigger_PV, kind="omitted",
+                        lazy=True)
+    mode = Cpt(EpicsSignal, pmac_mode_PV, kind="config", lazy=True)
+    wf_1000 = Cpt(EpicsSignal, pmac_wf_1000_PV, string=True, kind="config",
+                  lazy=True)
+    wf_1128 = Cpt(EpicsSignal, pmac_wf_1128_PV, string=True, kind="config",
+                  lazy=True)
+
+
+class FlyerEigerCam(Device):
+    """Eiger cam PVs used by the fly scans"""
+    acquire = Cpt(EpicsSignal, eiger_acquisition_PV, kind="omitted", lazy=True)
+    trigger_mode = Cpt(EpicsSignal, eiger_trigger_mode_PV, kind="config",
+                       lazy=True)
+    manual_trigger = Cpt(EpicsSignal, eiger_manual_trigger_PV, kind="config",
+                         lazy=True)
+    num_triggers = Cpt(EpicsSignal, eiger_num_triggers_PV, kind="config",
+                       lazy=True)
+    acquire_period = Cpt(EpicsSignal, eiger_acquire_period_PV, kind="config",
+                         lazy=True)
+    acquire_time = Cpt(EpicsSignal, eiger_acquire_time_PV, kind="config",
+                       lazy=True)
+    chi_start = Cpt(EpicsSignal, eiger_chi_start_PV, kind="config", lazy=True)
+    num_images = Cpt(EpicsSignal, eiger_num_images_PV, kind="config",
+                     lazy=True)
+    num_images_per_file = Cpt(EpicsSignal, eiger_num_images_per_file_PV,
+                              kind="config", lazy=True)
+    FW_enable = Cpt(EpicsSignal, eiger_FW_enable_PV, kind="config", lazy=True)
+    SaveFiles = Cpt(EpicsSignal, eiger_SaveFiles_PV, kind="config", lazy=True)
+    FW_auto_rm = Cpt(EpicsSignal, eiger_FW_auto_rm_PV, kind="config",
+                     lazy=True)
+    filepath = Cpt(EpicsSignal, eiger_filepath_PV, string=True, kind="config",
+                   lazy=True)
+    FW_pattern = Cpt(EpicsSignal, eiger_FW_pattern_PV, string=True,
+                     kind="config", lazy=True)
+    num_images_counter = Cpt(EpicsSignalRO, eiger_num_images_counter_PV,
+                             kind="normal", lazy=True)
+    armed = Cpt(EpicsSignalRO, eiger_armed_PV, kind="omitted", lazy=True)
+
+
+class VPScanCalc(Device):
+    """Velociprobe IOC fly scan geometry"""
+    scan_width = Cpt(EpicsSignal, 'ScanWidth.VAL', kind="config", lazy=True)
+    scan_height = Cpt(EpicsSignal, 'ScanHeight.VAL', kind="config", lazy=True)
+    x_center = Cpt(EpicsSignal, 'X_Center.VAL', kind="config", lazy=True)
+    y_center = Cpt(EpicsSignal, 'Y_Center.VAL', kind="config", lazy=True)
+    x_step_size = Cpt(EpicsSignal, 'X_Step_Size.VAL', kind="config", lazy=True)
+    y_step_size = Cpt(EpicsSignal, 'Y_Step_Size.VAL', kind="config", lazy=True)
+
+
+# flat names of the flyer signals (used by the plans) --> component
+_flat_signal_names = {
+    'scan_trigger': 'pmac.start_program',
+    'scan_mode': 'pmac.mode',
+    'scan_wf_1000': 'pmac.wf_1000',
+    'scan_wf_1128': 'pmac.wf_1128',
+    'cam_acquire': 'eiger.acquire',
+    'cam_trigger_mode': 'eiger.trigger_mode',
+    'cam_manual_trigger': 'eiger.manual_trigger',
+    'cam_num_triggers': 'eiger.num_triggers',
+    'cam_acquire_period': 'eiger.acquire_period',
+    'cam_acquire_time': 'eiger.acquire_time',
+    'cam_chi_start': 'eiger.chi_start',
+    'cam_num_images': 'eiger.num_images',
+    'cam_num_images_per_file': 'eiger.num_images_per_file',
+    'cam_FW_enable': 'eiger.FW_enable',
+    'cam_SaveFiles': 'eiger.SaveFiles',
+    'cam_FW_auto_rm': 'eiger.FW_auto_rm',
+    'cam_filepath': 'eiger.filepath',
+    'cam_FW_pattern': 'eiger.FW_pattern',
+    'cam_num_images_counter': 'eiger.num_images_counter',
+    'cam_armed': 'eiger.armed',
+    'scan_width': 'vp.scan_width',
+    'scan_height': 'vp.scan_height',
+    'x_center': 'vp.x_center',
+    'y_center': 'vp.y_center',
+    'x_step_size': 'vp.x_step_size',
+    'y_step_size': 'vp.y_step_size',
+}
+
+
+class PmacEigerFlyer(DiffStagedDevice):
+    """
+    PMAC driven fly scan with the Eiger
+
+    The PVs are lazily connected components of the ``pmac``, ``eiger`` and
+    ``vp`` sub-devices; ``wait_for_connection(all_signals=True)`` connects
+    them all in parallel (see ``load_flyer``).  The flat names used by
+    the plans (``cam_acquire``, ``scan_width``, ...) refer to the same
+    signals.  Staging writes only the ``stage_sigs`` that differ from the
+    current values (``staging_times`` has the seconds per written PV).
+    """
+
+    stream_name = "primary"
+    image_key = "eiger_image"
+    # Eiger file writer paths --> paths seen by bluesky (as in VPFlyScan2d)
+    eiger_write_root = "/local/home/dpuser/"
+    read_root = "/mnt/mic"
+    # open_positions() arguments of the PMAC position files
+    positions_format = dict(dtype=np.float64, columns=2)
+    # start of the first exposure after the start of the position record (s)
+    position_delay = 0.0
+    # seconds for the PMAC to report the motion program running
+    kickoff_timeout = 10.0
+    # seconds for the Eiger to report armed once the program runs
+    arm_timeout = 5.0
+    # most frames (events and datums) per collect
+    collect_block = 10000
+
+    monitor = FCpt(EpicsSignalRO, '{acro_pv}', kind="omitted", lazy=True)
+    pmac = FCpt(FlyerPmac, '{pmac_pv}')
+    eiger = FCpt(FlyerEigerCam, '{eiger_pv}')
+    vp = Cpt(VPScanCalc, '2iddVELO:VP:')
+
+    # PMAC start to Eiger arm (s), in the collect stream configuration
+    kickoff_latency = Cpt(Signal, value=0.0, kind="config")
 
     def __init__(self, pmac_pv, acro_pv, eiger_pv, *args, **kwargs  ):
+        # used by the formatted components
+        self.pmac_pv = pmac_pv
+        self.acro_pv = acro_pv
+        self.eiger_pv = eiger_pv
 
         super().__init__('', parent=None, **kwargs)
+        # optional, not a component: see pmac_abort_PV
+        self.scan_abort = EpicsSignal(f"{pmac_pv}{pmac_abort_PV}",
+                                      name=f"{self.name}_scan_abort")
         self.complete_status = None
-
-        self.monitor = EpicsSignalRO(acro_pv, name = "monitor")
-        
-        self.scan_trigger = EpicsSignal(pmac_pv+pmac_trigger_PV, name = "scan_trigger")
-        self.scan_mode = EpicsSignal(pmac_pv+pmac_mode_PV, name = "scan_mode")
-        self.scan_wf_1000 = EpicsSignal(pmac_pv+pmac_wf_1000_PV, name = 'scan_wf_1000')
-        self.scan_wf_1128 = EpicsSignal(pmac_pv+pmac_wf_1128_PV, name = 'scan_wf_1128')
-
-        self.cam_acquire = EpicsSignal(eiger_pv+eiger_acquisition_PV, name = "cam_acquire")
-        self.cam_trigger_mode = EpicsSignal(eiger_pv+eiger_trigger_mode_PV, name = "cam_trigger_mode")
-        self.cam_manual_trigger = EpicsSignal(eiger_pv+eiger_manual_trigger_PV, name = "cam_manual_trigger")
-        self.cam_num_triggers = EpicsSignal(eiger_pv+eiger_num_triggers_PV, name = "cam_num_triggers")
-        self.cam_acquire_period = EpicsSignal(eiger_pv+eiger_acquire_period_PV, name = 'cam_acquire_period')
-        self.cam_acquire_time = EpicsSignal(eiger_pv+eiger_acquire_time_PV, name = 'cam_acquire_time')
-        self.cam_chi_start = EpicsSignal(eiger_pv+eiger_chi_start_PV, name = 'cam_chi_start')
-        self.cam_num_images = EpicsSignal(eiger_pv+eiger_num_images_PV, name = 'cam_num_images')
-        self.cam_num_images_per_file = EpicsSignal(eiger_pv+eiger_num_images_per_file_PV, name = 'cam_num_images_per_file') 
-        self.cam_FW_enable = EpicsSignal(eiger_pv+eiger_FW_enable_PV, name = 'cam_FW_enable')
-        self.cam_SaveFiles = EpicsSignal(eiger_pv+eiger_SaveFiles_PV, name = 'cam_SaveFiles')
-        self.cam_FW_auto_rm = EpicsSignal(eiger_pv+eiger_FW_auto_rm_PV, name = 'cam_FW_auto_rm')
-        self.cam_filepath = EpicsSignal(eiger_pv+eiger_filepath_PV, name = 'cam_filepath')
-        self.cam_FW_pattern = EpicsSignal(eiger_pv+eiger_FW_pattern_PV, name = 'cam_FW_pattern')
-
-        self.scan_width = EpicsSignal('2iddVELO:VP:ScanWidth.VAL', name = 'scan_width')
-        self.scan_height = EpicsSignal('2iddVELO:VP:ScanHeight.VAL', name = 'scan_height')
-        self.x_center =  EpicsSignal('2iddVELO:VP:X_Center.VAL', name = 'x_center')
-        self.y_center = EpicsSignal('2iddVELO:VP:Y_Center.VAL', name = 'y_center')
-        self.x_step_size = EpicsSignal('2iddVELO:VP:X_Step_Size.VAL', name = 'x_step_size')
-        self.y_step_size = EpicsSignal('2iddVELO:VP:Y_Step_Size.VAL', name = 'y_step_size')
-
-        self.stage_sigs['cam_trigger_mode'] = 0
-        self.stage_sigs['cam_manual_trigger'] = 0
-        self.stage_sigs['cam_num_triggers'] = 1
-        self.stage_sigs['cam_FW_enable'] = 1 
-        self.stage_sigs['cam_SaveFiles'] = 1
-        self.stage_sigs['cam_FW_auto_rm'] = 1 
+        self._collect_info = None
+        self._position_samples = None
+        self.monitor_cb_index = None
+        self.pmac_start_time = None
+
+        self.stage_sigs['eiger.trigger_mode'] = 0
+        self.stage_sigs['eiger.manual_trigger'] = 0
+        self.stage_sigs['eiger.num_triggers'] = 1
+        self.stage_sigs['eiger.FW_enable'] = 1
+        self.stage_sigs['eiger.SaveFiles'] = 1
+        self.stage_sigs['eiger.FW_auto_rm'] = 1
 
     def stage(self):
         super().stage()
@@ -102,47 +211,99 @@ class PmacEigerFlyer(Device):
  
     def unstage(self):
         super().unstage()
+        self._position_samples = None
 
-        self.monitor.unsubscribe(self.monitor_cb_index)
+        if self.monitor_cb_index is not None:
+            self.monitor.unsubscribe(self.monitor_cb_index)
+            self.monitor_cb_index = None
 
         print('Flyer unstaged.')
 
 
     def kickoff(self):
-            """
-            Start this Flyer
-            """
-#           logger.info("kickoff()")
-            self.complete_status = DeviceStatus(self)
-
-            self.start_time = time.time()
-
-            #trigger system
-            #self.busy.put(BusyStatus.busy) -- from example
-            #send trigger to start_program
-            self.scan_trigger.put(1)
-            while(self.monitor.get() != 1):
-                print("waiting for pmac to begin", end="\r")
-                time.sleep(0.01)
-            print("\nPMAC has started---------")
+        """
+        Start this Flyer
 
-            #send trigger to camera
-            self.cam_acquire.put(1)
+        Starts the PMAC motion program and returns a status that finishes
+        once the PMAC monitor reports the program running (within
+        ``kickoff_timeout`` seconds) and then the Eiger reports armed
+        (within ``arm_timeout`` seconds).  If either does not happen the
+        motion program is aborted (when its abort PV is connected), the
+        acquisition stopped and the status fails.  The PMAC start to Eiger armed latency is kept in
+        ``kickoff_latency``.
+        """
+        logger.info("kickoff()")
+        self.complete_status = DeviceStatus(self)
+        self._collect_info = None
+        kickoff_status = DeviceStatus(self)
+
+        def abort(reason):
+            logger.error("fly scan kickoff failed, aborting: %s", reason)
+            try:
+                try:
+                    if self.scan_abort.connected:
+                        self.scan_abort.put(1)
+                    else:
+                        logger.warning("%s not connected, PMAC motion program"
+                                       " not aborted", self.scan_abort.pvname)
+                finally:
+                    self.cam_acquire.put(0)
+            finally:
+                # whatever the puts do, the kickoff must not hang
+                kickoff_status.set_exception(TimeoutError(reason))
+
+        def pmac_running(*, value, **kwargs):
+            if value == 1:
+                self.pmac_start_time = time.time()
+                return True
+            return False
+
+        def eiger_armed(*, value, **kwargs):
+            if value == 1:
+                self.start_time = time.time()
+                return True
+            return False
+
+        def armed(status):
+            if not status.success:
+                abort(f"Eiger not armed within {self.arm_timeout} s of the"
+                      f" PMAC start ({status.exception()})")
+                return
+            latency = self.start_time - self.pmac_start_time
+            self.kickoff_latency.put(latency)
+            logger.info("PMAC started, Eiger armed after %.3f s", latency)
 
             #add callback functions to set complete after fly scan trajectory
             #and detector acquisition complete
             def cb(*args, **kwargs):
-                    if not self.monitor.get(): #and self.cam_acquire.get():
-                        self.complete_status._finished(success=True)
-                        self.cam_acquire.put(0)
+                if not self.monitor.get(): #and self.cam_acquire.get():
+                    self.complete_status._finished(success=True)
+                    self.cam_acquire.put(0)
 
             self.monitor_cb_index = self.monitor.subscribe(cb)
-#            self.cam_acquire.subscribe(cb)
+            kickoff_status.set_finished()
+
+        def arm(status):
+            if not status.success:
+                abort(f"PMAC motion program did not start within"
+                      f" {self.kickoff_timeout} s ({status.exception()})")
+                return
+            # subscribe before the trigger so the arm can't be missed
+            eiger_armed_status = SubscriptionStatus(
+                self.cam_armed, eiger_armed, timeout=self.arm_timeout,
+                run=False)
+            #send trigger to camera
+            self.cam_acquire.put(1)
+            eiger_armed_status.add_callback(armed)
 
-            # set kickoff status to done
-            kickoff_status = DeviceStatus(self)
-            kickoff_status._finished(success=True)
-            return kickoff_status
+        # subscribe before the trigger so the PMAC start can't be missed
+        pmac_started = SubscriptionStatus(self.monitor, pmac_running,
+                                          timeout=self.kickoff_timeout,
+                                          run=False)
+        pmac_started.add_callback(arm)
+        #send trigger to start_program
+        self.scan_trigger.put(1)
+        return kickoff_status
 
     def complete(self):
         """
@@ -151,54 +312,155 @@ class PmacEigerFlyer(Device):
         logger.info("complete(): " + str(self.complete_status))
         return self.complete_status
 
+    def _image_path(self):
+        """Bluesky-side directory and file prefix of the Eiger data files."""
+        directory = self.cam_filepath.get()
+        if directory.startswith(self.eiger_write_root):
+            directory = self.read_root + directory[len(self.eiger_write_root):]
+        return directory, self.cam_FW_pattern.get()
+
+    def position_file(self):
+        """Interferometer position file written by the PMAC."""
+        return os.path.join(self.scan_wf_1000.get(), self.scan_wf_1128.get())
+
+    def _prepare_collect(self):
+        """Frames acquired and their collect blocks, computed once per scan."""
+        if self._collect_info is None:
+            num_frames = int(self.cam_num_images_counter.get())
+            ipf = int(self.cam_num_images_per_file.get())
+            root, prefix = self._image_path()
+            # blocks of at most collect_block frames, within one data file
+            blocks = []
+            for file_first in range(0, num_frames, ipf):
+                file_last = min(file_first + ipf, num_frames)
+                blocks += [(first, min(first + self.collect_block, file_last))
+                           for first in range(file_first, file_last,
+                                              self.collect_block)]
+            self._collect_info = dict(
+                num_frames=num_frames,
+                images_per_file=ipf,
+                root=root,
+                prefix=prefix,
+                blocks=blocks,
+                next_block=0,
+                resource_uid=None,
+            )
+        return self._collect_info
+
+    @property
+    def collect_done(self):
+        """True once every block of the scan has been collected."""
+        info = self._collect_info
+        return info is not None and info["next_block"] >= len(info["blocks"])
+
+    def collect_asset_docs(self):
+        """
+        Documents of the next collect block: the resource of its data file
+        (with the file's first block) and the datum of each of its frames
+        """
+        info = self._prepare_collect()
+        if self.collect_done:
+            return
+        first, last = info["blocks"][info["next_block"]]
+        ipf = info["images_per_file"]
+        if first % ipf == 0:
+            info["resource_uid"] = new_uid()
+            yield "resource", dict(
+                spec="AD_EIGER",
+                root=info["root"],
+                resource_path=info["prefix"],
+                resource_kwargs={"images_per_file": ipf},
+                path_semantics="posix",
+                uid=info["resource_uid"],
+            )
+        # the RunEngine accepts datum documents, not datum pages
+        uid = info["resource_uid"]
+        for i in range(first, last):
+            yield "datum", dict(resource=uid, datum_id=f"{uid}/{i}",
+                                datum_kwargs={"image_num": i})
+
     def describe_collect(self):
         """
         Describe details for ``collect()`` method
         """
         logger.info("describe_collect()")
-        return {
-            self.name: dict(
-                ifly_xArr = dict(
-                    source = self.positions.pvname,
-                    dtype = "number",
-                    shape = (1,)
-                ),
-                ifly_tArr = dict(
-                    source = self.times.pvname,
-                    dtype = "number",
-                    shape = (1,)
-                )
-            )
+        eiger_source = "PV:" + self.cam_acquire.pvname.rsplit("cam1:", 1)[0]
+        positions_source = "FILE:" + self.position_file()
+        data_keys = {
+            self.image_key: dict(source=eiger_source, dtype="array",
+                                 shape=[], external="FILESTORE:"),
+            "image_num": dict(source=eiger_source, dtype="integer", shape=[]),
         }
-
-    def collect(self):
+        for axis in ("x", "y"):
+            for suffix in ("", "_jitter"):
+                data_keys[f"{axis}{suffix}"] = dict(
+                    source=positions_source, dtype="number", shape=[])
+        data_keys["position_samples"] = dict(source=positions_source,
+                                             dtype="integer", shape=[])
+        return {self.stream_name: data_keys}
+
+    def _positions(self, starts, stops):
+        """Mean position and jitter per frame window (NaN if unavailable)."""
+        from ..utils.fly_positions import align_positions, open_positions
+
+        if self._position_samples is None:
+            path = self.position_file()
+            try:
+                self._position_samples = open_positions(
+                    path, **self.positions_format)
+            except (OSError, ValueError) as exc:
+                logger.warning("no fly scan positions from %s: %s", path, exc)
+                self._position_samples = False
+        if self._position_samples is False:
+            nan = np.full((len(starts), 2), np.nan)
+            return dict(mean=nan, std=nan, count=np.zeros(len(starts), int))
+        return align_positions(self._position_samples, starts, stops,
+                               sample_rate=laserFrequency.get())
+
+    def collect_pages(self):
         """
-        Start this Flyer
+        Yield the event page of the next collect block (at most
+        ``collect_block`` frames of one data file): image datum, image
+        number, mean x/y position, x/y jitter and number of position
+        samples of every frame, time stamped at the frame start.  Call
+        ``collect`` until ``collect_done`` (see ``staged_fly``).
         """
-        print("Storing data")
-        logger.info("collect(): " + str(self.complete_status))
-        
-        self.end_time = time.time()
-        
-        self.cam_acquire.put(0)
-        self.complete_status = None
-        # only data being stored is start and end times of each flyscan
-        t = [0,self.end_time-self.start_time]
-        x = [0,self.cam_num_images.value]
-        
-        for i in range(2):
-            d = dict(
-                time=self.start_time + t[i],
-                data=dict(
-                    ifly_tArr = t[i],
-                    ifly_xArr = x[i],
-                ),
-                timestamps=dict(
-                    ifly_tArr = t[i],
-                    ifly_xArr = t[i],
-                )
-            )
-            yield d
-
-
-
+        info = self._prepare_collect()
+        if info["next_block"] == 0:
+            logger.info("collect_pages(): " + str(self.complete_status))
+            self.end_time = time.time()
+            self.cam_acquire.put(0)
+            self.complete_status = None
+            print(f"Storing data: {info['num_frames']} frames")
+        if self.collect_done:
+            return
+
+        first, last = info["blocks"][info["next_block"]]
+        period = self.cam_acquire_period.get()
+        exposure = self.cam_acquire_time.get()
+        frames = np.arange(first, last)
+        # frame windows relative to the start of the position record
+        starts = self.position_delay + frames * period
+        positions = self._positions(starts, starts + exposure)
+        times = (self.start_time + frames * period).tolist()
+        data = {
+            self.image_key: [f"{info['resource_uid']}/{i}" for i in frames],
+            "image_num": frames.tolist(),
+            "x": positions["mean"][:, 0].tolist(),
+            "y": positions["mean"][:, 1].tolist(),
+            "x_jitter": positions["std"][:, 0].tolist(),
+            "y_jitter": positions["std"][:, 1].tolist(),
+            "position_samples": positions["count"].tolist(),
+        }
+        info["next_block"] += 1
+        if self.collect_done:
+            # release the memory map of the position file
+            self._position_samples = None
+        yield dict(data=data, timestamps={key: times for key in data})
+
+
+for _name, _path in _flat_signal_names.items():
+    setattr(PmacEigerFlyer, _name,
+            property(lambda self, _path=_path: getattr(self, _path),
+                     doc=f"same as ``{_path}``"))
+del _name, _path
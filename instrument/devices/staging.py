@@ -0,0 +1,178 @@
+"""
+Diff-only staging
+
+``Device.stage`` writes every ``stage_sigs`` entry one after the other and
+waits for each readback, even when the IOC already holds the value.  Here
+the current values come from the channel access monitors, only the
+signals that differ are written, all at once, and staging waits on the
+combined status.  The seconds each write took are kept in
+``staging_times`` (signal name -> s) to show which PVs dominate.
+"""
+
+__all__ = """
+    apply_settings
+    DiffStagedDevice
+""".split()
+
+from ..session_logs import logger
+
+logger.info(__file__)
+
+from collections import OrderedDict
+import time
+
+from ophyd import Device, Staged
+from ophyd.device import RedundantStaging
+from ophyd.signal import EpicsSignalBase
+from ophyd.utils.epics_pvs import _compare_maybe_enum
+
+
+def _current_value(signal):
+    """Value of the signal, from its monitor when it has one."""
+    if isinstance(signal, EpicsSignalBase):
+        return signal.get(use_monitor=True)
+    return signal.get()
+
+
+def _matches(signal, value, current):
+    """True when the signal already holds value (enum aware)."""
+    try:
+        return _compare_maybe_enum(
+            current, value,
+            getattr(signal, "enum_strs", None),
+            getattr(signal, "tolerance", None),
+            getattr(signal, "rtolerance", None),
+        )
+    except (IndexError, TypeError, ValueError):
+        return False
+
+
+def apply_settings(settings, timeout=10, times=None, original=None):
+    """
+    Write the settings that differ from the current values, concurrently
+
+    args
+    ----
+    settings            : mapping of signal -> value
+
+    kwargs
+    ------
+    timeout = 10        : float (s) allowed for each readback to match
+    times = None        : dict updated with signal name -> s of each write
+    original = None     : dict updated with signal -> previous value of each
+                          written signal, before waiting (so a failed
+                          write can still be undone)
+
+    returns
+    -------
+    dict of signal -> previous value of the written signals
+    """
+    original = OrderedDict() if original is None else original
+    statuses = []
+    for signal, value in settings.items():
+        current = _current_value(signal)
+        if _matches(signal, value, current):
+            logger.debug("%s is already %r, not written", signal.name, value)
+            continue
+        logger.debug("Setting %s to %r (was %r)", signal.name, value, current)
+        original[signal] = current
+        t0 = time.monotonic()
+        status = signal.set(value, timeout=timeout)
+        if times is not None:
+            status.add_callback(
+                lambda st, name=signal.name, t0=t0:
+                    times.__setitem__(name, time.monotonic() - t0))
+        statuses.append(status)
+
+    if statuses:
+        combined = statuses[0]
+        for status in statuses[1:]:
+            combined = combined & status
+        combined.wait()
+    return original
+
+
+class DiffStagedDevice(Device):
+    """
+    Device staging its ``stage_sigs`` diff-only and concurrently
+
+    Put it last in the bases (``class Cam(EigerDetectorCam,
+    DiffStagedDevice)``) so it takes the place of ``Device.stage`` and
+    ``Device.unstage`` under the stage methods of the other classes.
+    Unstaging restores only the signals that staging wrote.
+    """
+
+    # seconds allowed for each readback to match
+    staging_timeout = 10
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.staging_times = OrderedDict()
+
+    def stage(self):
+        if self._staged != Staged.no:
+            raise RedundantStaging(
+                f"Device {self!r} is (partially) staged. Unstage it first.")
+        self.log.debug("Staging %s", self.name)
+        self._staged = Staged.partially
+
+        # Resolve any stage_sigs keys given as strings: 'a.b' -> self.a.b
+        stage_sigs = OrderedDict(
+            (getattr(self, k) if isinstance(k, str) else k, v)
+            for k, v in self.stage_sigs.items()
+        )
+        self.staging_times.clear()
+        t0 = time.monotonic()
+        devices_staged = []
+        try:
+            apply_settings(stage_sigs, timeout=self.staging_timeout,
+                           times=self.staging_times,
+                           original=self._original_vals)
+            devices_staged.append(self)
+
+            for attr in self._sub_devices:
+                device = getattr(self, attr)
+                if hasattr(device, "stage"):
+                    device.stage()
+                    devices_staged.append(device)
+        except Exception:
+            self.log.debug("Staging %s failed, restoring the original"
+                           " settings", self.name)
+            self.unstage()
+            raise
+        else:
+            self._staged = Staged.yes
+
+        if stage_sigs:
+            self._log_staging(len(stage_sigs), time.monotonic() - t0)
+        return devices_staged
+
+    def unstage(self):
+        self.log.debug("Unstaging %s", self.name)
+        self._staged = Staged.partially
+        devices_unstaged = []
+
+        for attr in self._sub_devices[::-1]:
+            device = getattr(self, attr)
+            if hasattr(device, "unstage"):
+                device.unstage()
+                devices_unstaged.append(device)
+
+        # Restore the written signals, kept until all have been restored
+        apply_settings(
+            OrderedDict(reversed(list(self._original_vals.items()))),
+            timeout=self.staging_timeout,
+        )
+        self._original_vals.clear()
+        devices_unstaged.append(self)
+
+        self._staged = Staged.no
+        return devices_unstaged
+
+    def _log_staging(self, num_signals, elapsed):
+        slowest = sorted(self.staging_times.items(), key=lambda kv: -kv[1])
+        logger.info(
+            "%s staged in %.3f s: %d of %d signals written%s",
+            self.name, elapsed, len(self.staging_times), num_signals,
+            "".join(f", {name} {dt:.3f} s" for name, dt in slowest[:3]),
+        )
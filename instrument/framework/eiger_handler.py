@@ -1,16 +1,279 @@
 """
 Modified Eiger handler -> APS seems to use a different file naming.
 """
-from os.path import getsize
-from glob import glob
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from pathlib import Path
+import os
+import threading
 import dask.array
 import h5py
+import numpy as np
 from area_detector_handlers.eiger import EigerHandler
+from .eiger_index import EigerRunIndex
+
+try:
+    import bitshuffle
+except ImportError:
+    bitshuffle = None
+
+MB = 1024 * 1024
+
+# HDF5 filter written by the Eiger file writer (fw_compression)
+BSHUF_FILTER_ID = 32008
+BSHUF_LZ4 = 2
+
+
+def direct_chunk_codec(ds):
+    '''
+    How chunks of ``ds`` can be decoded without the HDF5 filter pipeline:
+    'raw' (no filter), 'bslz4' (bitshuffle/LZ4) or None (not supported:
+    chunks not made of whole frames, or the bitshuffle module is not
+    available).
+    '''
+    if ds.chunks is None or ds.chunks[1:] != ds.shape[1:]:
+        return None
+    plist = ds.id.get_create_plist()
+    nfilters = plist.get_nfilters()
+    if nfilters == 0:
+        return 'raw'
+    if nfilters == 1 and bitshuffle is not None:
+        code, _, values, _ = plist.get_filter(0)
+        if (code == BSHUF_FILTER_ID and len(values) > 4 and
+                values[4] == BSHUF_LZ4):
+            return 'bslz4'
+    return None
+
+
+def decode_chunk(codec, filter_mask, buf, shape, dtype):
+    '''
+    Decode one chunk read with ``read_direct_chunk``.
+    '''
+    if codec == 'raw' or filter_mask & 1:
+        return np.frombuffer(buf, dtype=dtype).reshape(shape)
+    # bitshuffle HDF5 header: uint64 BE bytes, uint32 BE block bytes
+    block_size = int.from_bytes(buf[8:12], 'big') // dtype.itemsize
+    return bitshuffle.decompress_lz4(
+        np.frombuffer(buf, dtype=np.uint8, offset=12), shape, dtype,
+        block_size
+    )
+
+
+class H5FilePool:
+    '''
+    Bounded, thread-safe LRU pool of open (read only) HDF5 files.
+
+    Least recently used files are closed when more than ``max_open_files``
+    are open or their estimated memory (HDF5 metadata cache plus raw
+    chunk cache) exceeds ``max_memory`` bytes.  Files in use (inside
+    ``open()``) are never closed, their eviction is deferred until
+    released.
+    '''
+
+    def __init__(self, max_open_files=64, max_memory=256 * MB):
+        self.max_open_files = max_open_files
+        self.max_memory = max_memory
+        self._files = OrderedDict()
+        self._memory = {}
+        self._in_use = {}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _estimate_memory(file):
+        metadata = file.id.get_mdc_size()[2]
+        chunk_cache = file.id.get_access_plist().get_cache()[2]
+        return metadata + chunk_cache
+
+    @contextmanager
+    def open(self, path):
+        '''
+        Context manager giving the open ``h5py.File`` for ``path``.
+        '''
+        path = Path(path)
+        with self._lock:
+            file = self._files.get(path)
+            if file is not None:
+                self.hits += 1
+                self._files.move_to_end(path)
+            else:
+                self.misses += 1
+                file = h5py.File(path, 'r')
+                self._files[path] = file
+                self._memory[path] = self._estimate_memory(file)
+            self._in_use[path] = self._in_use.get(path, 0) + 1
+            self._evict()
+        try:
+            yield file
+        finally:
+            with self._lock:
+                self._in_use[path] -= 1
+                if not self._in_use[path]:
+                    del self._in_use[path]
+                if path in self._files:
+                    self._memory[path] = self._estimate_memory(file)
+                self._evict()
+
+    def _evict(self):
+        for path in list(self._files):
+            if (len(self._files) <= self.max_open_files and
+                    sum(self._memory.values()) <= self.max_memory):
+                return
+            if path in self._in_use:
+                continue
+            self._close(path)
+            self.evictions += 1
+
+    def _close(self, path):
+        self._files.pop(path).close()
+        self._memory.pop(path, None)
+
+    def close(self, path=None):
+        '''
+        Close ``path`` (or all files when None) unless in use.
+        '''
+        with self._lock:
+            paths = list(self._files) if path is None else [Path(path)]
+            for p in paths:
+                if p in self._files and p not in self._in_use:
+                    self._close(p)
+
+    @property
+    def stats(self):
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                open_files=len(self._files),
+                memory=sum(self._memory.values()),
+            )
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.stats})'
+
+
+# shared by all the handler instances
+eiger_file_pool = H5FilePool()
+
+
+class PooledDataset:
+    '''
+    Array-like view of an HDF5 dataset that gets its file from a pool at
+    every read, so dask arrays built on it survive file eviction.
+    '''
+
+    def __init__(self, pool, path, data_path):
+        self._pool = pool
+        self._path = path
+        self._data_path = data_path
+        with pool.open(path) as file:
+            ds = file[data_path]
+            self.shape = ds.shape
+            self.dtype = ds.dtype
+            self.chunks = ds.chunks
+        self.ndim = len(self.shape)
+
+    def __getitem__(self, key):
+        with self._pool.open(self._path) as file:
+            return file[self._data_path][key]
 
 
 class MyEigerHandler(EigerHandler):
 
+    DATA_PATH = 'entry/data/data'
+    file_pool = eiger_file_pool
+    # 'hdf5': h5py filter pipeline; 'direct': direct chunk reads
+    # decompressed in a thread pool (falls back to 'hdf5' when the data
+    # is not bitshuffle/LZ4 or the bitshuffle module is missing)
+    default_reader = 'hdf5'
+    # boolean (H, W) mask, True for good pixels, bad pixels read as 0
+    # (see eiger_mask.mask_for_run)
+    default_mask = None
+
+    def __init__(self, fpath, images_per_file=None, frame_per_point=None,
+                 reader=None, num_threads=None, mask=None):
+        super().__init__(fpath, images_per_file=images_per_file,
+                         frame_per_point=frame_per_point)
+        self._dask_arrays = {}
+        self._paths = set()
+        self.reader = reader or self.default_reader
+        self.num_threads = num_threads or os.cpu_count()
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._index = None
+        self.mask = self.default_mask if mask is None else mask
+
+    @property
+    def mask(self):
+        '''
+        Boolean (H, W) pixel mask applied to the frames as they are read,
+        True for good pixels; None for no masking.
+        '''
+        return self._mask
+
+    @mask.setter
+    def mask(self, mask):
+        self._mask = None if mask is None else np.asarray(mask, dtype=bool)
+        self._bad_pixels = (None if mask is None else
+                            np.flatnonzero(~self._mask.ravel()))
+        self._dask_arrays.clear()
+
+    def _mask_frames(self, frames):
+        '''
+        Zero the bad pixels of a C-contiguous (n, H, W) array in place.
+        '''
+        if self._bad_pixels is not None and len(self._bad_pixels):
+            frames.reshape(len(frames), -1)[:, self._bad_pixels] = 0
+        return frames
+
+    @property
+    def index(self):
+        '''
+        Image-to-file index of the run, loaded from (or written to) the
+        user's index cache and updated with new data files.
+        '''
+        if self._index is None:
+            self._index = EigerRunIndex(self._file_prefix,
+                                        self._images_per_file,
+                                        self.DATA_PATH)
+        else:
+            self._index.update()
+        return self._index
+
+    def _file_path(self, file_index):
+        '''
+        Path of the data file number ``file_index`` (starts at 1).
+        '''
+        return Path(
+            f'{self._file_prefix}_data_{file_index:06d}.h5'
+        ).absolute()
+
+    def _open(self, fpath):
+        '''
+        Context manager giving the data file ``fpath`` from the file pool.
+        '''
+        self._paths.add(fpath)
+        return self.file_pool.open(fpath)
+
+    def _dask_array(self, fpath):
+        '''
+        One dask array per data file, chunked like the HDF5 dataset.
+        '''
+        try:
+            return self._dask_arrays[fpath]
+        except KeyError:
+            self._paths.add(fpath)
+            ds = PooledDataset(self.file_pool, fpath, self.DATA_PATH)
+            da = dask.array.from_array(ds, chunks=ds.chunks or 'auto')
+            if self._bad_pixels is not None:
+                da = da.map_blocks(self._mask_frames, dtype=da.dtype)
+            self._dask_arrays[fpath] = da
+            return da
+
     def __call__(self, image_num):
         '''
         This returns data contained in the file.
@@ -24,37 +287,291 @@ class MyEigerHandler(EigerHandler):
             A dask array
         '''
 
-        fpath = Path(
-            f'{self._file_prefix}_data_'
-            f'{1 + (image_num // self._images_per_file):06d}.h5'
-        ).absolute()
+        fpath = self._file_path(1 + (image_num // self._images_per_file))
+        da = self._dask_array(fpath)[image_num % self._images_per_file]
+
+        return da.reshape((1,) + da.shape)
+
+    def _read_run(self, ds, local, positions, out):
+        '''
+        Read the frames ``local`` (sorted, within one stored-chunk span) of
+        dataset ``ds`` into ``out[positions]`` with a single HDF5 read.
+        '''
+        lo, hi = int(local[0]), int(local[-1]) + 1
+        contiguous = (hi - lo == len(local) and
+                      np.all(np.diff(positions) == 1))
+        if contiguous:
+            p0 = int(positions[0])
+            ds.read_direct(out, np.s_[lo:hi], np.s_[p0:p0 + hi - lo])
+            self._mask_frames(out[p0:p0 + hi - lo])
+        else:
+            block = ds[lo:hi]
+            out[positions] = self._mask_frames(block[local - lo])
+
+    def _runs(self, ds, local):
+        '''
+        Split sorted frame indices into runs that touch consecutive
+        stored chunks, so every chunk is read (and decompressed) once.
+        '''
+        frames_per_chunk = ds.chunks[0] if ds.chunks else len(local) or 1
+        chunk_ids = local // frames_per_chunk
+        breaks = np.flatnonzero(np.diff(chunk_ids) > 1) + 1
+        return np.split(np.arange(len(local)), breaks)
+
+    def _read_direct(self, ds, codec, local, positions, out, futures,
+                      chunks=None, fd=None):
+        '''
+        Read the stored chunks holding frames ``local`` and queue their
+        decompression into ``out[positions]`` on the thread pool.  With
+        the chunk table of the run index (``chunks``, see
+        EigerRunIndex.file_chunks, and ``fd`` of the data file) the chunks
+        are read on the pool threads too, without HDF5.
+        '''
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.num_threads)
 
+        # the decode runs after the file is released (and maybe closed by
+        # the pool): nothing of ds may be used in it
+        chunk_shape = ds.chunks
+        dtype = ds.dtype
+        frames_per_chunk = chunk_shape[0]
+        chunk_ids = local // frames_per_chunk
+        starts = np.flatnonzero(np.diff(chunk_ids)) + 1
+        groups = np.split(np.arange(len(local)), starts)
+        firsts = chunk_ids[[idx[0] for idx in groups]] * frames_per_chunk
+
+        rows = None
+        if chunks is not None:
+            rows = np.searchsorted(chunks[0], firsts)
+            if (rows >= len(chunks[0])).any() or \
+                    (chunks[0][np.minimum(rows, len(chunks[0]) - 1)]
+                     != firsts).any():
+                # index older than the file: through HDF5
+                rows = None
+
+        for n, (idx, first) in enumerate(zip(groups, firsts.tolist())):
+            if rows is None:
+                offset = (first,) + (0,) * (ds.ndim - 1)
+                filter_mask, buf = ds.id.read_direct_chunk(offset)
+                where = None
+            else:
+                row = rows[n]
+                filter_mask = int(chunks[3][row])
+                buf = None
+                where = (int(chunks[2][row]), int(chunks[1][row]))
+
+            def decode(buf=buf, where=where, filter_mask=filter_mask,
+                       idx=idx, first=first):
+                if buf is None:
+                    buf = os.pread(fd, *where)
+                chunk = decode_chunk(codec, filter_mask, buf, chunk_shape,
+                                     dtype)
+                out[positions[idx]] = self._mask_frames(chunk[local[idx] - first])
+
+            futures.append(self._executor.submit(decode))
+
+    def get_images(self, image_nums):
+        '''
+        Bulk read of many images.
+
+        Requests are grouped by data file and read in contiguous,
+        chunk-aligned ranges, one HDF5 call per range.
+
+        Parameters
+        ----------
+        image_nums range, list or array of int
+            Image numbers as read from eiger.cam.num_images_counter
+        Returns
+        -------
+            A numpy array of shape (len(image_nums), H, W), in the
+            requested order
+        '''
+        image_nums = np.asarray(image_nums, dtype=int).ravel()
+
+        order = np.argsort(image_nums, kind='stable')
+        sorted_nums = image_nums[order]
+        file_index = 1 + sorted_nums // self._images_per_file
+        local_index = sorted_nums % self._images_per_file
+
+        out = None
+        futures = []
+        fds = []
+        # chunk tables of the direct reader
+        index = self.index if self.reader == 'direct' else None
+        starts = np.flatnonzero(np.diff(file_index)) + 1
         try:
-            file = self._files[fpath]
-        except KeyError:
-            file = h5py.File(fpath, 'r')
-            self._files[fpath] = file
+            for group in np.split(np.arange(len(sorted_nums)), starts):
+                if not len(group):
+                    continue
+                fpath = self._file_path(int(file_index[group[0]]))
+                with self._open(fpath) as file:
+                    ds = file[self.DATA_PATH]
+                    if out is None:
+                        out = np.empty((len(image_nums),) + ds.shape[1:],
+                                       dtype=ds.dtype)
+                    local = local_index[group]
+                    if local[-1] >= len(ds):
+                        raise IndexError(
+                            f'image {int(sorted_nums[group[-1]])} is not in'
+                            f' {fpath} ({len(ds)} images)')
+                    codec = None
+                    if self.reader == 'direct':
+                        codec = direct_chunk_codec(ds)
+                    if codec is not None:
+                        chunks = index.file_chunks(int(file_index[group[0]]))
+                        fd = None
+                        if chunks is not None:
+                            fd = os.open(fpath, os.O_RDONLY)
+                            fds.append(fd)
+                        self._read_direct(ds, codec, local, order[group], out,
+                                          futures, chunks, fd)
+                        continue
+                    for run in self._runs(ds, local):
+                        self._read_run(ds, local[run], order[group[run]], out)
+        finally:
+            # the queued reads use the file descriptors until done
+            done = wait(futures).done
+            for fd in fds:
+                os.close(fd)
+        for future in done:
+            future.result()
 
-        da = dask.array.from_array(file['entry/data/data'])[
-            image_num % self._images_per_file
-        ]
+        if out is None:
+            # no image requested: empty stack of the run's frame shape
+            with self._open(self._file_path(1)) as file:
+                ds = file[self.DATA_PATH]
+                out = np.empty((0,) + ds.shape[1:], dtype=ds.dtype)
+        return out
 
-        return da.reshape((1,) + da.shape)
+    def close(self):
+        '''
+        Close the data files opened by this handler.
+        '''
+        for fpath in self._paths:
+            self.file_pool.close(fpath)
+        self._paths.clear()
+        self._dask_arrays.clear()
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+    def num_images(self):
+        '''
+        Number of images written, from the run index.
+        '''
+        return self.index.num_images
+
+    def iter_batches(self, start=0, stop=None, batch_size=None, prefetch=4,
+                     max_memory=512 * MB):
+        '''
+        Iterate over the images in acquisition order, in batches read by
+        a background thread so I/O overlaps with processing.
+
+        Parameters
+        ----------
+        start int
+            First image number
+        stop int or None
+            One past the last image number, None for all images on disk
+        batch_size int or None
+            Images per batch (batches never straddle data files),
+            defaults to min(images_per_file, 100)
+        prefetch int
+            Maximum number of batches read ahead
+        max_memory int
+            Maximum bytes of batches read ahead (at least one batch is
+            always read)
+        Yields
+        ------
+            (first image number, numpy array (n, H, W))
+        '''
+        if stop is None:
+            stop = self.num_images()
+        if batch_size is None:
+            batch_size = min(self._images_per_file, 100)
+
+        ipf = self._images_per_file
+        ranges = []
+        first = start
+        while first < stop:
+            last = min(first + batch_size, stop, (first // ipf + 1) * ipf)
+            ranges.append((first, last))
+            first = last
+
+        queue = deque()
+        queued = [0]
+        done = threading.Event()
+        cond = threading.Condition()
+
+        def producer():
+            try:
+                for first, last in ranges:
+                    with cond:
+                        while not done.is_set() and queue and (
+                                len(queue) >= prefetch or
+                                queued[0] >= max_memory):
+                            cond.wait()
+                    if done.is_set():
+                        return
+                    batch = self.get_images(range(first, last))
+                    with cond:
+                        queue.append((first, batch))
+                        queued[0] += batch.nbytes
+                        cond.notify_all()
+            except Exception as exc:
+                with cond:
+                    queue.append((None, exc))
+                    cond.notify_all()
+
+        thread = threading.Thread(target=producer, daemon=True,
+                                  name=f'prefetch {self._file_prefix}')
+        thread.start()
+        try:
+            for _ in ranges:
+                with cond:
+                    while not queue:
+                        cond.wait()
+                    first, batch = queue.popleft()
+                    if first is None:
+                        raise batch
+                    queued[0] -= batch.nbytes
+                    cond.notify_all()
+                yield first, batch
+        finally:
+            done.set()
+            with cond:
+                cond.notify_all()
+            thread.join()
+
+    def iter_frames(self, start=0, stop=None, **kwargs):
+        '''
+        Iterate over single images in acquisition order with background
+        prefetching, see ``iter_batches`` for the parameters.
+
+        Yields
+        ------
+            (image number, numpy array (H, W))
+        '''
+        for first, batch in self.iter_batches(start, stop, **kwargs):
+            for i, frame in enumerate(batch):
+                yield first + i, frame
 
     def get_file_list(self):
         '''
-        Get the file list.
+        Get the file list: master file and data files (from the run index,
+        no directory scan).
         '''
-        return glob(f'{self._file_prefix}_*')
+        index = self.index
+        master = index.master_file
+        return ([master] if master else []) + index.file_paths
 
     def get_file_sizes(self):
         '''
         Get the file size.
         Returns size in bytes.
         '''
-        sizes = []
-        file_name = self.get_file_list()
-        for file in file_name:
-            sizes.append(getsize(file))
-
-        return sizes
+        index = self.index
+        master = index.master_file
+        return ([os.path.getsize(master)] if master else []) + index.file_sizes
@@ -0,0 +1,264 @@
+"""
+Image-to-file index of Eiger runs
+
+Kept in a per-user cache directory (never in the beamline data directory)
+as ``<name>_<hash of prefix>.npz`` so image counts, size reporting and the
+lookup of the stored chunk of an image need no directory scans.  New data files are indexed incrementally as they
+appear; a data file the file writer has not finished is left out until it
+can be read.
+"""
+
+__all__ = [
+    "EigerRunIndex",
+]
+
+from ..session_logs import logger
+
+logger.info(__file__)
+
+from os.path import abspath, basename, dirname, exists, getmtime, getsize, join
+import hashlib
+import os
+
+import h5py
+import numpy as np
+
+
+def default_cache_dir():
+    return os.path.join(os.path.expanduser("~"), ".cache",
+                        "velociprobe_eiger_index")
+
+
+class EigerRunIndex:
+    """
+    Index of the ``<prefix>_data_NNNNNN.h5`` files of one Eiger run
+
+    Per data file: name, size, mtime, number of images and first image
+    number; per stored chunk: data file, first frame, byte offset, byte
+    size and filter mask in the file.
+
+    kwargs
+    ------
+    data_path = None    : str of the image dataset, defaults to DATA_PATH
+    cache_dir = None    : str of directory for the index files, defaults to
+                          ``cache_dir`` (~/.cache/velociprobe_eiger_index);
+                          False to keep the index in memory only
+    """
+
+    VERSION = 3
+    DATA_PATH = "entry/data/data"
+    cache_dir = default_cache_dir()
+
+    _FILE_KEYS = ("file_names", "file_sizes", "file_mtimes",
+                  "file_num_images", "file_first_image")
+    _CHUNK_KEYS = ("chunk_file", "chunk_first_frame", "chunk_byte_offset",
+                   "chunk_nbytes", "chunk_filter_mask")
+
+    def __init__(self, prefix, images_per_file, data_path=None,
+                 cache_dir=None):
+        self.prefix = str(prefix)
+        self.images_per_file = images_per_file
+        self.data_path = data_path or self.DATA_PATH
+        if cache_dir is not None:
+            self.cache_dir = cache_dir
+        key = hashlib.sha1(abspath(self.prefix).encode()).hexdigest()[:16]
+        self.path = (join(self.cache_dir, f"{basename(self.prefix)}_{key}.npz")
+                     if self.cache_dir else None)
+        self._arrays = self._empty()
+        if not self._load():
+            logger.info("building Eiger index of %s", self.prefix)
+        self.update()
+
+    @classmethod
+    def _empty(cls):
+        arrays = {key: np.zeros(0, dtype=np.int64)
+                  for key in cls._FILE_KEYS + cls._CHUNK_KEYS}
+        arrays["file_names"] = np.zeros(0, dtype="U")
+        arrays["file_mtimes"] = np.zeros(0, dtype=float)
+        return arrays
+
+    def _load(self):
+        if self.path is None or not exists(self.path):
+            return False
+        try:
+            with np.load(self.path, allow_pickle=False) as npz:
+                if (int(npz["version"]) != self.VERSION or
+                        int(npz["images_per_file"]) != self.images_per_file or
+                        str(npz["prefix"]) != abspath(self.prefix)):
+                    return False
+                self._arrays = {key: npz[key]
+                                for key in self._FILE_KEYS + self._CHUNK_KEYS}
+        except (OSError, KeyError, ValueError) as exc:
+            logger.warning("ignoring unreadable Eiger index %s: %s",
+                           self.path, exc)
+            return False
+        return True
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(tmp, "wb") as f:
+                np.savez(f, version=self.VERSION,
+                         images_per_file=self.images_per_file,
+                         prefix=abspath(self.prefix), **self._arrays)
+            os.replace(tmp, self.path)
+        except OSError as exc:
+            # keep the index in memory
+            logger.warning("could not write Eiger index %s: %s",
+                           self.path, exc)
+
+    def data_file(self, file_index):
+        """Path of data file number ``file_index`` (starts at 1)."""
+        return f"{self.prefix}_data_{file_index:06d}.h5"
+
+    @property
+    def master_file(self):
+        """Path of the ``<prefix>_master.h5`` file, None if not written."""
+        path = f"{self.prefix}_master.h5"
+        return path if exists(path) else None
+
+    def _index_file(self, file_index):
+        path = self.data_file(file_index)
+        chunks = []
+        with h5py.File(path, "r") as f:
+            ds = f[self.data_path]
+            num = len(ds)
+            if ds.chunks is not None:
+                def record(info):
+                    chunks.append((info.chunk_offset[0], info.byte_offset,
+                                   info.size, info.filter_mask))
+                if hasattr(ds.id, "chunk_iter"):
+                    ds.id.chunk_iter(record)
+                else:
+                    for i in range(ds.id.get_num_chunks()):
+                        record(ds.id.get_chunk_info(i))
+        chunks = np.array(chunks, dtype=np.int64).reshape(-1, 4)
+        chunks = chunks[np.argsort(chunks[:, 0], kind="stable")]
+        return (basename(path), getsize(path), getmtime(path), num), chunks
+
+    def _replace_from(self, first_file, entries):
+        """Replace files from position ``first_file`` on by ``entries``."""
+        a = self._arrays
+        files = {key: list(a[key][:first_file]) for key in self._FILE_KEYS}
+        keep = a["chunk_file"] < first_file
+        chunks = {key: [a[key][keep]] for key in self._CHUNK_KEYS}
+
+        for n, ((name, size, mtime, num), c) in enumerate(entries, first_file):
+            first_image = (files["file_first_image"][-1] +
+                           files["file_num_images"][-1]
+                           if files["file_names"] else 0)
+            for key, value in zip(self._FILE_KEYS,
+                                  (name, size, mtime, num, first_image)):
+                files[key].append(value)
+            chunks["chunk_file"].append(np.full(len(c), n, dtype=np.int64))
+            for key, column in zip(self._CHUNK_KEYS[1:], c.T):
+                chunks[key].append(column)
+
+        arrays = self._empty()
+        for key in self._FILE_KEYS:
+            # file names: let numpy size the unicode dtype
+            dtype = None if key == "file_names" else arrays[key].dtype
+            arrays[key] = np.asarray(files[key], dtype=dtype)
+        for key in self._CHUNK_KEYS:
+            arrays[key] = np.concatenate(chunks[key]).astype(np.int64)
+        self._arrays = arrays
+
+    def update(self):
+        """
+        Index data files that appeared (or changed) since the last call.
+        Costs one stat of the last indexed file and of the next one.
+
+        returns True if the index changed
+        """
+        n_files = len(self._arrays["file_names"])
+        first = n_files
+        if n_files:
+            last = self.data_file(n_files)
+            if (not exists(last) or
+                    getsize(last) != self._arrays["file_sizes"][-1] or
+                    getmtime(last) != self._arrays["file_mtimes"][-1]):
+                first = n_files - 1
+
+        entries = []
+        file_index = first + 1
+        while exists(self.data_file(file_index)):
+            try:
+                entries.append(self._index_file(file_index))
+            except OSError as exc:
+                # still being written: indexed once readable
+                logger.debug("not indexing %s yet: %s",
+                             self.data_file(file_index), exc)
+                break
+            file_index += 1
+
+        if first == n_files and not entries:
+            return False
+        self._replace_from(first, entries)
+        self.save()
+        return True
+
+    def locate(self, image_num):
+        """
+        Where image ``image_num`` is stored
+
+        returns
+        -------
+        dict of path, frame (within the dataset), chunk_byte_offset,
+        chunk_nbytes, chunk_filter_mask (None when not chunked) and
+        file_size
+        """
+        a = self._arrays
+        n = int(np.searchsorted(a["file_first_image"], image_num,
+                                side="right")) - 1
+        if n < 0 or image_num >= self.num_images:
+            raise IndexError(f"image {image_num} is not in {self.prefix}"
+                             f" ({self.num_images} images)")
+        frame = int(image_num - a["file_first_image"][n])
+
+        lo, hi = np.searchsorted(a["chunk_file"], [n, n + 1])
+        c = lo + int(np.searchsorted(a["chunk_first_frame"][lo:hi], frame,
+                                     side="right")) - 1
+        chunk = {key: int(a[key][c]) if c >= lo else None
+                 for key in self._CHUNK_KEYS[2:]}
+        return dict(path=self.file_paths[n], frame=frame,
+                    file_size=int(a["file_sizes"][n]), **chunk)
+
+    def file_chunks(self, file_index):
+        """
+        Stored chunks of data file number ``file_index`` (starts at 1), in
+        frame order
+
+        returns
+        -------
+        (first_frame, byte_offset, nbytes, filter_mask) tuple of ndarrays,
+        None when the file is not indexed
+        """
+        n = file_index - 1
+        if not 0 <= n < len(self._arrays["file_names"]):
+            return None
+        a = self._arrays
+        lo, hi = np.searchsorted(a["chunk_file"], [n, n + 1])
+        return tuple(a[key][lo:hi] for key in self._CHUNK_KEYS[1:])
+
+    @property
+    def num_images(self):
+        a = self._arrays
+        if not len(a["file_names"]):
+            return 0
+        return int(a["file_first_image"][-1] + a["file_num_images"][-1])
+
+    @property
+    def file_paths(self):
+        directory = dirname(self.prefix)
+        return [join(directory, name) for name in self._arrays["file_names"]]
+
+    @property
+    def file_sizes(self):
+        return self._arrays["file_sizes"].tolist()
+
+    @property
+    def file_num_images(self):
+        return self._arrays["file_num_images"].tolist()
@@ -0,0 +1,190 @@
+"""
+Live (tailing) reader of Eiger data files while a scan is acquiring
+"""
+
+__all__ = [
+    "EigerTailReader",
+]
+
+from ..session_logs import logger
+
+logger.info(__file__)
+
+import threading
+import time
+
+import h5py
+
+
+class EigerTailReader:
+    """
+    Stream the frames of a run to callbacks while it is being written
+
+    Watches for the ``<prefix>_data_NNNNNN.h5`` files of a
+    ``MyEigerHandler`` in order.  A data file is read through the handler
+    once the file writer is done with it (next file present, file full
+    or last file of the run, size stable between two polls).  With
+    ``swmr=True``, files written in SWMR mode are also read frame by
+    frame while they grow.
+
+    Callbacks are called from the reader thread as
+    ``callback(first_image_num, frames)`` with frames (n, H, W) in
+    acquisition order.  Latency is bounded by ``poll_interval``.
+
+    Parameters
+    ----------
+    handler MyEigerHandler
+        Handler of the run's resource
+    num_images int or None
+        Images expected (e.g. ``cam_num_images``), the reader stops after
+        the last one; None runs until ``stop()`` or ``timeout``
+    poll_interval float
+        Seconds between checks of the write directory
+    swmr bool
+        Read growing files in SWMR mode when possible
+    timeout float or None
+        Stop after this many seconds without new frames
+    """
+
+    def __init__(self, handler, num_images=None, poll_interval=0.5,
+                 swmr=True, timeout=None):
+        self.handler = handler
+        self.num_images = num_images
+        self.poll_interval = poll_interval
+        self.swmr = swmr
+        self.timeout = timeout
+        self.next_image = 0
+        self._callbacks = []
+        self._sizes = {}
+        self._swmr_file = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def subscribe(self, callback):
+        self._callbacks.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        self._callbacks.remove(callback)
+
+    @property
+    def done(self):
+        return self.num_images is not None and self.next_image >= self.num_images
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, daemon=True,
+                                        name="EigerTailReader")
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self.join()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run(self):
+        """Poll until done, stopped or timed out (blocking)."""
+        last_frame = time.monotonic()
+        try:
+            while not self._stop.is_set() and not self.done:
+                if self.poll():
+                    last_frame = time.monotonic()
+                    continue
+                if (self.timeout is not None and
+                        time.monotonic() - last_frame > self.timeout):
+                    logger.warning("EigerTailReader: no new frames for %s s,"
+                                   " stopping at image %d",
+                                   self.timeout, self.next_image)
+                    break
+                self._stop.wait(self.poll_interval)
+        finally:
+            self._close_swmr()
+
+    def _emit(self, first, frames):
+        self.next_image = first + len(frames)
+        for callback in self._callbacks:
+            try:
+                callback(first, frames)
+            except Exception:
+                logger.exception("EigerTailReader callback %s failed", callback)
+
+    def _close_swmr(self):
+        if self._swmr_file is not None:
+            self._swmr_file[1].close()
+            self._swmr_file = None
+
+    def _file_length(self, path):
+        """Number of frames in a data file, None if it can't be read yet."""
+        try:
+            with h5py.File(path, "r") as f:
+                return len(f[self.handler.DATA_PATH])
+        except (OSError, KeyError):
+            return None
+
+    def _complete(self, file_index, path, first):
+        """Frames in the data file if the writer is done with it, or None."""
+        size = path.stat().st_size
+        stable = self._sizes.get(path) == size
+        self._sizes[path] = size
+        if not stable:
+            return None
+        ipf = self.handler._images_per_file
+        next_exists = self.handler._file_path(file_index + 1).exists()
+        length = self._file_length(path)
+        if length is None:
+            return None
+        if (next_exists or length == ipf or
+                (self.num_images is not None and first + length >= self.num_images)):
+            return length
+        return None
+
+    def _poll_swmr(self, path, first):
+        """Read the frames appended to a growing SWMR file."""
+        if self._swmr_file is None or self._swmr_file[0] != path:
+            self._close_swmr()
+            try:
+                file = h5py.File(path, "r", libver="latest", swmr=True)
+            except OSError:
+                # not written in SWMR mode, wait for the file to be closed
+                return False
+            self._swmr_file = (path, file)
+        ds = self._swmr_file[1][self.handler.DATA_PATH]
+        ds.refresh()
+        local = self.next_image - first
+        length = len(ds)
+        if length <= local:
+            return False
+        self._emit(self.next_image, ds[local:length])
+        return True
+
+    def poll(self):
+        """
+        Check for new frames once and deliver them.
+
+        returns True if frames were delivered
+        """
+        ipf = self.handler._images_per_file
+        file_index = 1 + self.next_image // ipf
+        first = (file_index - 1) * ipf
+        path = self.handler._file_path(file_index)
+        if not path.exists():
+            return False
+
+        length = self._complete(file_index, path, first)
+        if length is None:
+            return self.swmr and self._poll_swmr(path, first)
+
+        self._close_swmr()
+        self._sizes.pop(path, None)
+        stop = first + length
+        if self.num_images is not None:
+            stop = min(stop, self.num_images)
+        if stop <= self.next_image:
+            return False
+        self._emit(self.next_image,
+                   self.handler.get_images(range(self.next_image, stop)))
+        return True
@@ -0,0 +1,379 @@
+"""
+Bad-pixel masks of the Eiger detectors
+
+Masks combine the detector's own pixel mask (gaps, dead and noisy pixels,
+from the master file) with hot/dead pixels found statistically in dark
+and flat runs.  They are cached, in memory and as ``.npy`` files, keyed by
+detector serial number, threshold energy and date, and are handed to
+``MyEigerHandler`` (``mask=``) so they are applied while frames are read.
+
+Masks are boolean arrays (H, W), True for good pixels.
+"""
+
+__all__ = [
+    "EIGER_PIXEL_MASK_BITS",
+    "read_master_info",
+    "pixel_statistics",
+    "hot_pixels",
+    "dead_pixels",
+    "build_mask",
+    "PixelMaskCache",
+    "pixel_mask_cache",
+    "mask_for_run",
+]
+
+from ..session_logs import logger
+
+logger.info(__file__)
+
+import datetime
+import glob
+import os
+import threading
+
+import h5py
+import numpy as np
+
+# bits of detectorSpecific/pixel_mask (Dectris)
+EIGER_PIXEL_MASK_BITS = {
+    "gap": 1 << 0,
+    "dead": 1 << 1,
+    "under_responding": 1 << 2,
+    "over_responding": 1 << 3,
+    "noisy": 1 << 4,
+}
+
+DETECTOR_PATH = "entry/instrument/detector"
+
+
+def read_master_info(master_file):
+    """
+    Detector serial, threshold energy, pixel mask and acquisition date
+    from a master file
+
+    returns
+    -------
+    dict of serial (str), threshold_energy (float, eV), pixel_mask
+    (uint32 ndarray (H, W), 0 for good pixels, or None) and date
+    (datetime.date of detectorSpecific/data_collection_date, or of the
+    master file modification time when not recorded)
+    """
+    with h5py.File(master_file, "r") as f:
+        det = f[DETECTOR_PATH]
+        serial = det["detector_number"][()]
+        if isinstance(serial, bytes):
+            serial = serial.decode()
+        specific = det.get("detectorSpecific", {})
+        pixel_mask = specific.get("pixel_mask")
+        date = specific.get("data_collection_date")
+        date = None if date is None else date[()]
+        if isinstance(date, bytes):
+            date = date.decode()
+        info = dict(
+            serial=str(serial),
+            threshold_energy=float(det["threshold_energy"][()]),
+            pixel_mask=None if pixel_mask is None else pixel_mask[()],
+        )
+    try:
+        # e.g. 2021-05-12T10:01:02.345+01:00
+        info["date"] = datetime.date.fromisoformat(str(date)[:10])
+    except ValueError:
+        info["date"] = datetime.date.fromtimestamp(
+            os.path.getmtime(master_file))
+    return info
+
+
+def pixel_statistics(frames):
+    """
+    Per-pixel mean and maximum of a frame stack, in a single pass
+
+    args
+    ----
+    frames          : ndarray (n, H, W), or an iterable of such batches
+                      (e.g. ``(b for _, b in handler.iter_batches())``)
+
+    returns
+    -------
+    (mean, maximum) ndarrays (H, W)
+    """
+    if isinstance(frames, np.ndarray):
+        frames = (frames,)
+    total = maximum = None
+    count = 0
+    for batch in frames:
+        if total is None:
+            total = np.zeros(batch.shape[1:], dtype=np.float64)
+            maximum = np.zeros(batch.shape[1:], dtype=batch.dtype)
+        total += batch.sum(axis=0, dtype=np.float64)
+        np.maximum(maximum, batch.max(axis=0), out=maximum)
+        count += len(batch)
+    if not count:
+        raise ValueError("no frames given")
+    return total / count, maximum
+
+
+def _median_mad(values):
+    """Median and MAD-based standard deviation."""
+    median = np.median(values)
+    sigma = 1.4826 * np.median(np.abs(values - median))
+    return median, sigma
+
+
+def hot_pixels(darks, n_sigma=6.0, min_counts=1.0):
+    """
+    Hot pixels of a dark run
+
+    A pixel is hot if its mean counts are more than ``n_sigma`` robust
+    standard deviations (MAD) above the median pixel and at least
+    ``min_counts``, or if it holds the detector's invalid value
+    (the maximum of the data type) in any frame.
+
+    args
+    ----
+    darks           : frames of a dark run, see ``pixel_statistics``
+
+    returns
+    -------
+    boolean ndarray (H, W), True for hot pixels
+    """
+    mean, maximum = pixel_statistics(darks)
+    median, sigma = _median_mad(mean)
+    hot = mean > max(median + n_sigma * sigma, min_counts)
+    if np.issubdtype(maximum.dtype, np.integer):
+        hot |= maximum == np.iinfo(maximum.dtype).max
+    return hot
+
+
+def dead_pixels(flats, fraction=0.1):
+    """
+    Dead (or strongly under-responding) pixels of a flat-field run:
+    mean counts below ``fraction`` of the median pixel.
+
+    returns
+    -------
+    boolean ndarray (H, W), True for dead pixels
+    """
+    mean, _ = pixel_statistics(flats)
+    return mean < fraction * np.median(mean)
+
+
+def build_mask(pixel_mask=None, darks=None, flats=None, shape=None,
+               n_sigma=6.0, dead_fraction=0.1):
+    """
+    Combine the detector pixel mask with statistical hot/dead pixels
+
+    kwargs
+    ------
+    pixel_mask = None   : detector pixel mask, nonzero for bad pixels
+    darks = None        : frames of a dark run (hot pixels)
+    flats = None        : frames of a flat-field run (dead pixels)
+    shape = None        : (H, W), only needed when nothing else is given
+    n_sigma = 6.0       : float, hot pixel threshold
+    dead_fraction = 0.1 : float, dead pixel threshold
+
+    returns
+    -------
+    boolean ndarray (H, W), True for good pixels
+    """
+    bad = None if pixel_mask is None else np.asarray(pixel_mask) != 0
+    for frames, find in ((darks, lambda f: hot_pixels(f, n_sigma)),
+                         (flats, lambda f: dead_pixels(f, dead_fraction))):
+        if frames is None:
+            continue
+        found = find(frames)
+        bad = found if bad is None else bad | found
+    if bad is None:
+        if shape is None:
+            raise ValueError("nothing to build a mask from")
+        bad = np.zeros(shape, dtype=bool)
+    logger.info("pixel mask: %d bad pixels of %d", bad.sum(), bad.size)
+    return ~bad
+
+
+def default_cache_dir():
+    return os.path.join(os.path.expanduser("~"), ".cache", "velociprobe_masks")
+
+
+class PixelMaskCache:
+    """
+    Masks cached by detector serial, threshold energy and date
+
+    kwargs
+    ------
+    cache_dir = None    : str of directory for the .npy files, defaults to
+                          ~/.cache/velociprobe_masks; False to keep the
+                          cache in memory only
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = default_cache_dir() if cache_dir is None else cache_dir
+        self._memory = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(serial, threshold_energy, date=None):
+        """(serial, threshold in eV rounded, ISO date; default today)"""
+        if date is None:
+            date = datetime.date.today()
+        if isinstance(date, (datetime.date, datetime.datetime)):
+            date = date.strftime("%Y-%m-%d")
+        return (str(serial), int(round(threshold_energy)), str(date))
+
+    def _path(self, key):
+        serial, threshold, date = key
+        return os.path.join(self.cache_dir, f"{serial}_{threshold}eV_{date}.npy")
+
+    def _load(self, key):
+        if not self.cache_dir:
+            return None
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            return np.load(path)
+        except (OSError, ValueError) as exc:
+            logger.warning("ignoring unreadable pixel mask %s: %s", path, exc)
+            return None
+
+    def _save(self, key, mask):
+        if not self.cache_dir:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                np.save(f, mask)
+            os.replace(tmp, path)
+        except OSError as exc:
+            logger.warning("could not write pixel mask %s: %s", path, exc)
+
+    def _latest(self, key):
+        """Most recent cached key of the same detector and threshold."""
+        serial, threshold, date = key
+        dates = {k[2] for k in self._memory if k[:2] == key[:2]}
+        if self.cache_dir:
+            pattern = os.path.join(self.cache_dir, f"{serial}_{threshold}eV_*.npy")
+            for path in glob.glob(pattern):
+                dates.add(os.path.basename(path)[:-4].rsplit("_", 1)[1])
+        dates = sorted(d for d in dates if d <= date)
+        return (serial, threshold, dates[-1]) if dates else None
+
+    def put(self, serial, threshold_energy, mask, date=None):
+        key = self.key(serial, threshold_energy, date)
+        mask = np.asarray(mask, dtype=bool)
+        mask.flags.writeable = False
+        with self._lock:
+            self._memory[key] = mask
+        self._save(key, mask)
+        return mask
+
+    def get(self, serial, threshold_energy, date=None, compute=None,
+            latest=True):
+        """
+        Mask of a detector at a threshold energy and date
+
+        args
+        ----
+        serial              : detector serial number
+        threshold_energy    : float of threshold energy (eV)
+
+        kwargs
+        ------
+        date = None         : date or ISO str, default today
+        compute = None      : callable returning a new mask on a miss
+        latest = True       : boolean; on a miss without compute, use the
+                              most recent earlier mask of the detector
+
+        returns
+        -------
+        read-only boolean ndarray (H, W), or None if not found
+        """
+        key = self.key(serial, threshold_energy, date)
+        keys = [key]
+        if latest and compute is None:
+            keys.append(None)
+        for k in keys:
+            if k is None:
+                k = self._latest(key)
+                if k is None:
+                    break
+            with self._lock:
+                mask = self._memory.get(k)
+            if mask is not None:
+                self.hits += 1
+                return mask
+            mask = self._load(k)
+            if mask is not None:
+                self.disk_hits += 1
+                mask.flags.writeable = False
+                with self._lock:
+                    self._memory[k] = mask
+                return mask
+
+        self.misses += 1
+        if compute is None:
+            return None
+        return self.put(serial, threshold_energy, compute(), date)
+
+    def clear(self, disk=False):
+        """Empty the memory cache (and the cache directory if disk)."""
+        with self._lock:
+            self._memory.clear()
+            if disk and self.cache_dir and os.path.isdir(self.cache_dir):
+                for name in os.listdir(self.cache_dir):
+                    if name.endswith(".npy"):
+                        os.remove(os.path.join(self.cache_dir, name))
+
+    @property
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            disk_hits=self.disk_hits,
+            misses=self.misses,
+            size=len(self._memory),
+        )
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(cache_dir={self.cache_dir!r}, {self.stats})"
+
+
+pixel_mask_cache = PixelMaskCache()
+
+
+def mask_for_run(prefix, darks=None, flats=None, date=None, cache=None,
+                 **kwargs):
+    """
+    Mask of the detector that wrote the run ``prefix``
+
+    Uses ``<prefix>_master.h5`` for the serial number, threshold energy,
+    detector pixel mask and date of the run; computes (with
+    ``darks``/``flats``, see ``build_mask``) and caches the mask if none is
+    cached for the date.  ``date=None`` is the date of the run, so a mask
+    made after the run is never applied to it.
+
+    returns
+    -------
+    read-only boolean ndarray (H, W), True for good pixels
+    """
+    cache = pixel_mask_cache if cache is None else cache
+    info = read_master_info(f"{prefix}_master.h5")
+    if date is None:
+        date = info["date"]
+    if darks is None and flats is None:
+        mask = cache.get(info["serial"], info["threshold_energy"], date)
+        if mask is not None:
+            return mask
+
+    def compute():
+        return build_mask(info["pixel_mask"], darks, flats, **kwargs)
+
+    if darks is not None or flats is not None:
+        # new calibration data: replace the entry of the date
+        return cache.put(info["serial"], info["threshold_energy"], compute(),
+                         date)
+    return cache.get(info["serial"], info["threshold_energy"], date,
+                     compute=compute)
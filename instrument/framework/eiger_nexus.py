@@ -0,0 +1,213 @@
+"""
+NeXus master files over Eiger data files (no data copy)
+
+One small file per run maps the run's images of the
+``<prefix>_data_NNNNNN.h5`` files into a single ``(N, H, W)`` HDF5 virtual
+dataset (``/entry/data/data``) next to
+the scan positions and run metadata, so any HDF5/NeXus reader sees the
+run as one array.  Source files are referenced by relative path: keep
+the master file in the run directory.
+"""
+
+__all__ = [
+    "write_nexus_master",
+    "nexus_master_from_documents",
+]
+
+from ..session_logs import logger
+
+logger.info(__file__)
+
+from os.path import dirname, exists, join, relpath
+import datetime
+import json
+import os
+
+import h5py
+import numpy as np
+
+from .eiger_index import EigerRunIndex
+
+DATA_PATH = "entry/data/data"
+EIGER_SPEC = "AD_EIGER"
+
+
+def _nx_group(parent, name, nx_class):
+    group = parent.require_group(name)
+    group.attrs["NX_class"] = nx_class
+    return group
+
+
+def write_nexus_master(prefix, images_per_file, output=None, positions=None,
+                       metadata=None, num_images=None, first_image=0):
+    """
+    Write a NeXus master file with a virtual dataset over a run
+
+    args
+    ----
+    prefix              : str of the resource file prefix (data files are
+                          ``<prefix>_data_NNNNNN.h5``)
+    images_per_file     : int of images per data file
+
+    kwargs
+    ------
+    output = None       : str of the master file name, defaults to
+                          ``<prefix>_nexus.h5``
+    positions = None    : dict of name -> array (one value per point or
+                          per frame), written in ``/entry/data``
+    metadata = None     : dict of run metadata (start document), written as
+                          JSON in ``/entry/bluesky/start``
+    num_images = None   : int of images to map (default: all on disk
+                          from first_image)
+    first_image = 0     : int of the first image to map, e.g. the first
+                          image of a run of a detector kept armed (its
+                          runs share the data files)
+
+    returns
+    -------
+    str of the master file name
+    """
+    output = output or f"{prefix}_nexus.h5"
+    index = EigerRunIndex(prefix, images_per_file)
+    paths = index.file_paths
+    counts = index.file_num_images
+    if not paths:
+        raise FileNotFoundError(f"no data files for {prefix}")
+    total = sum(counts) - first_image
+    if num_images is not None:
+        total = min(num_images, total)
+    if total <= 0:
+        raise ValueError(f"no image from {first_image} on in {prefix}"
+                         f" ({sum(counts)} images)")
+
+    with h5py.File(paths[0], "r") as f:
+        ds = f[DATA_PATH]
+        frame_shape, dtype = ds.shape[1:], ds.dtype
+
+    layout = h5py.VirtualLayout(shape=(total,) + frame_shape, dtype=dtype)
+    out_dir = dirname(os.path.abspath(output))
+    first = 0   # image number of the first image of the file
+    mapped = 0
+    for path, count in zip(paths, counts):
+        lo = max(first_image - first, 0)
+        hi = min(count, first_image + total - first)
+        if hi > lo:
+            source = h5py.VirtualSource(
+                relpath(os.path.abspath(path), out_dir), DATA_PATH,
+                shape=(count,) + frame_shape, dtype=dtype)
+            layout[mapped:mapped + hi - lo] = source[lo:hi]
+            mapped += hi - lo
+        first += count
+
+    metadata = metadata or {}
+    tmp = f"{output}.{os.getpid()}.tmp"
+    with h5py.File(tmp, "w") as f:
+        f.attrs["default"] = "entry"
+        entry = _nx_group(f, "entry", "NXentry")
+        entry.attrs["default"] = "data"
+        if "uid" in metadata:
+            entry["entry_identifier"] = metadata["uid"]
+        if "scan_id" in metadata:
+            entry["title"] = f"scan {metadata['scan_id']}"
+        if "time" in metadata:
+            entry["start_time"] = datetime.datetime.fromtimestamp(
+                metadata["time"]).astimezone().isoformat()
+
+        data = _nx_group(entry, "data", "NXdata")
+        data.create_virtual_dataset("data", layout, fillvalue=0)
+        data.attrs["signal"] = "data"
+        for name, values in (positions or {}).items():
+            data[name] = np.asarray(values)
+            data.attrs[f"{name}_indices"] = 0
+
+        detector = _nx_group(_nx_group(entry, "instrument", "NXinstrument"),
+                             "detector", "NXdetector")
+        detector["data"] = h5py.SoftLink(f"/{DATA_PATH}")
+        master = f"{prefix}_master.h5"
+        if exists(master):
+            # detector geometry, pixel mask, ... written by the Eiger
+            detector["eiger"] = h5py.ExternalLink(
+                relpath(os.path.abspath(master), out_dir),
+                "entry/instrument/detector")
+
+        if metadata:
+            bluesky = _nx_group(entry, "bluesky", "NXcollection")
+            bluesky["start"] = json.dumps(metadata, default=repr)
+    os.replace(tmp, output)
+
+    logger.info("NeXus master %s: images %d to %d of %s", output, first_image,
+                first_image + total - 1, prefix)
+    return output
+
+
+def nexus_master_from_documents(documents, output=None, stream_name="primary"):
+    """
+    Write the NeXus master file of a run from its documents
+
+    args
+    ----
+    documents           : iterable of (name, doc), e.g.
+                          ``db[-1].documents(fill=False)``
+
+    kwargs
+    ------
+    output = None       : str of the master file name
+    stream_name = "primary" : str of the stream holding the positions
+
+    returns
+    -------
+    str of the master file name
+    """
+    start = None
+    resource = None
+    resources = set()
+    image_nums = []
+    descriptors = {}
+    columns = {}
+
+    def add_events(descriptor_uid, data):
+        keys = descriptors.get(descriptor_uid)
+        if keys is None:
+            return
+        for key in keys:
+            if key in data:
+                columns.setdefault(key, []).extend(data[key])
+
+    for name, doc in documents:
+        if name == "start":
+            start = doc
+        elif name == "resource" and doc.get("spec") == EIGER_SPEC:
+            resource = resource or doc
+            resources.add(doc["uid"])
+        elif name == "datum" and doc["resource"] in resources:
+            image_nums.append(doc["datum_kwargs"]["image_num"])
+        elif name == "datum_page" and doc["resource"] in resources:
+            image_nums.extend(doc["datum_kwargs"]["image_num"])
+        elif name == "descriptor" and doc.get("name") == stream_name:
+            # positions: scalar, stored in the event (not external)
+            descriptors[doc["uid"]] = [
+                key for key, dk in doc["data_keys"].items()
+                if not dk.get("external") and not dk.get("shape") and
+                dk.get("dtype") in ("number", "integer")
+            ]
+        elif name == "event":
+            add_events(doc["descriptor"],
+                       {k: [v] for k, v in doc["data"].items()})
+        elif name == "event_page":
+            add_events(doc["descriptor"], doc["data"])
+
+    if resource is None:
+        raise ValueError("no Eiger resource in the documents")
+    prefix = join(resource.get("root", ""), resource["resource_path"])
+    # the run's images only: the runs of a detector kept armed share the
+    # data files and number their images from the first run
+    first_image, num_images = 0, None
+    if image_nums:
+        first_image = int(min(image_nums))
+        num_images = int(max(image_nums)) + 1 - first_image
+    return write_nexus_master(
+        prefix, resource["resource_kwargs"]["images_per_file"],
+        output=output,
+        positions={key: np.asarray(values) for key, values in columns.items()},
+        metadata=start, num_images=num_images, first_image=first_image,
+    )
@@ -4,49 +4,329 @@ Velociprobe fly scanning plans
 M. Wyman 2022-02-11
 """
 
-import bluesky.plans as bp
 import bluesky.plan_stubs as bps
 import bluesky.preprocessors as bpp
-from ..utils.trajectory_tools import unCenterCoords
+from ophyd.areadetector.filestore_mixins import new_uid
+import os
+import re
+import time
+from ..framework.eiger_index import EigerRunIndex
+from ..utils.trajectory_tools import unCenterCoords, fly_scan_num_images
 from ..utils.file_tools import create_dir
 from ..devices.motors import *
 from ..devices.flyers import flyUserCalcEnable, scanUserCalcEnable, laserFrequency, triggerFrequency
+from ..session_logs import logger
 
 __all__ = """
     staged_fly
+    fly_scan_settings
     VPBatchFly2d
     VPFlyScan2d
 """.split()
 
+DEFAULT_MAIN_DIR = '/mnt/micdata2/velociprobe/2021-2/Luo'
+
 def staged_fly(flyers, md = None):
+    '''
+    Stage, kick off and complete the flyers in one run, then collect each
+    flyer until it reports ``collect_done`` (one collect when it has no
+    such attribute).  The collected events are not kept in memory.
+    '''
 
     @bpp.stage_decorator(flyers)
+    @bpp.run_decorator(md = md)
     def inner_fly():
-        yield from bp.fly(flyers, md = md)
+        for flyer in flyers:
+            yield from bps.kickoff(flyer, wait = True)
+        for flyer in flyers:
+            yield from bps.complete(flyer, wait = True)
+        for flyer in flyers:
+            while True:
+                yield from bps.collect(flyer, return_payload = False)
+                if getattr(flyer, 'collect_done', True):
+                    break
 
     return (yield from inner_fly())
 
-def VPBatchFly2d(flyer, scan_parms):
+def fly_scan_settings(x_center, x_width, x_step_size,
+                      y_center, y_width, y_step_size,
+                      x_motor = sm_px, y_motor = sm_py,
+                      z_motor = sm_pz, z_pos = None,
+                      theta_motor = sm_theta, theta_pos = None,
+                      trig_freq = 80.0, laser_freq = 5000, scan_mode = 0,
+                      exposure_factor = 2, image_margin = 0.02,
+                      safety_factor = None, turnaround_time = None,
+                      main_dir=DEFAULT_MAIN_DIR,
+                      scan_num = None,
+                      md=None):
+    '''
+    Validate the parameters of a fly scan and compute its settings,
+    without touching any PV (see VPFlyScan2d for the parameters)
+
+    returns
+    -------
+    dict of scan_num, N_points (armed), predicted (model alone),
+    image_dir (bluesky side), images_per_file, vp (PMAC/VP calc puts),
+    eiger (Eiger puts), moves (start position) and md
+    '''
+    for name, value in (('x_width', x_width), ('y_width', y_width),
+                        ('x_step_size', x_step_size),
+                        ('y_step_size', y_step_size),
+                        ('trig_freq', trig_freq), ('laser_freq', laser_freq),
+                        ('exposure_factor', exposure_factor)):
+        if not value > 0:
+            raise ValueError(f"{name} must be positive, got {value}")
+    if scan_num is None:
+        raise ValueError("scan_num is required")
+
+    # coordinate transformation
+    x_start, x_stop, x_points = unCenterCoords(x_center, x_width, x_step_size)
+    y_start, y_stop, y_points = unCenterCoords(y_center, y_width, y_step_size)
+
+    N_points = fly_scan_num_images(scan_mode, x_width, y_width,
+                                   x_step_size, y_step_size, trig_freq,
+                                   margin = image_margin,
+                                   safety_factor = safety_factor,
+                                   turnaround_time = turnaround_time)
+    # model alone, recorded to calibrate it against the acquired images
+    predicted = fly_scan_num_images(scan_mode, x_width, y_width,
+                                    x_step_size, y_step_size, trig_freq,
+                                    margin = 0, safety_factor = None,
+                                    turnaround_time = turnaround_time)
+
+    name = 'fly{:03d}'.format(scan_num)
+    scan_dir='/local/home/dpuser/'+main_dir.split('mic')[1]+'/ptycho/'+name
+    exposure_period = 1./trig_freq
+
+    # Needs to be set for the PMAC to get the correct values
+    vp = [('scan_width', x_width),
+          ('scan_height', y_width),
+          ('x_center', x_center),
+          ('y_center', y_center),
+          ('x_step_size', 1000.0*x_step_size), # convert to nm
+          ('y_step_size', 1000.0*y_step_size), # convert to nm
+          #Velociprobe IOC calcs
+          ('scan_mode', scan_mode),
+          ('scan_wf_1000', main_dir+'/positions'),
+          ('scan_wf_1128', name)]
+    eiger = [('cam_acquire_period', exposure_period),
+             ('cam_acquire_time', exposure_period/exposure_factor),
+             ('cam_num_images', N_points),
+             ('cam_num_images_per_file', min([N_points,100000])),
+             ('cam_filepath', scan_dir),
+             ('cam_FW_pattern', name)]
+    if theta_pos is not None:
+        eiger.append(('cam_chi_start', theta_pos))
+
+    moves = [x_motor, x_start, y_motor, y_start]
+    if z_pos is not None:
+        moves += [z_motor, z_pos]
+    if theta_pos is not None:
+        moves += [theta_motor, theta_pos]
+
+# Added commented-out code in case needed for callbacks. This version was used
+# in VPcorrectedFermatSpiralStepScan
+    _md = {'predicted_num_images': predicted, 'armed_num_images': N_points}
+#   _md = {
+#          'extents': tuple([[x_center - x_radius*1.25, x_center + x_radius*1.25],
+#                            [y_center - y_radius*1.25, y_center + y_radius*1.25]]),
+#          'hints': {},
+#          }
+#   try:
+#       dimensions = [(x_motor.hints['fields'], 'primary'),
+#                     (y_motor.hints['fields'], 'primary')]
+#   except (AttributeError, KeyError):
+#   else:
+#       _md['hints'].update({'dimensions': dimensions})
+    _md.update(md or {})
+#       pass
+
+    return dict(
+        scan_num = scan_num,
+        scan_mode = scan_mode,
+        N_points = N_points,
+        predicted = predicted,
+        image_dir = main_dir+'/ptycho/'+name,
+        images_per_file = min([N_points,100000]),
+        #Laser frequency needs to be capped at 15 kHz
+        laser_freq = min([laser_freq,15000]),
+        trig_freq = trig_freq,
+        vp = vp,
+        eiger = eiger,
+        moves = moves,
+        md = _md,
+    )
+
+
+def _put_vp_settings(vpFlyer, settings):
+    # Setting up calcs for fly scan
+    flyUserCalcEnable.put(1)
+    scanUserCalcEnable.put(0)
+    for attr, value in settings['vp']:
+        getattr(vpFlyer, attr).put(value)
+    laserFrequency.put(settings['laser_freq'])
+    triggerFrequency.put(settings['trig_freq'])
+
+
+def _put_eiger_settings(vpFlyer, settings):
+    for attr, value in settings['eiger']:
+        getattr(vpFlyer, attr).put(value)
+
+
+def _fly_and_report(vpFlyer, settings, md=None):
+    _md = dict(settings['md'])
+    _md.update(md or {})
+    yield from staged_fly([vpFlyer], md = _md)
+
+    num_images = yield from bps.rd(vpFlyer.cam_num_images_counter)
+    latency = yield from bps.rd(vpFlyer.kickoff_latency)
+    logger.info("fly%03d scan_mode %d: armed %d images, predicted %d,"
+                " acquired %s, PMAC start to Eiger arm %.3f s",
+                settings['scan_num'], settings['scan_mode'],
+                settings['N_points'], settings['predicted'], num_images,
+                latency)
+    print(f"Images armed: {settings['N_points']}, predicted:"
+          f" {settings['predicted']}, acquired: {num_images}")
+    print(f"PMAC start to Eiger arm: {latency*1000:.1f} ms")
+    return num_images
+
+
+def _wait_for_eiger_files(settings, num_images, timeout = 600,
+                          poll_interval = 1.0):
     '''
-    How do ensure each scan in the batch gets its own uid?
+    Wait (plan) until the file writer has saved ``num_images`` images of a
+    fly scan, or ``timeout`` seconds.  The index of the files is kept in
+    memory only, nothing is written.
     '''
+    name = 'fly{:03d}'.format(settings['scan_num'])
+    prefix = os.path.join(settings['image_dir'], name)
+    t0 = time.monotonic()
+    index = EigerRunIndex(prefix, settings['images_per_file'],
+                          cache_dir = False)
+    while True:
+        # a data file still being written is counted once readable
+        index.update()
+        saved = index.num_images
+        if saved >= num_images:
+            return True
+        if time.monotonic() - t0 > timeout:
+            logger.warning("%s: %d of %d images saved after %s s",
+                           name, saved, num_images, timeout)
+            return False
+        yield from bps.sleep(poll_interval)
+
 
-    #Eiger setup
-    #! caput ('dp_eiger_xrd91:cam1:FWEnable',1)
-    #! caput ('dp_eiger_xrd91:cam1:SaveFiles',1)
-    #! caput ('dp_eiger_xrd91:cam1:FWAutoRemove',1)
+def _next_scan_num(main_dir):
+    ptycho = os.path.join(main_dir, 'ptycho')
+    nums = [int(m.group(1)) for m in
+            (re.fullmatch(r'fly(\d+)', d) for d in
+             (os.listdir(ptycho) if os.path.isdir(ptycho) else []))
+            if m]
+    return max(nums, default=0) + 1
 
-    #what setup needs done? Eiger settings; pmac settings;
-    #! caput('2iddVELO:VP:Pause_Resume.VAL',1)
-    #! gantry_z=caget('2iddf:Granite_Z:GoTo.VAL')
 
+def VPBatchFly2d(vpFlyer, scan_parms, first_scan_num = None,
+                 file_timeout = 600, poll_interval = 1.0, md = None,
+                 **kwargs):
+    '''
+    Run a batch of fly scans, one run (uid) each, overlapping the setup of
+    the next scan with the end of the previous one.
 
+    All scans are validated, numbered and their directories created
+    before the first one starts.  As soon as a scan's motion is complete,
+    the next scan's PMAC/VP settings are written and its start position
+    move is started; its Eiger settings (file path, name pattern, number
+    of images, ...) are written once the file writer has saved the
+    previous scan, since changing them earlier would misplace its files.
+    Nothing waits for the files of the last scan.
 
+    args
+    ----
+    vpFlyer         :   PmacEigerFlyer
+    scan_parms      :   list of scans, each a dict of VPFlyScan2d keyword
+                        arguments or a sequence (x_center, x_width,
+                        x_step_size, y_center, y_width, y_step_size)
+
+    kwargs
+    ------
+    first_scan_num = None   :   number of the first scan without scan_num
+                                in each main_dir, None --> next free flyNNN
+                                in main_dir/ptycho
+    file_timeout = 600      :   seconds to wait for the file writer
+    poll_interval = 1.0     :   seconds between file writer checks
+    md = None               :   metadata added to every run
+    **kwargs                :   VPFlyScan2d keyword arguments common to all
+                                scans (overridden by the scan's own)
+
+    returns
+    -------
+    list of the number of images acquired in each scan
+    '''
+    positional = ('x_center', 'x_width', 'x_step_size',
+                  'y_center', 'y_width', 'y_step_size')
+    scans = []
     for scan in scan_parms:
-        #scans[-1] is the last element in the old scan list
-        #! laser_freq=scan[-1]*pos_sampling
-        #! trig_freq = np.min((15000,laser_freq))
-        yield from VPFlyScan2d(flyer, scan_parms)
+        params = dict(kwargs)
+        params.update(scan if isinstance(scan, dict)
+                      else dict(zip(positional, scan)))
+        scans.append(params)
+
+    # number the scans and validate everything before moving anything
+    next_nums = {}
+    for params in scans:
+        if params.get('scan_num') is None:
+            main_dir = params.get('main_dir', DEFAULT_MAIN_DIR)
+            if main_dir not in next_nums:
+                next_nums[main_dir] = (_next_scan_num(main_dir)
+                                       if first_scan_num is None
+                                       else first_scan_num)
+            params['scan_num'] = next_nums[main_dir]
+            next_nums[main_dir] += 1
+    settings = [fly_scan_settings(**params) for params in scans]
+    dirs = [s['image_dir'] for s in settings]
+    if len(set(dirs)) != len(dirs):
+        raise ValueError("scan numbers are not unique: "
+                         f"{[s['scan_num'] for s in settings]}")
+    for image_dir in dirs:
+        if os.path.exists(image_dir):
+            raise ValueError(f"{image_dir} already exists")
+    for image_dir in dirs:
+        create_dir(image_dir)
+
+    batch_md = dict(batch_uid = new_uid(), batch_size = len(settings))
+    batch_md.update(md or {})
+
+    _put_vp_settings(vpFlyer, settings[0])
+    _put_eiger_settings(vpFlyer, settings[0])
+    yield from bps.mv(*settings[0]['moves'])
+
+    acquired = []
+    for i, current in enumerate(settings):
+        if i:
+            yield from bps.wait(group = 'fly_batch_move')
+        t0 = time.monotonic()
+        num_images = yield from _fly_and_report(
+            vpFlyer, current, dict(batch_md, batch_index = i))
+        acquired.append(num_images)
+
+        if i + 1 == len(settings):
+            logger.info("fly%03d: %.1f s from start to end of motion",
+                        current['scan_num'], time.monotonic() - t0)
+            break
+        nxt = settings[i + 1]
+        # motion done: PMAC setup and start move of the next scan now
+        _put_vp_settings(vpFlyer, nxt)
+        for motor, position in zip(nxt['moves'][::2], nxt['moves'][1::2]):
+            yield from bps.abs_set(motor, position, group = 'fly_batch_move')
+        # the next Eiger settings must wait for the files of this scan
+        yield from _wait_for_eiger_files(current, num_images, file_timeout,
+                                         poll_interval)
+        _put_eiger_settings(vpFlyer, nxt)
+        logger.info("fly%03d: %.1f s from start to files saved",
+                    current['scan_num'], time.monotonic() - t0)
+
+    return acquired
+
 
 def VPFlyScan2d(vpFlyer, x_center, x_width, x_step_size,
                 y_center, y_width, y_step_size, 
@@ -54,8 +334,9 @@ def VPFlyScan2d(vpFlyer, x_center, x_width, x_step_size,
                 z_motor = sm_pz, z_pos = None, 
                 theta_motor = sm_theta, theta_pos = None,
                 trig_freq = 80.0, laser_freq = 5000, scan_mode = 0, 
-                exposure_factor = 2,
-                main_dir='/mnt/micdata2/velociprobe/2021-2/Luo',
+                exposure_factor = 2, image_margin = 0.02,
+                safety_factor = None, turnaround_time = None,
+                main_dir=DEFAULT_MAIN_DIR,
                 scan_num = None, 
                 md=None):
     '''
@@ -83,88 +364,38 @@ def VPFlyScan2d(vpFlyer, x_center, x_width, x_step_size,
 	trig_freq = 80 Hz		: 	Detector trigger frequency also used by D-T to calc motor speeds
 	laser_freq = 5 kHz		:	D-T position recording frequency
     scan_mode = 0           :   0-snake, 5-spiral, 7-lissajous
+    image_margin = 0.02     :   fraction of extra frames armed above the
+                                predicted trajectory length
+    safety_factor = None    :   minimum frames armed per scan point (e.g.
+                                1.5 as armed before the prediction),
+                                None --> the prediction alone
+    turnaround_time = None  :   measured snake line turnaround time (s),
+                                None --> estimated from PMAC acceleration
     main_dir 				: 	main directory for storing position data and images
     md = None               :   dictionary of optional metadata passed onto
                                 grid_scan
     '''
 
-    # Setting up calcs for fly scan
-    flyUserCalcEnable.put(1)
-    scanUserCalcEnable.put(0)
-
-    # Needs to be set for the PMAC to get the correct values
-    vpFlyer.scan_width.put(x_width)
-    vpFlyer.scan_height.put(y_width)
-    vpFlyer.x_center.put(x_center)
-    vpFlyer.y_center.put(y_center)
-    vpFlyer.x_step_size.put(1000.0*x_step_size) # convert to nm
-    vpFlyer.y_step_size.put(1000.0*y_step_size) # convert to nm
-
-    # coordinate transformation
-    x_start, x_stop, x_points = unCenterCoords(x_center, x_width, x_step_size)
-    y_start, y_stop, y_points = unCenterCoords(y_center, y_width, y_step_size)
-
-    N_points = x_points*y_points*1.5 
-
-    #Velociprobe IOC calcs
-    vpFlyer.scan_mode.put(scan_mode)
-
-    #Eiger setup
-    exposure_period = 1./trig_freq
-    vpFlyer.cam_acquire_period.put(exposure_period)
-    vpFlyer.cam_acquire_time.put(exposure_period/exposure_factor)
-    if theta_pos is not None:
-        vpFlyer.cam_chi_start.put(theta_pos)
-    vpFlyer.cam_num_images.put(N_points)
-    vpFlyer.cam_num_images_per_file.put(min([N_points,100000])) 
-
-
-	#File saving
-    if scan_num is None:
-        pass
-
-    scan_dir='/local/home/dpuser/'+main_dir.split('mic')[1]+'/ptycho/fly{:03d}'.format(scan_num)
-    create_dir(main_dir+'/ptycho/fly{:03d}'.format(scan_num))
-
-    vpFlyer.cam_filepath.put(scan_dir)
-    vpFlyer.cam_FW_pattern.put('fly{:03d}'.format(scan_num))
-    vpFlyer.scan_wf_1000.put(main_dir+'/positions')
-    vpFlyer.scan_wf_1128.put('fly{:03d}'.format(scan_num))
-
-    #what setup needs done? Eiger settings; pmac settings;
-    #Laser frequency needs to be capped at 15 kHz
-    laserFrequency.put(min([laser_freq,15000]))
-    triggerFrequency.put(trig_freq)
+    settings = fly_scan_settings(
+        x_center, x_width, x_step_size, y_center, y_width, y_step_size,
+        x_motor = x_motor, y_motor = y_motor,
+        z_motor = z_motor, z_pos = z_pos,
+        theta_motor = theta_motor, theta_pos = theta_pos,
+        trig_freq = trig_freq, laser_freq = laser_freq, scan_mode = scan_mode,
+        exposure_factor = exposure_factor, image_margin = image_margin,
+        safety_factor = safety_factor,
+        turnaround_time = turnaround_time, main_dir = main_dir,
+        scan_num = scan_num, md = md)
 
+    #File saving
+    create_dir(settings['image_dir'])
 
+    _put_vp_settings(vpFlyer, settings)
+    _put_eiger_settings(vpFlyer, settings)
 
     # move to start
-    if z_pos is None and theta_pos is None:
-        yield from bps.mv(x_motor, x_start, y_motor, y_start)
-    elif z_pos is None and theta_pos is not None:
-        yield from bps.mv(x_motor, x_start, y_motor, y_start, theta_motor, theta_pos)
-    elif z_pos is not None and theta_pos is None:
-        yield from bps.mv(x_motor, x_start, y_motor, y_start, z_motor, z_pos)
-    else:
-        yield from bps.mv(x_motor, x_start, y_motor, y_start, z_motor, z_pos, theta_motor, theta_pos)
+    yield from bps.mv(*settings['moves'])
 
-# Added commented-out code in case needed for callbacks. This version was used
-# in VPcorrectedFermatSpiralStepScan
-    _md = {}
-#   _md = {
-#          'extents': tuple([[x_center - x_radius*1.25, x_center + x_radius*1.25],
-#                            [y_center - y_radius*1.25, y_center + y_radius*1.25]]),
-#          'hints': {},
-#          }
-#   try:
-#       dimensions = [(x_motor.hints['fields'], 'primary'),
-#                     (y_motor.hints['fields'], 'primary')]
-#   except (AttributeError, KeyError):
-#   else:
-#       _md['hints'].update({'dimensions': dimensions})
-    _md.update(md or {})
-#       pass
-
-    yield from staged_fly([vpFlyer], md = _md)
+    yield from _fly_and_report(vpFlyer, settings)
 
     return
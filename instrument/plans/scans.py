@@ -7,13 +7,19 @@ __all__ = """
 	VPfermatSpiralStepScan
 	VPspiralStepScan
 	VPcorrectedFermatSpiralStepScan
+	VPtrajectoryStepScan
 """.split()
 
-from bluesky.plan_stubs import mv
+from bluesky.plan_stubs import mv, one_nd_step
+from bluesky.preprocessors import stage_decorator, run_decorator
 from bluesky.plans import grid_scan, spiral, spiral_fermat, list_scan
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 from ..utils.trajectory_tools import unCenterCoords, path_length, vogel_spiral, reorder_spiral_path, snaked_spiral_path
+from ..utils.trajectory_tools import optimized_spiral_path, scan_time, trajectory_chunks
+from ..utils.trajectory_tools import motion_model_from_motors
+from ..utils.trajectory_cache import trajectory_cache
 from ..devices.motors import *
+from ..session_logs import logger
 
 import datetime
 import os
@@ -25,7 +31,7 @@ def VPstepScan(det, outer_center, outer_width, outer_step_size,
 			   outer_motor = sm_py, 
 			   inner_motor = sm_px, 
 			   z_motor = sm_pz, z_pos = None, 
-			   snake = True, md=None):
+			   snake = True, batch = None, md=None):
 	'''
 	args
 	----
@@ -45,14 +51,30 @@ def VPstepScan(det, outer_center, outer_width, outer_step_size,
 							z_pos defined
 	z_pos = None		:	Z position for scan 
 	snake = True		:	"Snake'ing" the inner axis by default
+	batch = None		:	None --> one trigger button press per point;
+							'gated' --> one image per external gate, 
+							points only wait for their image to be 
+							counted.  Needs a gate source wired to the 
+							Eiger trigger input and driven at each point 
+							(not set up here), otherwise every point 
+							times out.  One press per row ('images') is 
+							not possible: the motors move within the row
 	md = None			:	dictionary of optional metadata passed onto 
 							grid_scan
 	'''
 	
+	if batch == 'images':
+		raise ValueError("batch='images' takes the whole row at the frame"
+						 " rate while the motors move, use batch='gated'")
+	if batch not in (None, 'gated'):
+		raise ValueError(f"Unknown batch '{batch}', expected None or 'gated'")
+
 	# coordinate transformation
 	outer_start, outer_stop, outer_steps = unCenterCoords(outer_center, outer_width, outer_step_size)
 	inner_start, inner_stop, inner_steps = unCenterCoords(inner_center, inner_width, inner_step_size)
 
+	batched = [d for d in det if batch and hasattr(d, 'setup_batch_trigger')]
+
 	# move to start
 	if z_pos is not None:
 		yield from mv(outer_motor, outer_start, inner_motor, inner_start, z_motor, z_pos)
@@ -60,9 +82,15 @@ def VPstepScan(det, outer_center, outer_width, outer_step_size,
 		yield from mv(outer_motor, outer_start, inner_motor, inner_start)
 		
 	# grid_scan
-	yield from grid_scan(det, outer_motor, outer_start, outer_stop, outer_steps,
-							inner_motor, inner_start, inner_stop, inner_steps, 
-							snake_axes = snake, md=None)
+	try:
+		for d in batched:
+			d.setup_batch_trigger(inner_steps, gated = True)
+		yield from grid_scan(det, outer_motor, outer_start, outer_stop, outer_steps,
+								inner_motor, inner_start, inner_stop, inner_steps, 
+								snake_axes = snake, md=None)
+	finally:
+		for d in batched:
+			d.restore_trigger()
 
 	return
 
@@ -171,6 +199,9 @@ def VPcorrectedFermatSpiralStepScan(det, x_center, y_center, x_radius, y_radius,
 									factor = 1,
 									rough_dr = 5,  
 									snaked = False, polar=True, strips = 10, 
+									ordering = None, motion_model = None,
+									time_budget = 10.0, use_cache = True,
+									compare_orderings = False,
 									md=None):
 	'''
 	args
@@ -198,26 +229,82 @@ def VPcorrectedFermatSpiralStepScan(det, x_center, y_center, x_radius, y_radius,
 							that defined by the inner_motor
 	strips = 10			:	Used in forcing fermat spiral points into 
 							snake like ordering.  Number of outer_motor levels
+	ordering = None		:	'spiral', 'snake' or 'optimized' (minimum
+							predicted stage move time); None --> from snaked
+	motion_model = None	:	dict of per-axis velocity, acceleration, settle
+							used to predict the scan time; None --> from
+							the x/y motor settings (see
+							trajectory_tools.motion_model_from_motors)
+	time_budget = 10.0	:	seconds allowed for the 'optimized' ordering
+	use_cache = True	:	reuse spiral/snake trajectories of identical
+							geometry from trajectory_cache (any center)
+	compare_orderings = False	:	also compute the other orderings and log
+							their predicted move times
 	md = None			:	dictionary of optional metadata passed onto 
 							grid_scan
 	'''
 
-	r, theta = vogel_spiral(delta_r, x_radius, y_radius, factor, theta_0 = 137.508, polar = polar)
-
-	if not snaked:
-		trajectory_pol = reorder_spiral_path(r, theta, rough_dr)
-		trajectory_cart = np.vstack((trajectory_pol[:,0]*np.cos(trajectory_pol[:,1]),trajectory_pol[:,0]*np.sin(trajectory_pol[:,1]))).T
-	else:
-		trajectory_cart = snaked_spiral_path(r, theta, strips = 10, snakeXaxis = True)		
-
-	x_points = (trajectory_cart[:,0] + x_center).tolist()
-	y_points = (trajectory_cart[:,1] + y_center).tolist()
-
+	if ordering is None:
+		ordering = 'snake' if snaked else 'spiral'
+	if ordering not in ('spiral', 'snake', 'optimized'):
+		raise ValueError(f"Unknown ordering '{ordering}', expected one of "
+						 "'spiral', 'snake' or 'optimized'")
+
+	def compute(name):
+		r, theta = vogel_spiral(delta_r, x_radius, y_radius, factor, theta_0 = 137.508, polar = polar)
+		if name == 'spiral':
+			trajectory_pol = reorder_spiral_path(r, theta, rough_dr)
+			return np.vstack((trajectory_pol[:,0]*np.cos(trajectory_pol[:,1]),trajectory_pol[:,0]*np.sin(trajectory_pol[:,1]))).T
+		elif name == 'snake':
+			return snaked_spiral_path(r, theta, strips = strips, snakeXaxis = True)
+		else:
+			return optimized_spiral_path(r, theta, motion_model = motion_model,
+										 time_budget = time_budget,
+										 rough_dr = rough_dr, strips = strips)
+
+	if motion_model is None:
+		try:
+			motion_model = motion_model_from_motors(x_motor, y_motor)
+		except AttributeError:
+			# simulated motors: no velocity/acceleration to predict from
+			logger.info("no motion model for %s, %s: move time not predicted",
+						x_motor.name, y_motor.name)
+
+	names = [ordering]
+	if compare_orderings:
+		names += [name for name in ('spiral', 'snake', 'optimized')
+				  if name != ordering and (name != 'optimized' or
+										   motion_model is not None)]
+	trajectories = {}
+	for name in names:
+		# the optimized ordering depends on the time available, not cached
+		if not use_cache or name == 'optimized':
+			trajectories[name] = compute(name)
+			continue
+		params = dict(delta_r = delta_r, x_radius = x_radius, y_radius = y_radius,
+					  factor = factor, polar = polar, ordering = name)
+		if name == 'spiral':
+			params.update(rough_dr = rough_dr)
+		else:
+			params.update(strips = strips)
+		trajectories[name] = trajectory_cache.get(params, lambda: compute(name))
+
+	predicted = {}
+	if motion_model is not None:
+		for name, trajectory in trajectories.items():
+			predicted[name] = scan_time(trajectory[:,0], trajectory[:,1], motion_model)
+			logger.info("predicted move time (%s ordering): %.1f s", name, predicted[name])
+
+	trajectory_cart = trajectories.pop(ordering)
+	del trajectories
+
+	x_first = trajectory_cart[0,0] + x_center
+	y_first = trajectory_cart[0,1] + y_center
 
 	if z_pos is not None:
-		yield from mv(x_motor, x_points[0], y_motor, y_points[0], z_motor, z_pos)
+		yield from mv(x_motor, x_first, y_motor, y_first, z_motor, z_pos)
 	else:
-		yield from mv(x_motor, x_points[0], y_motor, y_points[0])
+		yield from mv(x_motor, x_first, y_motor, y_first)
 
 
 	# For live plots need dimensions added to metadata, which doesn't occur 
@@ -227,7 +314,10 @@ def VPcorrectedFermatSpiralStepScan(det, x_center, y_center, x_radius, y_radius,
 		   'extents': tuple([[x_center - x_radius*1.25, x_center + x_radius*1.25],
 							 [y_center - y_radius*1.25, y_center + y_radius*1.25]]),
 		   'hints': {},
+		   'ordering': ordering,
 		   }
+	if ordering in predicted:
+		_md['predicted_move_time'] = predicted[ordering]
 	try:
 		dimensions = [(x_motor.hints['fields'], 'primary'),
 					  (y_motor.hints['fields'], 'primary')]
@@ -238,11 +328,55 @@ def VPcorrectedFermatSpiralStepScan(det, x_center, y_center, x_radius, y_radius,
 	_md.update(md or {})
 
 	# fermat_spiral_scan yield
-	yield from list_scan(det, x_motor, x_points, y_motor, y_points, md = _md)
+	yield from VPtrajectoryStepScan(det, x_motor, y_motor,
+									trajectory_chunks(trajectory_cart, x_center, y_center),
+									num_points = len(trajectory_cart), md = _md)
 
 	return
 
 
+def VPtrajectoryStepScan(det, x_motor, y_motor, chunks, num_points = None,
+						 md = None):
+	'''
+	Step scan over (x, y) points consumed lazily from an iterable of (n,2)
+	chunks, e.g. trajectory_tools.trajectory_chunks().  Equivalent to 
+	list_scan without building the full point lists up front.
+
+	args
+	----
+	det					:	list of detectors to acquire at each step
+	x_motor				:	x stage
+	y_motor				:	y stage
+	chunks				:	iterable of (n,2) arrays of (x, y) positions
+
+	kwargs
+	------
+	num_points = None	:	total number of points, for metadata and
+							progress only
+	md = None			:	dictionary of optional metadata
+	'''
+
+	_md = {'detectors': [d.name for d in det],
+		   'motors': [x_motor.name, y_motor.name],
+		   'plan_name': 'VPtrajectoryStepScan',
+		   'hints': {},
+		   }
+	if num_points is not None:
+		_md['num_points'] = num_points
+		_md['num_intervals'] = num_points - 1
+	_md.update(md or {})
+
+	@stage_decorator(list(det) + [x_motor, y_motor])
+	@run_decorator(md = _md)
+	def inner_scan():
+		pos_cache = defaultdict(lambda: None)
+		for chunk in chunks:
+			for x, y in chunk.tolist():
+				yield from one_nd_step(det, {x_motor: x, y_motor: y}, pos_cache)
+
+	return (yield from inner_scan())
+
+
 
 
 
@@ -5,3 +5,4 @@ any extra commands or utility functions here
 from .load_eiger import load_eiger
 from .load_flyer import load_flyer
 
+from .trajectory_cache import trajectory_cache
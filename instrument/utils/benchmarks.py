@@ -0,0 +1,335 @@
+"""
+Benchmarks for trajectory generation and scan-plan construction
+
+Times (best of ``repeat``) and peak memory (tracemalloc) of the trajectory
+tools and of the message generation of the step-scan plans, swept over
+field size.  Plans are run against ophyd.sim motors and detectors and only
+their messages are generated (no RunEngine), so nothing touches EPICS.
+
+Typical use from the bluesky session::
+
+    results = run_benchmarks()
+    save_benchmark_baseline(results, "bench_baseline.json")
+    ...  # next release
+    run_benchmarks(baseline="bench_baseline.json", threshold=0.25)
+"""
+
+__all__ = """
+    benchmark
+    trajectory_benchmarks
+    plan_benchmarks
+    eiger_handler_benchmarks
+    run_benchmarks
+    save_benchmark_baseline
+    check_benchmark_regression
+""".split()
+
+from ..session_logs import logger
+logger.info(__file__)
+
+import json
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import pyRestTable
+
+from .trajectory_tools import (unCenterCoords, vogel_spiral,
+                               reorder_spiral_path, snaked_spiral_path)
+
+# (delta_r, x_radius, y_radius, factor) -> ~10^4, 10^5, 10^6 points
+TRAJECTORY_SWEEP = [
+    (0.1, 10.0, 10.0, 1),
+    (0.03, 10.0, 10.0, 1),
+    (0.01, 10.0, 10.0, 1),
+]
+
+# (width, step_size) of each axis -> 10^2, 10^3, 10^4 points
+# plan generation is much slower per point, extend this with care
+STEP_SCAN_SWEEP = [
+    (10.0, 1.0),
+    (30.0, 1.0),
+    (100.0, 1.0),
+]
+
+# (delta_r, radius) for VPcorrectedFermatSpiralStepScan
+SPIRAL_SCAN_SWEEP = [
+    (0.5, 5.0),
+    (0.2, 5.0),
+    (0.05, 5.0),
+]
+
+
+def benchmark(func, *args, repeat=3, number=1, **kwargs):
+    """
+    Time ``func(*args, **kwargs)`` and measure its peak memory
+
+    args
+    ----
+    func            : callable to benchmark
+
+    kwargs
+    ------
+    repeat = 3      : int of timing repeats, the best one is kept
+    number = 1      : int of calls per repeat (for very fast functions)
+
+    returns
+    -------
+    dict with ``time`` (s per call) and ``peak_memory`` (bytes)
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            func(*args, **kwargs)
+        best = min(best, (time.perf_counter() - t0) / number)
+
+    # separate pass: tracemalloc slows down allocation heavy code
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return dict(time=best, peak_memory=peak)
+
+
+def _consume(plan):
+    """Generate all the messages of a plan, returns the number of messages."""
+    n = 0
+    for _ in plan:
+        n += 1
+    return n
+
+
+def trajectory_benchmarks(sweep=None, rough_dr=5, strips=10, repeat=3):
+    """
+    Benchmark the trajectory tools over a sweep of field sizes
+
+    kwargs
+    ------
+    sweep = None    : list of (delta_r, x_radius, y_radius, factor),
+                      defaults to TRAJECTORY_SWEEP
+    rough_dr = 5    : float of ring width passed to reorder_spiral_path,
+                      as by VPcorrectedFermatSpiralStepScan
+    strips = 10     : int of strips used by snaked_spiral_path
+    repeat = 3      : int of timing repeats
+
+    returns
+    -------
+    dict of {benchmark name: result dict}
+    """
+    results = {}
+    results["unCenterCoords"] = dict(
+        points=1,
+        **benchmark(unCenterCoords, 0.0, 100.0, 0.1,
+                    repeat=repeat, number=10000)
+    )
+
+    for dr, x_radius, y_radius, factor in (sweep or TRAJECTORY_SWEEP):
+        label = f"dr={dr},r=({x_radius},{y_radius}),f={factor}"
+        r, theta = vogel_spiral(dr, x_radius, y_radius, factor, polar=True)
+        points = len(r)
+
+        results[f"vogel_spiral[{label}]"] = dict(
+            points=points,
+            **benchmark(vogel_spiral, dr, x_radius, y_radius, factor,
+                        polar=True, repeat=repeat)
+        )
+        results[f"reorder_spiral_path[{label}]"] = dict(
+            points=points,
+            **benchmark(reorder_spiral_path, r, theta, rough_dr,
+                        repeat=repeat)
+        )
+        results[f"snaked_spiral_path[{label}]"] = dict(
+            points=points,
+            **benchmark(snaked_spiral_path, r, theta, strips=strips,
+                        repeat=repeat)
+        )
+
+    return results
+
+
+def plan_benchmarks(step_sweep=None, spiral_sweep=None, repeat=1):
+    """
+    Benchmark message generation of the step-scan plans
+
+    Uses ophyd.sim motors and detector; messages are generated but never
+    sent to a RunEngine.
+
+    kwargs
+    ------
+    step_sweep = None   : list of (width, step_size) for VPstepScan,
+                          defaults to STEP_SCAN_SWEEP
+    spiral_sweep = None : list of (delta_r, radius) for
+                          VPcorrectedFermatSpiralStepScan,
+                          defaults to SPIRAL_SCAN_SWEEP
+    repeat = 1          : int of timing repeats
+
+    returns
+    -------
+    dict of {benchmark name: result dict}
+    """
+    from ophyd.sim import det, motor1, motor2
+    from ..plans.scans import VPstepScan, VPcorrectedFermatSpiralStepScan
+
+    results = {}
+    for width, step in (step_sweep or STEP_SCAN_SWEEP):
+        points = unCenterCoords(0.0, width, step)[2]**2
+
+        def plan():
+            return _consume(VPstepScan([det], 0.0, width, step,
+                                       0.0, width, step,
+                                       outer_motor=motor2, inner_motor=motor1))
+
+        results[f"VPstepScan[w={width},s={step}]"] = dict(
+            points=points, **benchmark(plan, repeat=repeat)
+        )
+
+    for dr, radius in (spiral_sweep or SPIRAL_SCAN_SWEEP):
+        points = len(vogel_spiral(dr, radius, radius, 1)[0])
+
+        def plan():
+            # not cached: time the trajectory generation every repeat
+            return _consume(VPcorrectedFermatSpiralStepScan(
+                [det], 0.0, 0.0, radius, radius, dr,
+                x_motor=motor1, y_motor=motor2, use_cache=False))
+
+        results[f"VPcorrectedFermatSpiralStepScan[dr={dr},r={radius}]"] = \
+            dict(points=points, **benchmark(plan, repeat=repeat))
+
+    return results
+
+
+def eiger_handler_benchmarks(directory=None, num_images=2000,
+                             images_per_file=500, shape=(128, 128),
+                             compression="gzip", repeat=1):
+    """
+    Benchmark reading a whole run through MyEigerHandler, per datum versus
+    the bulk get_images(), on synthetic Eiger-layout files
+
+    kwargs
+    ------
+    directory = None        : str of directory for the synthetic files,
+                              a temporary directory by default
+    num_images = 2000       : int of images in the run
+    images_per_file = 500   : int of images per data file
+    shape = (128, 128)      : tuple of frame shape
+    compression = "gzip"    : h5py compression of the synthetic files
+    repeat = 1              : int of timing repeats
+
+    returns
+    -------
+    dict of {benchmark name: result dict}
+    """
+    from ..framework.eiger_handler import MyEigerHandler
+    from .synthetic_eiger import write_synthetic_eiger_run
+
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        prefix = f"{tmp}/bench"
+        write_synthetic_eiger_run(prefix, num_images, images_per_file,
+                                  shape=shape, compression=compression)
+        image_nums = range(num_images)
+        label = f"n={num_images},ipf={images_per_file},shape={shape}"
+
+        def per_datum():
+            handler = MyEigerHandler(prefix, images_per_file=images_per_file)
+            return np.concatenate([handler(i).compute() for i in image_nums])
+
+        def bulk():
+            handler = MyEigerHandler(prefix, images_per_file=images_per_file)
+            return handler.get_images(image_nums)
+
+        results = {
+            f"MyEigerHandler.__call__[{label}]": dict(
+                points=num_images, **benchmark(per_datum, repeat=repeat)),
+            f"MyEigerHandler.get_images[{label}]": dict(
+                points=num_images, **benchmark(bulk, repeat=repeat)),
+        }
+
+    return results
+
+
+def save_benchmark_baseline(results, path):
+    """Write benchmark results to a JSON file to compare against later."""
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    logger.info("benchmark baseline written to %s", path)
+
+
+def check_benchmark_regression(results, baseline, threshold=0.25):
+    """
+    Compare benchmark results against a baseline
+
+    args
+    ----
+    results         : dict of results from run_benchmarks()
+    baseline        : dict of baseline results or path to a JSON file
+                      written by save_benchmark_baseline()
+
+    kwargs
+    ------
+    threshold = 0.25    : float of allowed fractional increase of time
+                          and peak memory
+
+    raises RuntimeError listing every regression beyond the threshold
+    """
+    if isinstance(baseline, str):
+        with open(baseline) as f:
+            baseline = json.load(f)
+
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for key in ("time", "peak_memory"):
+            old, new = baseline[name][key], result[key]
+            if old > 0 and (new - old) / old > threshold:
+                regressions.append(
+                    f"{name} {key}: {old:.4g} -> {new:.4g}"
+                    f" (+{100*(new - old)/old:.0f}%)"
+                )
+
+    if regressions:
+        raise RuntimeError(
+            f"{len(regressions)} benchmark(s) regressed by more than"
+            f" {100*threshold:.0f}%:\n  " + "\n  ".join(regressions)
+        )
+
+
+def run_benchmarks(baseline=None, threshold=0.25, plans=True, printing=True):
+    """
+    Run the trajectory (and plan) benchmarks
+
+    kwargs
+    ------
+    baseline = None     : dict or JSON path of baseline results; when
+                          given, regressions beyond threshold raise
+                          RuntimeError
+    threshold = 0.25    : float of allowed fractional regression
+    plans = True        : boolean to also benchmark plan generation
+    printing = True     : boolean to print a results table
+
+    returns
+    -------
+    dict of {benchmark name: result dict}
+    """
+    results = trajectory_benchmarks()
+    if plans:
+        results.update(plan_benchmarks())
+
+    if printing:
+        table = pyRestTable.Table()
+        table.labels = ["benchmark", "points", "time (s)", "peak memory (MB)"]
+        for name, result in results.items():
+            table.addRow((name, result["points"], f"{result['time']:.4g}",
+                          f"{result['peak_memory']/2**20:.2f}"))
+        print(table)
+
+    if baseline is not None:
+        check_benchmark_regression(results, baseline, threshold=threshold)
+
+    return results
@@ -0,0 +1,233 @@
+"""
+Fly scan positions per Eiger frame
+
+The PMAC records the interferometer positions (``scan_wf_1000`` directory,
+``scan_wf_1128`` file name) at ``laser_freq`` while the Eiger takes frames
+at ``trig_freq``.  Position files are memory mapped and the samples inside
+each exposure window are averaged with vectorized searchsorted/reduceat,
+block by block, so files of ~10^8 samples are never loaded whole.
+"""
+
+__all__ = """
+    open_positions
+    text_positions_to_npy
+    frame_windows
+    gate_windows
+    align_positions
+""".split()
+
+from ..session_logs import logger
+logger.info(__file__)
+
+from itertools import islice
+import os
+
+import numpy as np
+
+
+def open_positions(path, dtype=np.float64, columns=2):
+    """
+    Memory map a position file
+
+    args
+    ----
+    path                : str of a ``.npy`` file or a raw binary file of
+                          records
+
+    kwargs
+    ------
+    dtype = np.float64  : dtype of the raw binary values
+    columns = 2         : int of values per record (raw binary only)
+
+    returns
+    -------
+    read-only array (num_samples, columns)
+    """
+    if str(path).endswith(".npy"):
+        samples = np.load(path, mmap_mode="r")
+    else:
+        samples = np.memmap(path, dtype=dtype, mode="r")
+        samples = samples[:len(samples) - len(samples) % columns]
+        samples = samples.reshape(-1, columns)
+    return samples if samples.ndim == 2 else samples[:, None]
+
+
+def _is_data_line(line):
+    return bool(line.split("#", 1)[0].strip())
+
+
+def text_positions_to_npy(path, output=None, usecols=None, delimiter=None,
+                          skiprows=0, chunk_lines=1000000):
+    """
+    Convert a text position file to ``.npy`` once, in chunks of lines
+
+    returns
+    -------
+    str of the .npy file name (default: ``path`` with .npy)
+    """
+    output = output or os.path.splitext(path)[0] + ".npy"
+    # rows np.loadtxt parses: not blank once comments are removed, so the
+    # file is written with its final length
+    with open(path) as f:
+        num = sum(1 for line in islice(f, skiprows, None)
+                  if _is_data_line(line))
+    out = None
+    first = 0
+    with open(path) as f:
+        for _ in range(skiprows):
+            next(f)
+        while True:
+            lines = list(islice(f, chunk_lines))
+            if not lines:
+                break
+            lines = [line for line in lines if _is_data_line(line)]
+            if not lines:
+                continue
+            block = np.loadtxt(lines, delimiter=delimiter, usecols=usecols,
+                               ndmin=2)
+            if out is None:
+                tmp = f"{output}.{os.getpid()}.tmp"
+                out = np.lib.format.open_memmap(
+                    tmp, mode="w+", dtype=np.float64,
+                    shape=(num, block.shape[1]))
+            out[first:first + len(block)] = block
+            first += len(block)
+    if out is None:
+        raise ValueError(f"no positions in {path}")
+    out.flush()
+    del out
+    os.replace(tmp, output)
+    return output
+
+
+def frame_windows(num_frames, trig_freq, exposure_time=None, start=0.0):
+    """
+    Exposure windows of frames triggered at a fixed frequency
+
+    args
+    ----
+    num_frames          : int of frames
+    trig_freq           : float of trigger frequency (Hz)
+
+    kwargs
+    ------
+    exposure_time = None    : float (s), defaults to the trigger period
+    start = 0.0             : float, time of the first trigger (s)
+
+    returns
+    -------
+    (starts, stops) float arrays (num_frames,) in seconds
+    """
+    period = 1.0 / trig_freq
+    starts = start + period * np.arange(num_frames)
+    if exposure_time is None:
+        # each stop is exactly the next start, not one ulp past it
+        return starts, start + period * np.arange(1, num_frames + 1)
+    return starts, starts + exposure_time
+
+
+def gate_windows(gate, threshold=0.5):
+    """
+    Exposure windows from a recorded gate (trigger) column
+
+    returns
+    -------
+    (starts, stops) int arrays of sample indices, [start, stop) per frame
+    """
+    high = np.asarray(gate) > threshold
+    edges = np.diff(high.astype(np.int8), prepend=0, append=0)
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def _sample_range(starts, stops, times, sample_rate, num_samples):
+    """First and one-past-last sample of each window."""
+    if times is not None:
+        lo = np.searchsorted(times, starts, side="left")
+        hi = np.searchsorted(times, stops, side="left")
+    else:
+        # rounded first: a time a few ulp past a sample is on that sample
+        lo = np.ceil(np.round(np.asarray(starts) * sample_rate, 6))
+        hi = np.ceil(np.round(np.asarray(stops) * sample_rate, 6))
+        lo, hi = lo.astype(np.int64), hi.astype(np.int64)
+    return (np.clip(lo, 0, num_samples), np.clip(hi, 0, num_samples))
+
+
+def align_positions(samples, starts, stops, times=None, sample_rate=None,
+                    block_frames=100000):
+    """
+    Average the position samples over each frame's exposure window
+
+    args
+    ----
+    samples             : array (num_samples, k) of positions, e.g. from
+                          ``open_positions``
+    starts, stops       : arrays (num_frames,) of window limits: times in
+                          seconds (``frame_windows``), or sample indices
+                          (``gate_windows``) when times and sample_rate
+                          are None; windows must not overlap by more than
+                          one sample (a shared sample goes to the later
+                          frame)
+
+    kwargs
+    ------
+    times = None        : array (num_samples,) of sample times (s), sorted
+    sample_rate = None  : float (Hz) of uniformly spaced samples starting
+                          at t=0 (laser_freq), instead of times
+    block_frames = 100000   : int of frames processed per block (bounds
+                          the samples held in memory)
+
+    returns
+    -------
+    dict of arrays: mean (num_frames, k), std (jitter, num_frames, k),
+    ptp (peak to peak, num_frames, k), count (num_frames,); frames
+    without samples are NaN
+    """
+    num_samples, k = samples.shape
+    if times is None and sample_rate is None:
+        lo = np.clip(np.asarray(starts, dtype=np.int64), 0, num_samples)
+        hi = np.clip(np.asarray(stops, dtype=np.int64), 0, num_samples)
+    else:
+        lo, hi = _sample_range(starts, stops, times, sample_rate, num_samples)
+    if np.any(lo[1:] < hi[:-1] - 1):
+        raise ValueError("exposure windows overlap")
+    hi[:-1] = np.minimum(hi[:-1], lo[1:])
+
+    num_frames = len(lo)
+    count = hi - lo
+    mean = np.full((num_frames, k), np.nan)
+    std = np.full((num_frames, k), np.nan)
+    ptp = np.full((num_frames, k), np.nan)
+
+    for f0 in range(0, num_frames, block_frames):
+        f1 = min(f0 + block_frames, num_frames)
+        s0, s1 = lo[f0], hi[f1 - 1]
+        if s1 <= s0:
+            continue
+        block = np.asarray(samples[s0:s1], dtype=np.float64)
+        # offset for precision of the variance, sentinel row for reduceat
+        offset = block[0]
+        block = np.vstack([block - offset, np.zeros((1, k))])
+
+        # interleaved [lo, hi] indices: even reduceat results are windows
+        idx = np.empty(2 * (f1 - f0), dtype=np.int64)
+        idx[0::2] = lo[f0:f1] - s0
+        idx[1::2] = hi[f0:f1] - s0
+        n = count[f0:f1]
+        good = n > 0
+        sums = np.add.reduceat(block, idx, axis=0)[0::2][good]
+        squares = np.add.reduceat(block ** 2, idx, axis=0)[0::2][good]
+        highs = np.maximum.reduceat(block, idx, axis=0)[0::2][good]
+        lows = np.minimum.reduceat(block, idx, axis=0)[0::2][good]
+
+        frames = np.arange(f0, f1)[good]
+        n = n[good][:, None]
+        m = sums / n
+        mean[frames] = m + offset
+        std[frames] = np.sqrt(np.maximum(squares / n - m ** 2, 0.0))
+        ptp[frames] = highs - lows
+
+    empty = int(np.sum(count == 0))
+    if empty:
+        logger.warning("align_positions: %d of %d frames without position"
+                       " samples", empty, num_frames)
+    return dict(mean=mean, std=std, ptp=ptp, count=count)
@@ -6,26 +6,43 @@ M. Wyman 2022-02-11
 
 """ Loads a new flyer device """
 
+import time
+
 from ..devices.ad_eiger import LocalEigerDetector
 from ..devices.flyers import PmacEigerFlyer
 from ..framework import sd
 from ..session_logs import logger
 logger.info(__file__)
 
-__all__ = ['load_eiger']
+__all__ = ['load_flyer']
 
 pmac_base_pv = '2iddTAU:pmac1:'
 monitor_pv = '2iddf:9440:1:bi_1.VAL'
 eiger_base_pv = 'dp_eiger_xrd2:'
 
-
-def load_flyer(pmac_pv = pmac_base_pv, acro_pv = monitor_pv, 
-               eiger_pv = eiger_base_pv, name = 'vpFlyer'):
-
-    print('Using PMAC at : ',pmac_pv)
-    print('Using PMAC monitor : ', acro_pv)
-    print('Using Eiger at : ', eiger_pv)
-
-    peFlyer = PmacEigerFlyer(pmac_pv, acro_pv, eiger_pv, acro_pv, name = 'vpFlyer')
+# flyers already created in this session, by (pmac_pv, acro_pv, eiger_pv, name)
+_flyers = {}
+
+
+def load_flyer(pmac_pv = pmac_base_pv, acro_pv = monitor_pv,
+               eiger_pv = eiger_base_pv, name = 'vpFlyer', timeout = 10):
+    """
+    Return the fly scan device, connected
+
+    The device is created and all its PVs connected in parallel on the
+    first call; later calls with the same PVs return the same instance.
+    """
+    key = (pmac_pv, acro_pv, eiger_pv, name)
+    peFlyer = _flyers.get(key)
+    if peFlyer is None:
+        print('Using PMAC at : ',pmac_pv)
+        print('Using PMAC monitor : ', acro_pv)
+        print('Using Eiger at : ', eiger_pv)
+        peFlyer = PmacEigerFlyer(pmac_pv, acro_pv, eiger_pv, name = name)
+        _flyers[key] = peFlyer
+
+    t0 = time.monotonic()
+    peFlyer.wait_for_connection(all_signals = True, timeout = timeout)
+    logger.info("%s connected in %.3f s", name, time.monotonic() - t0)
 
     return peFlyer
@@ -0,0 +1,260 @@
+"""
+Ptychography preprocessing of Eiger runs
+
+Crops the diffraction patterns around the beam center, applies the bad
+pixel mask, bins, and writes a compact chunked/compressed HDF5 file ready
+for reconstruction.  Frames are read and reduced by a pool of worker
+threads; the output is written in image order by the calling thread.
+The run can be processed after the scan or incrementally while the data
+files land (``watch``).
+"""
+
+__all__ = """
+    preprocess_frames
+    PtychoPreprocessor
+""".split()
+
+from ..session_logs import logger
+
+logger.info(__file__)
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+
+import h5py
+import numpy as np
+
+
+def preprocess_frames(frames, center, crop_size, binning=1, mask=None,
+                      dtype=np.uint32):
+    """
+    Crop, mask and bin a stack of frames
+
+    args
+    ----
+    frames          : ndarray (n, H, W)
+    center          : (x, y) of the beam center (pixels)
+    crop_size       : int or (size_x, size_y) of the crop, a multiple of
+                      binning; parts outside of the detector are zero
+
+    kwargs
+    ------
+    binning = 1     : int of pixels binned along each axis
+    mask = None     : boolean ndarray (H, W), True for good pixels; bad
+                      pixels are set to 0
+    dtype = np.uint32   : output dtype
+
+    returns
+    -------
+    ndarray (n, size_y//binning, size_x//binning)
+    """
+    if np.isscalar(crop_size):
+        crop_size = (crop_size, crop_size)
+    size_x, size_y = (int(s) for s in crop_size)
+    if size_x % binning or size_y % binning:
+        raise ValueError(f"crop_size {crop_size} is not a multiple of"
+                         f" binning {binning}")
+
+    n, height, width = frames.shape
+    x0 = int(round(center[0])) - size_x // 2
+    y0 = int(round(center[1])) - size_y // 2
+
+    # overlap of the crop window with the detector
+    sx0, sx1 = max(x0, 0), min(x0 + size_x, width)
+    sy0, sy1 = max(y0, 0), min(y0 + size_y, height)
+
+    cropped = np.zeros((n, size_y, size_x), dtype=frames.dtype)
+    if sx1 > sx0 and sy1 > sy0:
+        region = frames[:, sy0:sy1, sx0:sx1]
+        if mask is not None:
+            region = region * mask[sy0:sy1, sx0:sx1]
+        cropped[:, sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = region
+
+    if binning > 1:
+        cropped = cropped.reshape(
+            n, size_y // binning, binning, size_x // binning, binning
+        ).sum(axis=(2, 4), dtype=np.uint64)
+        cropped = np.minimum(cropped, np.iinfo(dtype).max
+                             if np.issubdtype(dtype, np.integer) else np.inf)
+
+    return cropped.astype(dtype, copy=False)
+
+
+def _preprocess_range(handler, start, stop, kwargs):
+    """Worker: read images [start, stop) of a run and preprocess them."""
+    return preprocess_frames(handler.get_images(range(start, stop)), **kwargs)
+
+
+class PtychoPreprocessor:
+    """
+    Parallel crop/bin/mask pipeline from an Eiger run to a reduced file
+
+    The workers are threads: numpy and the chunk decompression of the
+    direct reader release the GIL, and threads are safe in the session
+    where forking a process with live channel access threads is not.
+
+    Parameters
+    ----------
+    prefix str
+        Resource file prefix of the run (``<prefix>_data_NNNNNN.h5``)
+    images_per_file int
+        Images per Eiger data file
+    output str
+        Output HDF5 file name (data in ``entry/data/data``)
+    center (x, y)
+        Beam center in pixels
+    crop_size int or (size_x, size_y)
+        Crop size in pixels (multiple of binning)
+    binning int
+        Binning along each axis
+    mask ndarray or None
+        Boolean (H, W), True for good pixels (saved with the output)
+    workers int or None
+        Worker threads, defaults to the number of CPUs
+    batch_size int
+        Images per worker task (also the output chunking along frames)
+    compression str
+        h5py compression of the output
+    compression_opts
+        h5py compression options
+    reader str
+        MyEigerHandler reader of the workers, 'direct' or 'hdf5'
+    """
+
+    def __init__(self, prefix, images_per_file, output, center, crop_size,
+                 binning=1, mask=None, workers=None, batch_size=256,
+                 compression="gzip", compression_opts=4, dtype=np.uint32,
+                 reader="direct"):
+        self.prefix = prefix
+        self.images_per_file = images_per_file
+        self.output = output
+        self.workers = workers or os.cpu_count()
+        self.batch_size = batch_size
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.reader = reader
+        self.mask = mask
+        self._kwargs = dict(center=tuple(center), crop_size=crop_size,
+                            binning=binning, mask=mask, dtype=dtype)
+        # next input image to queue, images in the output file
+        self.submitted = 0
+        self.written = 0
+        self._pending = deque()
+        self._pool = None
+        self._handler = None
+        self._file = None
+        self._ds = None
+
+    def _open_output(self, shape, dtype):
+        self._file = h5py.File(self.output, "w")
+        ds = self._file.create_dataset(
+            "entry/data/data", shape=(0,) + shape, maxshape=(None,) + shape,
+            chunks=(min(self.batch_size, 64),) + shape, dtype=dtype,
+            compression=self.compression,
+            compression_opts=self.compression_opts,
+        )
+        for key in ("center", "crop_size", "binning"):
+            ds.attrs[key] = self._kwargs[key]
+        ds.attrs["source"] = str(self.prefix)
+        if self.mask is not None:
+            self._file.create_dataset("entry/data/mask", data=self.mask,
+                                      compression=self.compression)
+        self._ds = ds
+
+    def submit(self, stop):
+        """Queue images up to ``stop`` (exclusive) not queued yet."""
+        from ..framework.eiger_handler import MyEigerHandler
+
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(self.workers)
+            self._handler = MyEigerHandler(
+                self.prefix, images_per_file=self.images_per_file,
+                reader=self.reader)
+        for first in range(self.submitted, stop, self.batch_size):
+            last = min(first + self.batch_size, stop)
+            self._pending.append(self._pool.submit(
+                _preprocess_range, self._handler, first, last, self._kwargs))
+        self.submitted = max(self.submitted, stop)
+
+    def write_ready(self, block=False):
+        """Write finished batches, in order; returns images written."""
+        count = 0
+        while self._pending and (block or self._pending[0].done()):
+            batch = self._pending.popleft().result()
+            if self._ds is None:
+                self._open_output(batch.shape[1:], batch.dtype)
+            n = self.written
+            self._ds.resize(n + len(batch), axis=0)
+            self._ds[n:] = batch
+            self.written += len(batch)
+            count += len(batch)
+        if count:
+            self._file.flush()
+        return count
+
+    def run(self, start=0, stop=None):
+        """Process a complete run (images [start, stop)) and close."""
+        from ..framework.eiger_handler import MyEigerHandler
+
+        if stop is None:
+            stop = MyEigerHandler(self.prefix, self.images_per_file).num_images()
+        self.submitted = start
+        self.written = 0
+        self.submit(stop)
+        self.write_ready(block=True)
+        self.close()
+        return self.output
+
+    def watch(self, num_images, poll_interval=1.0, timeout=None):
+        """
+        Process the run incrementally while its data files land.
+
+        Parameters
+        ----------
+        num_images int
+            Images expected in the run
+        poll_interval float
+            Seconds between checks for new data files
+        timeout float or None
+            Give up after this many seconds without new images
+        """
+        from ..framework.eiger_handler import MyEigerHandler
+
+        handler = MyEigerHandler(self.prefix, self.images_per_file)
+        last_new = time.monotonic()
+        try:
+            while self.written < num_images:
+                available = min(handler.num_images(), num_images)
+                if available < num_images:
+                    # the last file may still be written, whole files only
+                    available -= available % self.images_per_file
+                if available > self.submitted:
+                    self.submit(available)
+                    last_new = time.monotonic()
+                elif (timeout is not None and
+                        time.monotonic() - last_new > timeout):
+                    logger.warning("%s: no new images for %s s, stopping"
+                                   " after %d of %d", self.prefix, timeout,
+                                   self.submitted, num_images)
+                    break
+                if not self.write_ready():
+                    time.sleep(poll_interval)
+            self.write_ready(block=True)
+        finally:
+            self.close()
+        return self.output
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+            self._handler.close()
+            self._handler = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._ds = None
+        logger.info("%s: %d images written to %s", self.prefix,
+                    self.written, self.output)
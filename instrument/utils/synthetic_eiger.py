@@ -0,0 +1,181 @@
+"""
+Synthetic Eiger data files
+
+Writes ``<prefix>_data_NNNNNN.h5`` files with the Eiger file-writer layout
+(``entry/data/data``, one frame per chunk) so the Eiger handler and the
+analysis tools can be exercised without the detector.
+"""
+
+__all__ = """
+    write_eiger_data_file
+    write_synthetic_eiger_run
+    start_synthetic_eiger_writer
+""".split()
+
+from ..session_logs import logger
+logger.info(__file__)
+
+import multiprocessing
+import os
+import time
+
+import h5py
+import numpy as np
+
+DATA_PATH = 'entry/data/data'
+
+
+def write_eiger_data_file(path, frames, first_image=1, chunk_frames=1,
+                          compression=None):
+    """
+    Write one Eiger-layout data file
+
+    args
+    ----
+    path                : str of file name
+    frames              : ndarray (n, H, W) of frames
+
+    kwargs
+    ------
+    first_image = 1     : int of image_nr_low (Eiger numbering starts at 1)
+    chunk_frames = 1    : int of frames per HDF5 chunk
+    compression = None  : h5py compression, e.g. "gzip" or
+                          hdf5plugin.Bitshuffle()
+    """
+    kwargs = {}
+    if compression is not None:
+        if isinstance(compression, str):
+            kwargs["compression"] = compression
+        else:
+            kwargs.update(compression)
+
+    tmp = f"{path}.tmp"
+    with h5py.File(tmp, "w") as f:
+        ds = f.create_dataset(
+            DATA_PATH, data=frames,
+            chunks=(min(chunk_frames, len(frames)),) + frames.shape[1:],
+            **kwargs
+        )
+        ds.attrs["image_nr_low"] = first_image
+        ds.attrs["image_nr_high"] = first_image + len(frames) - 1
+    # appear atomically, as the file writer closing the file
+    os.replace(tmp, path)
+
+
+def synthetic_frames(first, num, shape, dtype=np.uint32, seed=0):
+    """Reproducible Poisson frames, frame i has mean ~ (i % 7) + 1."""
+    rng = np.random.default_rng(seed + first)
+    lam = ((np.arange(first, first + num) % 7) + 1)[:, None, None]
+    return rng.poisson(lam, size=(num,) + tuple(shape)).astype(dtype)
+
+
+def write_synthetic_eiger_run(prefix, num_images, images_per_file,
+                              shape=(64, 64), dtype=np.uint32,
+                              chunk_frames=1, compression=None, seed=0):
+    """
+    Write a full run of Eiger-layout data files
+
+    args
+    ----
+    prefix              : str of the resource file prefix, files are
+                          ``<prefix>_data_NNNNNN.h5``
+    num_images          : int of total images
+    images_per_file     : int of images per data file
+
+    kwargs
+    ------
+    shape = (64, 64)    : tuple of frame shape
+    dtype = np.uint32   : frame dtype
+    chunk_frames = 1    : int of frames per HDF5 chunk
+    compression = None  : h5py compression
+    seed = 0            : int of random seed
+
+    returns
+    -------
+    list of the data file names
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(prefix)), exist_ok=True)
+    paths = []
+    for n, first in enumerate(range(0, num_images, images_per_file)):
+        num = min(images_per_file, num_images - first)
+        path = f"{prefix}_data_{n + 1:06d}.h5"
+        write_eiger_data_file(
+            path, synthetic_frames(first, num, shape, dtype, seed),
+            first_image=first + 1, chunk_frames=chunk_frames,
+            compression=compression
+        )
+        paths.append(path)
+    return paths
+
+
+def _swmr_data_file(path, first, num, shape, dtype, seed, frame_rate):
+    """Write one data file frame by frame in SWMR mode."""
+    with h5py.File(path, "w", libver="latest") as f:
+        ds = f.create_dataset(DATA_PATH, shape=(0,) + tuple(shape),
+                              maxshape=(None,) + tuple(shape),
+                              chunks=(1,) + tuple(shape), dtype=dtype)
+        ds.attrs["image_nr_low"] = first + 1
+        ds.attrs["image_nr_high"] = first + num
+        f.swmr_mode = True
+        frames = synthetic_frames(first, num, shape, dtype, seed)
+        for i, frame in enumerate(frames):
+            time.sleep(1.0 / frame_rate)
+            ds.resize(i + 1, axis=0)
+            ds[i] = frame
+            ds.flush()
+
+
+def _synthetic_eiger_writer(prefix, num_images, images_per_file, frame_rate,
+                            shape, dtype, compression, swmr, seed):
+    os.makedirs(os.path.dirname(os.path.abspath(prefix)), exist_ok=True)
+    for n, first in enumerate(range(0, num_images, images_per_file)):
+        num = min(images_per_file, num_images - first)
+        path = f"{prefix}_data_{n + 1:06d}.h5"
+        if swmr:
+            _swmr_data_file(path, first, num, shape, dtype, seed, frame_rate)
+        else:
+            # the file writer closes the file once all its frames are in
+            time.sleep(num / frame_rate)
+            write_eiger_data_file(
+                path, synthetic_frames(first, num, shape, dtype, seed),
+                first_image=first + 1, compression=compression
+            )
+
+
+def start_synthetic_eiger_writer(prefix, num_images, images_per_file,
+                                 frame_rate=100.0, shape=(64, 64),
+                                 dtype=np.uint32, compression=None,
+                                 swmr=False, seed=0):
+    """
+    Start a process emitting Eiger-layout data files as a live acquisition
+
+    args
+    ----
+    prefix              : str of the resource file prefix
+    num_images          : int of total images
+    images_per_file     : int of images per data file
+
+    kwargs
+    ------
+    frame_rate = 100.0  : float of simulated frames per second
+    shape = (64, 64)    : tuple of frame shape
+    dtype = np.uint32   : frame dtype
+    compression = None  : h5py compression (not used with swmr)
+    swmr = False        : boolean; True --> each file is written frame by
+                          frame in SWMR mode, False --> each file appears
+                          complete once its frames are "acquired"
+    seed = 0            : int of random seed (frames match
+                          write_synthetic_eiger_run)
+
+    returns
+    -------
+    the started multiprocessing.Process
+    """
+    process = multiprocessing.Process(
+        target=_synthetic_eiger_writer,
+        args=(prefix, num_images, images_per_file, frame_rate, shape, dtype,
+              compression, swmr, seed),
+        daemon=True,
+    )
+    process.start()
+    return process
@@ -0,0 +1,170 @@
+"""
+Persistent cache of centered scan trajectories
+
+Trajectories are stored centered on (0, 0), keyed by a hash of the
+parameters that define them, so re-running a geometry at a new center
+skips the point generation and ordering.  Recently used entries are kept
+in memory (LRU), all entries are saved as ``.npy`` files in a cache
+directory that survives between sessions.
+"""
+
+__all__ = """
+    TrajectoryCache
+    trajectory_cache
+""".split()
+
+from ..session_logs import logger
+logger.info(__file__)
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+# bump when the trajectory generation changes, invalidates old entries
+TRAJECTORY_CACHE_VERSION = 1
+
+
+def default_cache_dir():
+    return os.path.join(os.path.expanduser("~"), ".cache", "velociprobe_trajectories")
+
+
+class TrajectoryCache:
+    """
+    LRU memory cache of centered trajectories backed by ``.npy`` files
+
+    kwargs
+    ------
+    cache_dir = None    : str of directory for the .npy files, defaults to
+                          ~/.cache/velociprobe_trajectories; False to keep
+                          the cache in memory only
+    maxsize = 16        : int of trajectories kept in memory
+    """
+
+    def __init__(self, cache_dir=None, maxsize=16):
+        self.cache_dir = default_cache_dir() if cache_dir is None else cache_dir
+        self.maxsize = maxsize
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(params):
+        """Content address of a parameter dict."""
+        text = json.dumps(
+            dict(params, version=TRAJECTORY_CACHE_VERSION),
+            sort_keys=True, default=repr
+        )
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def _remember(self, key, trajectory):
+        self._memory[key] = trajectory
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def _load(self, key):
+        if not self.cache_dir:
+            return None
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            return np.load(path)
+        except (OSError, ValueError) as exc:
+            logger.warning("ignoring unreadable trajectory cache %s: %s", path, exc)
+            return None
+
+    def _save(self, key, trajectory):
+        if not self.cache_dir:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                np.save(f, trajectory)
+            os.replace(tmp, path)
+        except OSError as exc:
+            logger.warning("could not write trajectory cache %s: %s", path, exc)
+
+    def get(self, params, compute, x_center=0.0, y_center=0.0):
+        """
+        Return the trajectory for ``params``, computing it on a miss
+
+        args
+        ----
+        params          : dict of the parameters defining the trajectory
+        compute         : callable returning the centered (N,2) trajectory
+
+        kwargs
+        ------
+        x_center = 0.0  : float of x offset applied to the returned points
+        y_center = 0.0  : float of y offset applied to the returned points
+
+        returns
+        -------
+        (N,2) ndarray; read-only and shared with the cache when no offset
+        is applied
+        """
+        key = self.key(params)
+        with self._lock:
+            trajectory = self._memory.get(key)
+            if trajectory is not None:
+                self.hits += 1
+                self._memory.move_to_end(key)
+            else:
+                trajectory = self._load(key)
+                if trajectory is not None:
+                    self.disk_hits += 1
+                    self._remember(key, trajectory)
+
+        if trajectory is None:
+            self.misses += 1
+            trajectory = np.asarray(compute(), dtype=float)
+            trajectory.flags.writeable = False
+            with self._lock:
+                self._remember(key, trajectory)
+            self._save(key, trajectory)
+        else:
+            trajectory.flags.writeable = False
+
+        if x_center or y_center:
+            return trajectory + np.array([x_center, y_center])
+        return trajectory
+
+    def clear(self, disk=False):
+        """Empty the memory cache (and the cache directory if disk)."""
+        with self._lock:
+            self._memory.clear()
+            if disk and self.cache_dir and os.path.isdir(self.cache_dir):
+                for name in os.listdir(self.cache_dir):
+                    if name.endswith(".npy"):
+                        os.remove(os.path.join(self.cache_dir, name))
+
+    @property
+    def stats(self):
+        """Dict of hit/miss counters and memory size."""
+        return dict(
+            hits=self.hits,
+            disk_hits=self.disk_hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            size=len(self._memory),
+        )
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(cache_dir={self.cache_dir!r}, {self.stats})"
+
+
+trajectory_cache = TrajectoryCache()
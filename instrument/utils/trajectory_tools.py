@@ -1,12 +1,21 @@
 """ Trajectory Tools """
 
 __all__ = ['unCenterCoords',
-		   'path_lengths',
-		   'vogel_sprial',
+		   'path_length',
+		   'vogel_spiral',
 		   'reorder_spiral_path',
-		   'snaked_spiral_path']
+		   'snaked_spiral_path',
+		   'optimized_spiral_path',
+		   'move_times',
+		   'scan_time',
+		   'motion_model_from_motors',
+		   'DEFAULT_MOTION_MODEL',
+		   'trajectory_chunks',
+		   'fly_trajectory_duration',
+		   'fly_scan_num_images']
 
 import math
+import time
 import numpy as np
 
 
@@ -86,41 +95,82 @@ def vogel_spiral(dr, x_radius, y_radius, factor, theta_0 = 137.508, polar = Fals
 
 
 
+def _ring_order(r, theta, dr):
+	"""Indices of the points ring by ring, and the (wrapped) angles"""
+	coords_n = np.floor(r/dr).astype(int)
+	
+	if np.max(np.abs(theta)) > 2*math.pi:
+		ttheta = theta % (2*math.pi)
+	else:
+		ttheta = theta
+
+	# last key is the primary one: ring index, then angle
+	return np.lexsort((ttheta, coords_n)), ttheta
+
+
+
+
 def reorder_spiral_path(r, theta, dr): 
 	"""
+	Orders fermat points ring by ring (ring width dr), by increasing
+	angle within each ring.  Done as a single stable lexsort so it scales
+	to 10^6 point trajectories.
+
 	args
 	----
 	r		: ndarray of radii in fermat trajectory
 	theta	: ndarray of angles in fermat trajectory
 	dr		: float of dr to use for "enforced" spiral
+
+	returns
+	-------
+	(N,2) ndarray of (r, theta); theta is wrapped to [0, 2*pi) only when
+	some |theta| > 2*pi, otherwise it is kept as given (possibly negative)
 	"""
 	
-	coords_n = np.floor(r/dr).astype(int)
-	
-	if max(abs(theta)) > 2*math.pi:
-		ttheta = theta % (2*math.pi)
-	else:
-		ttheta = theta
-		
-	for n in range(0,max(coords_n)+1):
-		rs = r[coords_n == n]
-		thetas = ttheta[coords_n == n]
-		_spiraled = []
-		for rr, tt in zip(rs, thetas):
-			_spiraled.append([rr,tt])
-		_spiraled_sorted = sorted(_spiraled, key=lambda coord: coord[1])
-		if n == 0:
-			spiraled = np.asarray(_spiraled_sorted)
-		else:
-			spiraled = np.append(spiraled, np.asarray(_spiraled_sorted), axis = 0)
+	r = np.asarray(r, dtype=float)
+	theta = np.asarray(theta, dtype=float)
+
+	order, ttheta = _ring_order(r, theta, dr)
+
+	spiraled = np.empty((order.size, 2))
+	np.take(r, order, out=spiraled[:,0])
+	np.take(ttheta, order, out=spiraled[:,1])
 			
 	return spiraled
 
 
 
 
+def _strip_order(xs, ys, strips, all_points = False):
+	"""
+	Indices of the points strip by strip, snaking along x.  Points on the
+	lower edge of the last strip are left out unless all_points.
+	"""
+	miny, maxy = np.min(ys), np.max(ys)
+	dy = (maxy - miny)/strips
+	
+	ystep_n = np.floor((maxy - ys)/dy).astype(int)
+	if all_points:
+		ystep_n = np.clip(ystep_n, 0, strips - 1)
+
+	keep = np.flatnonzero((ystep_n >= 0) & (ystep_n < strips))
+	strip_n = ystep_n[keep]
+
+	# odd strips run backwards: negating both the x key and the tie-break
+	# (original index) is exactly a reversed stable sort
+	sign = np.where(strip_n % 2 == 1, -1, 1)
+	return keep[np.lexsort((sign*keep, sign*xs[keep], strip_n))]
+
+
+
+
 def snaked_spiral_path(r, theta, strips = 10, snakeXaxis = True): 
 	"""
+	Orders fermat points in horizontal strips, alternating the direction
+	of the fast axis from strip to strip.  Done as a single stable lexsort
+	so it scales to 10^6 point trajectories.
+
 	args
 	----
 	r					: ndarray of radii in fermat trajectory
@@ -130,8 +180,18 @@ def snaked_spiral_path(r, theta, strips = 10, snakeXaxis = True):
 	------
 	strips = 10			: float of snake turns to make
 	snakeXaxis	= True	: boolean of whether to snake x or y axis
+
+	returns
+	-------
+	(N,2) ndarray of (x, y)
+
+	Points lying exactly on the lower edge of the last strip fall outside
+	of the strips and are not included (as in the original loop version).
 	"""
 	
+	r = np.asarray(r, dtype=float)
+	theta = np.asarray(theta, dtype=float)
+
 	if snakeXaxis:
 		xs = r*np.cos(theta)
 		ys = r*np.sin(theta)
@@ -139,28 +199,499 @@ def snaked_spiral_path(r, theta, strips = 10, snakeXaxis = True):
 		ys = r*np.cos(theta)
 		xs = r*np.sin(theta)
 	
-	miny, maxy = np.min(ys), np.max(ys)
-	dy = (maxy - miny)/strips
-	
-	ysteps = np.linspace(start = maxy, stop = miny, num = strips + 1)
-	
-	ystep_n = np.floor((maxy - ys)/dy).astype(int)
-	
-	for n in range(0, strips):
-		xs_strip = xs[ystep_n == n]
-		ys_strip = ys[ystep_n == n]
-		_strip_pts = []
-		for xx, yy in zip(xs_strip, ys_strip):
-			_strip_pts.append([xx,yy])
-		_strip_sorted = sorted(_strip_pts, key = lambda coord: coord[0])
-		if n % 2 == 1:
-			_strip_sorted.reverse()
-		if n == 0:
-			snaked = np.asarray(_strip_sorted)
-		else:
-			snaked = np.append(snaked, np.asarray(_strip_sorted), axis = 0)
+	order = _strip_order(xs, ys, strips)
 
-	if not snakeXaxis:
-		snaked[:,[0,1]] = snaked[:,[1,0]]
+	snaked = np.empty((order.size, 2))
+	if snakeXaxis:
+		np.take(xs, order, out=snaked[:,0])
+		np.take(ys, order, out=snaked[:,1])
+	else:
+		np.take(ys, order, out=snaked[:,0])
+		np.take(xs, order, out=snaked[:,1])
 		
 	return snaked
+
+
+
+
+# Placeholder stage model for sm_px/sm_py (um, um/s, um/s^2, s); use
+# motion_model_from_motors() for the real motor settings.
+DEFAULT_MOTION_MODEL = dict(
+	velocity = (50.0, 50.0),
+	acceleration = (500.0, 500.0),
+	settle = (0.02, 0.02),
+)
+
+
+
+
+def motion_model_from_motors(x_motor, y_motor, settle = 0.02):
+	"""
+	Builds a motion model from the EpicsMotor velocity and acceleration
+	(time to reach velocity) settings
+
+	args
+	----
+	x_motor			: EpicsMotor of x-axis
+	y_motor			: EpicsMotor of y-axis
+
+	kwargs
+	------
+	settle = 0.02	: float (or (x,y) tuple) of settling time after a move
+	"""
+
+	velocity = []
+	acceleration = []
+	for motor in (x_motor, y_motor):
+		v = motor.velocity.get()
+		accl = motor.acceleration.get()
+		velocity.append(v)
+		acceleration.append(v/accl if accl > 0 else float('inf'))
+
+	if np.isscalar(settle):
+		settle = (settle, settle)
+
+	return dict(velocity = tuple(velocity), acceleration = tuple(acceleration),
+				settle = tuple(settle))
+
+
+
+
+def _axis_move_time(d, v, a):
+	"""Trapezoidal (or triangular) profile time for a move of |d|"""
+	d = np.abs(d)
+	if np.isinf(a):
+		return d/v
+	return np.where(d < v*v/a, 2*np.sqrt(d/a), d/v + v/a)
+
+
+
+
+def _move_time(dx, dy, model):
+	"""Time of moves by (dx, dy): slowest axis including settling"""
+	(vx, vy), (ax, ay), (sx, sy) = (model['velocity'], model['acceleration'],
+									model['settle'])
+	tx = np.where(dx != 0, _axis_move_time(dx, vx, ax) + sx, 0)
+	ty = np.where(dy != 0, _axis_move_time(dy, vy, ay) + sy, 0)
+	return np.maximum(tx, ty)
+
+
+
+
+def move_times(x, y, motion_model = None):
+	"""
+	Predicted time of each move along a trajectory.  Axes move together,
+	so a move takes as long as its slowest axis (including settling).
+
+	args
+	----
+	x	: ndarray of x-coordinates of trajectory
+	y	: ndarray of y-coordinates of trajectory
+
+	kwargs
+	------
+	motion_model = None	: dict of per-axis (x,y) velocity, acceleration and
+						  settle, defaults to DEFAULT_MOTION_MODEL
+	"""
+
+	dx = np.diff(np.asarray(x, dtype=float))
+	dy = np.diff(np.asarray(y, dtype=float))
+
+	return _move_time(dx, dy, motion_model or DEFAULT_MOTION_MODEL)
+
+
+
+
+def scan_time(x, y, motion_model = None, dwell = 0.0):
+	"""
+	Predicted total time of a step scan along a trajectory
+
+	args
+	----
+	x	: ndarray of x-coordinates of trajectory
+	y	: ndarray of y-coordinates of trajectory
+
+	kwargs
+	------
+	motion_model = None	: dict of stage motion model, see move_times()
+	dwell = 0.0			: float of time spent at each point (exposure,
+						  readout)
+	"""
+
+	return float(np.sum(move_times(x, y, motion_model)) + dwell*len(x))
+
+
+
+
+def _grid_cells(x, y, cell):
+	"""Spatial hash: dict of (i,j) cell -> list of point indices"""
+	ci = np.floor((x - x.min())/cell).astype(int)
+	cj = np.floor((y - y.min())/cell).astype(int)
+	cells = {}
+	for n, key in enumerate(zip(ci.tolist(), cj.tolist())):
+		cells.setdefault(key, []).append(n)
+	return cells, ci, cj
+
+
+
+
+def _optimize_order(x, y, motion_model, time_budget, neighbours, fill):
+	"""
+	Nearest-neighbour seed then 2-opt/Or-opt refinement of an open path
+	starting at fill[0], minimizing the predicted move time.  Candidate
+	moves are restricted to the nearest neighbours found on a spatial grid.
+	When time runs out during the seed, the points left follow the order
+	fill.
+	"""
+
+	t_stop = time.perf_counter() + time_budget
+	n_pts = len(x)
+	if n_pts < 3:
+		return np.asarray(fill)
+	start = int(fill[0])
+
+	model = motion_model or DEFAULT_MOTION_MODEL
+	(vx, vy), (ax, ay), (sx, sy) = (model['velocity'], model['acceleration'],
+									model['settle'])
+
+	def axis_time(d, v, a, s):
+		if d == 0:
+			return 0.0
+		if math.isinf(a):
+			return d/v + s
+		if d < v*v/a:
+			return 2*math.sqrt(d/a) + s
+		return d/v + v/a + s
+
+	X = x.tolist()
+	Y = y.tolist()
+
+	def cost(p, q):
+		return max(axis_time(abs(X[p]-X[q]), vx, ax, sx),
+				   axis_time(abs(Y[p]-Y[q]), vy, ay, sy))
+
+	# ~2 points per cell
+	width = max(x.max() - x.min(), y.max() - y.min(), 1e-12)
+	cell = width*math.sqrt(2.0/n_pts)
+	cells, ci, cj = _grid_cells(x, y, cell)
+	ci, cj = ci.tolist(), cj.tolist()
+
+	# nearest neighbour seed, over the points not yet in the tour
+	free = {key: list(members) for key, members in cells.items()}
+	remaining = np.ones(n_pts, dtype=bool)
+	tour = np.empty(n_pts, dtype=int)
+	current = start
+	for step in range(n_pts):
+		tour[step] = current
+		remaining[current] = False
+		free[(ci[current], cj[current])].remove(current)
+		if step == n_pts - 1:
+			break
+		if not step % 256 and time.perf_counter() > t_stop:
+			# out of time: the rest in the fill order, no refinement
+			tour[step+1:] = fill[remaining[fill]]
+			return tour
+		best = None
+		ring = 0
+		while best is None and ring <= 3:
+			# once a candidate is found, one more ring may hold a closer one
+			for r in (ring, ring + 1):
+				for di in range(-r, r + 1):
+					for dj in range(-r, r + 1):
+						if max(abs(di), abs(dj)) != r:
+							continue
+						for q in free.get((ci[current]+di, cj[current]+dj), ()):
+							c = cost(current, q)
+							if best is None or c < best[0]:
+								best = (c, q)
+			ring += 2
+		if best is None:
+			# isolated: brute force over what is left
+			left = np.flatnonzero(remaining)
+			c = _move_time(x[left] - x[current], y[left] - y[current], model)
+			current = int(left[np.argmin(c)])
+		else:
+			current = best[1]
+
+	# nearest neighbour candidate lists from the 5x5 surrounding cells
+	nbrs = [None]*n_pts
+	for n_cell, ((i, j), members) in enumerate(cells.items()):
+		if not n_cell % 256 and time.perf_counter() > t_stop:
+			return tour
+		cand = []
+		for di in range(-2, 3):
+			for dj in range(-2, 3):
+				cand.extend(cells.get((i+di, j+dj), ()))
+		cand = np.asarray(cand)
+		members = np.asarray(members)
+		dist = np.maximum(np.abs(x[members,None] - x[cand])/vx,
+						  np.abs(y[members,None] - y[cand])/vy)
+		dist[members[:,None] == cand] = np.inf
+		k = min(neighbours, len(cand) - 1)
+		if k < 1:
+			for m in members:
+				nbrs[m] = []
+			continue
+		nearest = np.argpartition(dist, k - 1, axis=1)[:,:k]
+		for m, row, d in zip(members, nearest, dist):
+			nbrs[m] = [int(cand[c]) for c in row if np.isfinite(d[c])]
+
+	pos = np.empty(n_pts, dtype=int)
+	pos[tour] = np.arange(n_pts)
+	eps = 1e-12
+
+	def two_opt():
+		improved = False
+		for i in range(n_pts - 1):
+			if not i % 256 and time.perf_counter() > t_stop:
+				return improved
+			a = tour[i]
+			for c in nbrs[a]:
+				j = pos[c]
+				if j > i + 1:
+					lo, hi = i + 1, j
+				elif j < i:
+					lo, hi = j + 1, i
+				else:
+					continue
+				p, l, r = tour[lo-1], tour[lo], tour[hi]
+				delta = cost(p, r) - cost(p, l)
+				if hi < n_pts - 1:
+					nx = tour[hi+1]
+					delta += cost(l, nx) - cost(r, nx)
+				if delta < -eps:
+					tour[lo:hi+1] = tour[lo:hi+1][::-1].copy()
+					pos[tour[lo:hi+1]] = np.arange(lo, hi + 1)
+					improved = True
+					break
+		return improved
+
+	def or_opt():
+		nonlocal tour
+		improved = False
+		i = 1
+		while i < n_pts:
+			if not i % 256 and time.perf_counter() > t_stop:
+				return improved
+			moved = False
+			for seg_len in (1, 2, 3):
+				if i + seg_len > n_pts:
+					break
+				s0, s1 = tour[i], tour[i+seg_len-1]
+				p = tour[i-1]
+				gain = cost(p, s0)
+				if i + seg_len < n_pts:
+					nx = tour[i+seg_len]
+					gain += cost(s1, nx) - cost(p, nx)
+				for q in nbrs[s0] + nbrs[s1]:
+					k = pos[q]
+					if i - 1 <= k < i + seg_len:
+						continue
+					u = tour[k]
+					if k < n_pts - 1:
+						w = tour[k+1]
+						base = cost(u, w)
+						fwd = cost(u, s0) + cost(s1, w) - base
+						rev = cost(u, s1) + cost(s0, w) - base
+					else:
+						fwd = cost(u, s0)
+						rev = cost(u, s1)
+					if min(fwd, rev) - gain < -eps:
+						seg = tour[i:i+seg_len]
+						if rev < fwd:
+							seg = seg[::-1]
+						rest = np.concatenate((tour[:i], tour[i+seg_len:]))
+						at = k + 1 if k < i else k + 1 - seg_len
+						tour = np.concatenate((rest[:at], seg, rest[at:]))
+						pos[tour] = np.arange(n_pts)
+						improved = moved = True
+						break
+				if moved:
+					break
+			i += 1
+		return improved
+
+	while time.perf_counter() < t_stop:
+		improved = two_opt()
+		improved = or_opt() or improved
+		if not improved:
+			break
+
+	return tour
+
+
+
+
+def optimized_spiral_path(r, theta, motion_model = None, time_budget = 10.0,
+						  neighbours = 8, rough_dr = 5, strips = 10):
+	"""
+	Orders fermat points to minimize the predicted stage move time
+	(nearest-neighbour seed, then 2-opt/Or-opt refinement).  The spiral
+	and snake orderings are the baselines: the seed starts where the
+	faster one does and, when time runs out, continues in its order; the
+	faster of the baselines is returned when the tour does not beat it.
+
+	args
+	----
+	r					: ndarray of radii in fermat trajectory
+	theta				: ndarray of angles in fermat trajectory
+
+	kwargs
+	------
+	motion_model = None	: dict of stage motion model, see move_times()
+	time_budget = 10.0	: float of seconds allowed for the refinement
+	neighbours = 8		: int of candidate neighbours per point
+	rough_dr = 5		: float of ring width of the spiral baseline
+	strips = 10			: int of strips of the snake baseline
+
+	returns
+	-------
+	(N,2) ndarray of (x, y)
+	"""
+
+	r = np.asarray(r, dtype=float)
+	theta = np.asarray(theta, dtype=float)
+	xs = r*np.cos(theta)
+	ys = r*np.sin(theta)
+
+	model = motion_model or DEFAULT_MOTION_MODEL
+	baselines = [_ring_order(r, theta, rough_dr)[0],
+				 _strip_order(xs, ys, strips, all_points = True)]
+	times = [scan_time(xs[o], ys[o], model) for o in baselines]
+	order = baselines[int(np.argmin(times))]
+
+	tour = _optimize_order(xs, ys, model, time_budget, neighbours, order)
+	if scan_time(xs[tour], ys[tour], model) < min(times):
+		order = tour
+
+	optimized = np.empty((order.size, 2))
+	np.take(xs, order, out=optimized[:,0])
+	np.take(ys, order, out=optimized[:,1])
+
+	return optimized
+
+
+
+
+def trajectory_chunks(trajectory, x_center = 0.0, y_center = 0.0,
+					  chunk_size = 1000):
+	"""
+	Yields an (N,2) trajectory in (n,2) chunks with the center applied,
+	so large trajectories are never expanded into lists of Python floats
+
+	args
+	----
+	trajectory			: (N,2) ndarray of centered (x, y) points
+
+	kwargs
+	------
+	x_center = 0.0		: float of x offset added to each chunk
+	y_center = 0.0		: float of y offset added to each chunk
+	chunk_size = 1000	: int of points per chunk
+	"""
+
+	center = np.array([x_center, y_center], dtype=float)
+	for start in range(0, len(trajectory), chunk_size):
+		yield trajectory[start:start+chunk_size] + center
+
+
+
+
+# PMAC Motion_Program values used by VPFlyScan2d
+FLY_SCAN_MODES = {0: 'snake', 5: 'spiral', 7: 'lissajous'}
+
+# Placeholder PMAC trajectory acceleration (um/s^2) for the turnarounds,
+# not calibrated: fly_scan_num_images() keeps the 1.5 frames per point floor
+DEFAULT_PMAC_ACCELERATION = 1000.0
+
+
+
+
+def fly_trajectory_duration(scan_mode, x_width, y_width, x_step_size,
+							y_step_size, trig_freq,
+							acceleration = DEFAULT_PMAC_ACCELERATION,
+							turnaround_time = None):
+	"""
+	Predicted duration (s) of a PMAC fly trajectory.  The fast axis moves
+	one x_step_size per detector trigger, v = x_step_size*trig_freq.
+
+	snake (0)		: y_points lines of x_points frames, plus a
+					  turnaround (decelerate, step, accelerate) per line
+	spiral (5)		: constant speed spiral with pitch y_step_size covering
+					  the circle around the scan rectangle
+	lissajous (7)	: path of line density 1/y_step_size filling the
+					  scan rectangle
+
+	args
+	----
+	scan_mode		: int of PMAC Motion_Program (0, 5 or 7)
+	x_width			: float of x window width (um)
+	y_width			: float of y window width (um)
+	x_step_size		: float of x step size (um)
+	y_step_size		: float of y step size (um)
+	trig_freq		: float of detector trigger frequency (Hz)
+
+	kwargs
+	------
+	acceleration = DEFAULT_PMAC_ACCELERATION	: float of PMAC acceleration 
+												  (um/s^2)
+	turnaround_time = None	: float of measured turnaround time (s) of 
+							  snake lines; None --> 2*v/acceleration
+	"""
+
+	if scan_mode not in FLY_SCAN_MODES:
+		raise ValueError(f"Unknown scan_mode {scan_mode}, expected one of "
+						 f"{sorted(FLY_SCAN_MODES)}")
+
+	x_points = unCenterCoords(0.0, x_width, x_step_size)[2]
+	y_points = unCenterCoords(0.0, y_width, y_step_size)[2]
+	velocity = abs(x_step_size)*trig_freq
+	ramp = velocity/acceleration
+
+	if FLY_SCAN_MODES[scan_mode] == 'snake':
+		if turnaround_time is None:
+			turnaround_time = 2*ramp
+		return y_points*x_points/trig_freq + (y_points - 1)*turnaround_time
+
+	x_span = x_points*abs(x_step_size)
+	y_span = y_points*abs(y_step_size)
+	if FLY_SCAN_MODES[scan_mode] == 'spiral':
+		area = math.pi*(x_span**2 + y_span**2)/4
+	else:
+		area = x_span*y_span
+
+	return area/abs(y_step_size)/velocity + ramp
+
+
+
+
+def fly_scan_num_images(scan_mode, x_width, y_width, x_step_size,
+						y_step_size, trig_freq, margin = 0.02,
+						safety_factor = None, **kwargs):
+	"""
+	Number of detector frames to arm for a fly trajectory, see
+	fly_trajectory_duration() for args and kwargs: the predicted duration
+	plus margin.  With safety_factor, never fewer than the
+	x_points*y_points*safety_factor frames armed before the prediction.
+
+	kwargs
+	------
+	margin = 0.02		: float of fractional extra frames above the
+						  predicted duration
+	safety_factor = None	: float of minimum frames per scan point (e.g.
+						  1.5, the former fixed setting); None --> the
+						  prediction alone
+	"""
+
+	duration = fly_trajectory_duration(scan_mode, x_width, y_width,
+									   x_step_size, y_step_size, trig_freq,
+									   **kwargs)
+	num_images = int(math.ceil(duration*trig_freq*(1 + margin)))
+
+	if safety_factor is not None:
+		x_points = unCenterCoords(0.0, x_width, x_step_size)[2]
+		y_points = unCenterCoords(0.0, y_width, y_step_size)[2]
+		num_images = max(num_images,
+						 int(math.ceil(x_points*y_points*safety_factor)))
+
+	return num_images
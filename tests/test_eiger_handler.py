@@ -0,0 +1,125 @@
+"""
+MyEigerHandler bulk reads on synthetic Eiger-layout files
+"""
+
+import glob
+import os
+
+import h5py
+import numpy as np
+import pytest
+
+from instrument.framework.eiger_handler import (
+    H5FilePool,
+    MyEigerHandler,
+    direct_chunk_codec,
+)
+from instrument.framework.eiger_index import EigerRunIndex
+from instrument.utils.synthetic_eiger import write_synthetic_eiger_run
+
+NUM_IMAGES = 25
+IMAGES_PER_FILE = 10
+SHAPE = (8, 6)
+
+
+@pytest.fixture(autouse=True)
+def index_cache(tmp_path, monkeypatch):
+    cache = tmp_path / "index_cache"
+    monkeypatch.setattr(EigerRunIndex, "cache_dir", str(cache))
+    return cache
+
+
+@pytest.fixture
+def prefix(tmp_path):
+    prefix = str(tmp_path / "run")
+    write_synthetic_eiger_run(prefix, NUM_IMAGES, IMAGES_PER_FILE,
+                              shape=SHAPE)
+    return prefix
+
+
+def test_get_images_empty(prefix):
+    handler = MyEigerHandler(prefix, images_per_file=IMAGES_PER_FILE)
+    images = handler.get_images([])
+    assert images.shape == (0,) + SHAPE
+    assert images.dtype == np.uint32
+    handler.close()
+
+
+@pytest.mark.parametrize("reader", ["hdf5", "direct"])
+def test_get_images_matches_per_datum(prefix, reader):
+    handler = MyEigerHandler(prefix, images_per_file=IMAGES_PER_FILE,
+                             reader=reader)
+    image_nums = [24, 3, 4, 11, 0, 19, 3]
+    expected = np.concatenate([handler(i).compute() for i in image_nums])
+    np.testing.assert_array_equal(handler.get_images(image_nums), expected)
+    handler.close()
+
+
+def test_direct_reader_falls_back_on_partial_frame_chunks(tmp_path):
+    prefix = str(tmp_path / "tiled")
+    frames = np.arange(4*8*6, dtype=np.uint32).reshape((4,) + SHAPE)
+    with h5py.File(f"{prefix}_data_000001.h5", "w") as f:
+        f.create_dataset(MyEigerHandler.DATA_PATH, data=frames,
+                         chunks=(1, 4, 6))
+    with h5py.File(f"{prefix}_data_000001.h5", "r") as f:
+        assert direct_chunk_codec(f[MyEigerHandler.DATA_PATH]) is None
+    handler = MyEigerHandler(prefix, images_per_file=4, reader="direct")
+    np.testing.assert_array_equal(handler.get_images([2, 0]), frames[[2, 0]])
+    handler.close()
+
+
+def test_file_list_and_index(prefix, index_cache):
+    with h5py.File(f"{prefix}_master.h5", "w") as f:
+        f["entry/instrument"] = 0
+    # data file the file writer has not finished yet
+    with open(f"{prefix}_data_000004.h5", "wb") as f:
+        f.write(b"\x89HDF\r\n\x1a\n")
+
+    handler = MyEigerHandler(prefix, images_per_file=IMAGES_PER_FILE)
+    files = handler.get_file_list()
+    assert files[0] == f"{prefix}_master.h5"
+    assert [os.path.basename(f) for f in files[1:]] == [
+        f"run_data_{n:06d}.h5" for n in (1, 2, 3)]
+    assert handler.get_file_sizes() == [os.path.getsize(f) for f in files]
+    assert handler.num_images() == NUM_IMAGES
+    # the index is cached outside of the data directory
+    assert not glob.glob(f"{prefix}_index*")
+    assert len(os.listdir(index_cache)) == 1
+    handler.close()
+
+
+def test_direct_reader_bslz4_with_one_open_file(tmp_path, monkeypatch):
+    hdf5plugin = pytest.importorskip("hdf5plugin")
+    pytest.importorskip("bitshuffle")
+    prefix = str(tmp_path / "bslz4")
+    write_synthetic_eiger_run(prefix, NUM_IMAGES, IMAGES_PER_FILE,
+                              shape=SHAPE,
+                              compression=hdf5plugin.Bitshuffle(cname="lz4"))
+    with h5py.File(f"{prefix}_data_000001.h5", "r") as f:
+        assert direct_chunk_codec(f[MyEigerHandler.DATA_PATH]) == "bslz4"
+    # every file is closed as soon as the next one is opened
+    monkeypatch.setattr(MyEigerHandler, "file_pool",
+                        H5FilePool(max_open_files=1))
+    handler = MyEigerHandler(prefix, images_per_file=IMAGES_PER_FILE,
+                             reader="hdf5")
+    image_nums = list(range(NUM_IMAGES))[::-1]
+    expected = handler.get_images(image_nums)
+    handler.reader = "direct"
+    np.testing.assert_array_equal(handler.get_images(image_nums), expected)
+    handler.close()
+
+
+def test_index_locates_chunks(prefix):
+    index = EigerRunIndex(prefix, IMAGES_PER_FILE)
+    where = index.locate(13)
+    assert os.path.basename(where["path"]) == "run_data_000002.h5"
+    assert where["frame"] == 3
+    with h5py.File(where["path"], "r") as f:
+        info = f[MyEigerHandler.DATA_PATH].id.get_chunk_info_by_coord(
+            (3, 0, 0))
+    assert where["chunk_byte_offset"] == info.byte_offset
+    assert where["chunk_nbytes"] == info.size
+    first_frame, byte_offset, _, _ = index.file_chunks(3)
+    assert first_frame.tolist() == [0, 1, 2, 3, 4]
+    with pytest.raises(IndexError):
+        index.locate(NUM_IMAGES)
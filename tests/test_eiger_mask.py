@@ -0,0 +1,46 @@
+"""
+Pixel masks chosen by the date of the run
+"""
+
+import datetime
+
+import h5py
+import numpy as np
+
+from instrument.framework.eiger_mask import (
+    PixelMaskCache,
+    mask_for_run,
+    read_master_info,
+)
+
+SHAPE = (4, 5)
+
+
+def write_master(prefix, date):
+    with h5py.File(f"{prefix}_master.h5", "w") as f:
+        det = f.create_group("entry/instrument/detector")
+        det["detector_number"] = b"E-32-0123"
+        det["threshold_energy"] = 6000.0
+        specific = det.create_group("detectorSpecific")
+        specific["pixel_mask"] = np.zeros(SHAPE, dtype=np.uint32)
+        specific["data_collection_date"] = date.encode()
+
+
+def test_read_master_info_date(tmp_path):
+    prefix = str(tmp_path / "run")
+    write_master(prefix, "2021-05-12T10:01:02.345+01:00")
+    assert read_master_info(f"{prefix}_master.h5")["date"] == \
+        datetime.date(2021, 5, 12)
+
+
+def test_mask_for_run_uses_the_run_date(tmp_path):
+    prefix = str(tmp_path / "run")
+    write_master(prefix, "2021-05-12T10:01:02.345+01:00")
+    cache = PixelMaskCache(cache_dir=False)
+    before = np.ones(SHAPE, dtype=bool)
+    after = before.copy()
+    after[0, 0] = False
+    cache.put("E-32-0123", 6000, before, date="2021-05-01")
+    cache.put("E-32-0123", 6000, after, date="2021-06-01")
+
+    np.testing.assert_array_equal(mask_for_run(prefix, cache=cache), before)
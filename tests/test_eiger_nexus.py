@@ -0,0 +1,50 @@
+"""
+NeXus master files of runs sharing the data files of one arm
+"""
+
+import h5py
+import numpy as np
+import pytest
+
+from instrument.framework.eiger_index import EigerRunIndex
+from instrument.framework.eiger_nexus import nexus_master_from_documents
+from instrument.utils.synthetic_eiger import write_synthetic_eiger_run
+
+SHAPE = (4, 5)
+
+
+@pytest.fixture(autouse=True)
+def index_in_memory(monkeypatch):
+    monkeypatch.setattr(EigerRunIndex, "cache_dir", False)
+
+
+def run_documents(prefix, image_nums, positions):
+    yield "start", {"uid": "run", "scan_id": 2, "time": 0.0}
+    yield "resource", {"uid": "res", "spec": "AD_EIGER", "root": "",
+                       "resource_path": prefix,
+                       "resource_kwargs": {"images_per_file": 10}}
+    for i in image_nums:
+        yield "datum", {"resource": "res", "datum_id": f"res/{i}",
+                        "datum_kwargs": {"image_num": i}}
+    yield "descriptor", {"uid": "desc", "name": "primary", "data_keys": {
+        "x": {"dtype": "number", "shape": [], "source": "x"}}}
+    yield "event_page", {"descriptor": "desc", "data": {"x": positions}}
+
+
+def test_second_run_of_one_arm(tmp_path):
+    prefix = str(tmp_path / "series")
+    # first run: images 0-6, second run: images 7-18, in files of 10
+    write_synthetic_eiger_run(prefix, 19, 10, shape=SHAPE)
+    output = nexus_master_from_documents(
+        run_documents(prefix, range(7, 19), list(range(12))),
+        output=str(tmp_path / "run2_nexus.h5"))
+
+    with h5py.File(output, "r") as f, \
+            h5py.File(f"{prefix}_data_000001.h5", "r") as f1, \
+            h5py.File(f"{prefix}_data_000002.h5", "r") as f2:
+        data = f["entry/data/data"]
+        assert data.shape == (12,) + SHAPE
+        expected = np.concatenate((f1["entry/data/data"][7:],
+                                   f2["entry/data/data"][:]))
+        np.testing.assert_array_equal(data[()], expected)
+        assert len(f["entry/data/x"]) == len(data)
@@ -0,0 +1,56 @@
+"""
+Exposure windows and per-frame positions of fly scans
+"""
+
+import numpy as np
+import pytest
+
+from instrument.utils.fly_positions import (
+    align_positions,
+    frame_windows,
+    text_positions_to_npy,
+)
+
+
+@pytest.mark.parametrize("trig_freq, laser_freq", [
+    (80.0, 5000), (100.0, 5000), (1000.0, 10000)])
+@pytest.mark.parametrize("explicit_exposure", [False, True])
+def test_full_period_windows_tile_the_samples(trig_freq, laser_freq,
+                                              explicit_exposure):
+    num_frames = 20000
+    num_samples = int(np.ceil(num_frames * laser_freq / trig_freq))
+    samples = np.arange(num_samples, dtype=float)[:, None]
+    exposure = 1.0 / trig_freq if explicit_exposure else None
+    starts, stops = frame_windows(num_frames, trig_freq, exposure)
+
+    result = align_positions(samples, starts, stops, sample_rate=laser_freq)
+    lo = np.ceil(np.arange(num_frames) * laser_freq / trig_freq)
+    hi = np.ceil(np.arange(1, num_frames + 1) * laser_freq / trig_freq)
+    np.testing.assert_array_equal(result["count"], hi - lo)
+    assert result["count"].sum() == len(samples)
+    np.testing.assert_allclose(result["mean"][:, 0], (lo + hi - 1) / 2)
+
+
+def test_one_sample_touch_goes_to_the_later_frame():
+    samples = np.arange(10, dtype=float)[:, None]
+    result = align_positions(samples, [0, 4], [5, 8])
+    np.testing.assert_array_equal(result["count"], [4, 4])
+    np.testing.assert_array_equal(result["mean"][:, 0], [1.5, 5.5])
+    with pytest.raises(ValueError):
+        align_positions(samples, [0, 3], [5, 8])
+
+
+def test_text_positions_skip_blank_and_comment_lines(tmp_path):
+    path = tmp_path / "positions.txt"
+    rows = np.arange(20, dtype=float).reshape(10, 2)
+    lines = ["# x y"]
+    for n, row in enumerate(rows):
+        lines.append(f"{row[0]} {row[1]}")
+        if n in (2, 3):
+            # a whole chunk of blank lines
+            lines += ["", "  ", ""]
+    lines += ["# end", ""]
+    path.write_text("\n".join(lines) + "\n")
+
+    output = text_positions_to_npy(str(path), chunk_lines=3)
+    np.testing.assert_array_equal(np.load(output), rows)
@@ -0,0 +1,43 @@
+"""
+PtychoPreprocessor on a synthetic Eiger run
+"""
+
+import h5py
+import numpy as np
+import pytest
+
+from instrument.framework.eiger_index import EigerRunIndex
+from instrument.utils.ptycho_preprocess import (
+    PtychoPreprocessor,
+    preprocess_frames,
+)
+from instrument.utils.synthetic_eiger import write_synthetic_eiger_run
+
+NUM_IMAGES = 50
+IMAGES_PER_FILE = 20
+
+
+@pytest.fixture
+def run(tmp_path, monkeypatch):
+    monkeypatch.setattr(EigerRunIndex, "cache_dir", False)
+    prefix = str(tmp_path / "run")
+    frames = []
+    for path in write_synthetic_eiger_run(prefix, NUM_IMAGES,
+                                          IMAGES_PER_FILE, shape=(16, 20)):
+        with h5py.File(path, "r") as f:
+            frames.append(f["entry/data/data"][()])
+    return prefix, np.concatenate(frames)
+
+
+@pytest.mark.parametrize("start", [0, 13])
+def test_run_writes_from_the_start_of_the_output(run, tmp_path, start):
+    prefix, frames = run
+    output = str(tmp_path / "reduced.h5")
+    kwargs = dict(center=(9, 7), crop_size=8, binning=2)
+    PtychoPreprocessor(prefix, IMAGES_PER_FILE, output, workers=3,
+                       batch_size=6, **kwargs).run(start=start)
+
+    with h5py.File(output, "r") as f:
+        reduced = f["entry/data/data"][()]
+    np.testing.assert_array_equal(reduced,
+                                  preprocess_frames(frames[start:], **kwargs))
@@ -0,0 +1,139 @@
+"""
+Spiral orderings against the original per-ring/per-strip loop versions
+"""
+
+import math
+import os
+import time
+
+import numpy as np
+import pytest
+
+from instrument.utils.trajectory_tools import (
+    optimized_spiral_path,
+    reorder_spiral_path,
+    scan_time,
+    snaked_spiral_path,
+    vogel_spiral,
+)
+
+
+def loop_reorder_spiral_path(r, theta, dr):
+    """reorder_spiral_path before the lexsort rewrite."""
+    coords_n = np.floor(r/dr).astype(int)
+    if max(abs(theta)) > 2*math.pi:
+        ttheta = theta % (2*math.pi)
+    else:
+        ttheta = theta
+    for n in range(0, max(coords_n)+1):
+        rs = r[coords_n == n]
+        thetas = ttheta[coords_n == n]
+        _spiraled = [[rr, tt] for rr, tt in zip(rs, thetas)]
+        _spiraled_sorted = sorted(_spiraled, key=lambda coord: coord[1])
+        if n == 0:
+            spiraled = np.asarray(_spiraled_sorted)
+        else:
+            spiraled = np.append(spiraled, np.asarray(_spiraled_sorted),
+                                 axis=0)
+    return spiraled
+
+
+def loop_snaked_spiral_path(r, theta, strips=10, snakeXaxis=True):
+    """snaked_spiral_path before the lexsort rewrite."""
+    if snakeXaxis:
+        xs = r*np.cos(theta)
+        ys = r*np.sin(theta)
+    else:
+        ys = r*np.cos(theta)
+        xs = r*np.sin(theta)
+    miny, maxy = np.min(ys), np.max(ys)
+    dy = (maxy - miny)/strips
+    ystep_n = np.floor((maxy - ys)/dy).astype(int)
+    for n in range(0, strips):
+        xs_strip = xs[ystep_n == n]
+        ys_strip = ys[ystep_n == n]
+        _strip_pts = [[xx, yy] for xx, yy in zip(xs_strip, ys_strip)]
+        _strip_sorted = sorted(_strip_pts, key=lambda coord: coord[0])
+        if n % 2 == 1:
+            _strip_sorted.reverse()
+        if n == 0:
+            snaked = np.asarray(_strip_sorted)
+        else:
+            snaked = np.append(snaked, np.asarray(_strip_sorted), axis=0)
+    if not snakeXaxis:
+        snaked[:, [0, 1]] = snaked[:, [1, 0]]
+    return snaked
+
+
+# (delta_r, x_radius, y_radius, factor) as used by the plans
+GEOMETRIES = [
+    (0.5, 5.0, 5.0, 1),
+    (0.2, 10.0, 4.0, 1),
+    (1.0, 40.0, 40.0, 3),
+]
+
+
+@pytest.mark.parametrize("delta_r, x_radius, y_radius, factor", GEOMETRIES)
+@pytest.mark.parametrize("rough_dr", [0.5, 5])
+def test_reorder_spiral_path_matches_loop(delta_r, x_radius, y_radius,
+                                          factor, rough_dr):
+    r, theta = vogel_spiral(delta_r, x_radius, y_radius, factor, polar=True)
+    expected = loop_reorder_spiral_path(r, theta, rough_dr)
+    np.testing.assert_array_equal(reorder_spiral_path(r, theta, rough_dr),
+                                  expected)
+
+
+def test_reorder_spiral_path_small_negative_angles():
+    rng = np.random.default_rng(1)
+    r = rng.uniform(0, 10, 500)
+    theta = rng.uniform(-math.pi, math.pi, 500)
+    result = reorder_spiral_path(r, theta, 2.0)
+    np.testing.assert_array_equal(result,
+                                  loop_reorder_spiral_path(r, theta, 2.0))
+    # not wrapped: max |theta| <= 2 pi
+    assert result[:, 1].min() < 0
+
+
+@pytest.mark.parametrize("delta_r, x_radius, y_radius, factor", GEOMETRIES)
+@pytest.mark.parametrize("strips", [3, 10])
+@pytest.mark.parametrize("snakeXaxis", [True, False])
+def test_snaked_spiral_path_matches_loop(delta_r, x_radius, y_radius, factor,
+                                         strips, snakeXaxis):
+    r, theta = vogel_spiral(delta_r, x_radius, y_radius, factor, polar=True)
+    expected = loop_snaked_spiral_path(r, theta, strips, snakeXaxis)
+    np.testing.assert_array_equal(
+        snaked_spiral_path(r, theta, strips=strips, snakeXaxis=snakeXaxis),
+        expected)
+
+
+@pytest.mark.skipif(not os.environ.get("VP_BENCHMARKS"),
+                    reason="wall-clock timing, set VP_BENCHMARKS=1 to run")
+def test_orderings_faster_than_loop():
+    # ~3*10^4 points over ~700 rings
+    r, theta = vogel_spiral(0.2, 20.0, 20.0, 1, polar=True)
+    timings = {}
+    for name, new, old in [
+        ("reorder", lambda: reorder_spiral_path(r, theta, 0.5),
+         lambda: loop_reorder_spiral_path(r, theta, 0.5)),
+        ("snake", lambda: snaked_spiral_path(r, theta, strips=50),
+         lambda: loop_snaked_spiral_path(r, theta, strips=50)),
+    ]:
+        t0 = time.perf_counter()
+        old()
+        t1 = time.perf_counter()
+        new()
+        t2 = time.perf_counter()
+        timings[name] = (t1 - t0, t2 - t1)
+    for old_time, new_time in timings.values():
+        assert new_time < old_time
+
+
+@pytest.mark.parametrize("time_budget", [0.0, 0.05])
+def test_optimized_path_never_slower_than_baselines(time_budget):
+    r, theta = vogel_spiral(0.1, 10.0, 10.0, 1, polar=True)
+    spiral = reorder_spiral_path(r, theta, 5)
+    spiral_time = scan_time(spiral[:, 0]*np.cos(spiral[:, 1]),
+                            spiral[:, 0]*np.sin(spiral[:, 1]))
+    optimized = optimized_spiral_path(r, theta, time_budget=time_budget)
+    assert len(optimized) == len(r)
+    assert scan_time(optimized[:, 0], optimized[:, 1]) <= spiral_time
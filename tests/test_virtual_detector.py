@@ -0,0 +1,38 @@
+"""
+VirtualDetectorStream on a synthetic Eiger run
+"""
+
+import h5py
+import numpy as np
+
+from instrument.callbacks.virtual_detector import (
+    VirtualDetectorStream,
+    reduce_frames,
+)
+from instrument.framework.eiger_index import EigerRunIndex
+from instrument.utils.synthetic_eiger import write_synthetic_eiger_run
+
+
+def test_reduce_run_matches_in_memory(tmp_path, monkeypatch):
+    monkeypatch.setattr(EigerRunIndex, "cache_dir", False)
+    prefix = str(tmp_path / "run")
+    paths = write_synthetic_eiger_run(prefix, 45, 20, shape=(16, 12))
+    frames = []
+    for path in paths:
+        with h5py.File(path, "r") as f:
+            frames.append(f["entry/data/data"][()])
+    frames = np.concatenate(frames)
+    rois = [(2, 3, 4, 5)]
+
+    docs = []
+    vd = VirtualDetectorStream(rois=rois, workers=3,
+                               publish=lambda name, doc: docs.append(name))
+    vd.reduce_run(prefix, 20, batch_size=7)
+    maps = vd.stop()
+
+    expected = reduce_frames(frames, rois)
+    np.testing.assert_array_equal(maps["image_num"], np.arange(45))
+    for key, values in expected.items():
+        np.testing.assert_allclose(maps[key], values)
+    assert docs[0] == "start" and docs[-1] == "stop"
+    assert docs.count("event_page") == 7